@@ -1,17 +1,13 @@
-import requests
-import os
+import sys
 
+from gcp_identity_client import WorkloadIdentityClient
+
+# --wait: also wait until the metadata server hands out credentials of the new GCP service account
+wait = '--wait' in sys.argv
 org = 'org1'
-url = 'http://gcpworkloadidentity-svc.gcp-aes4085-platform/assume_service_account'
-headers = {"Content-Type" : "application/json",
-           "X-Domino-Api-Key": os.environ['DOMINO_USER_API_KEY']
-          }
-print(headers)
-data = {
-    "domino_org" : org,
-    "run_id" : os.environ['DOMINO_RUN_ID']
-}
 
-resp = requests.post(url,headers=headers,json=data)
-print(resp.status_code)
-print(resp.content)
\ No newline at end of file
+with WorkloadIdentityClient() as client:
+    gcp_service_account = client.assume(org)
+    print(f'Assumed {gcp_service_account}')
+    if wait:
+        print(f'Credentials ready after {client.wait_until_ready(gcp_service_account):.1f}s')
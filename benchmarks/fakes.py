@@ -0,0 +1,426 @@
+"""Local stand-ins for the upstream services used by the benchmarks.
+
+Each fake is a threaded HTTP/1.1 server (so keep-alive behaves like the real
+upstream) that counts accepted TCP connections and requests per route.
+"""
+import json
+import re
+import sys
+from urllib.parse import parse_qs, urlsplit
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Write each response in one segment; avoids Nagle/delayed-ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def setup(self):
+        super().setup()
+        self.server.fake.record_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.fake.record_bytes(length)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _dispatch(self):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        status, payload = fake.handle(self.command, self.path, self.headers, self._body())
+        if isinstance(payload, Stream):
+            self._stream(status, payload)
+            return
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, status, stream):
+        # Chunked newline-delimited JSON until the stream ends (like a watch timing out)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for item in stream.items:
+            data = json.dumps(item).encode() + b'\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+
+class Stream:
+    """A streamed response body: an iterable of JSON documents."""
+
+    def __init__(self, items):
+        self.items = items
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-response (a watch being closed, the service exiting) are expected
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class FakeServer:
+    """Base class: subclasses implement ``routes`` as (method, regex, callable)."""
+
+    routes = ()
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.connections = 0
+        self.bytes_received = 0
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._httpd = _FakeHTTPServer(('127.0.0.1', 0), _FakeHandler)
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f'http://{host}:{port}'
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record_bytes(self, length):
+        with self._lock:
+            self.bytes_received += length
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections = 0
+            self.bytes_received = 0
+            self.requests.clear()
+
+    def handle(self, method, path, headers, body):
+        url = urlsplit(path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        for route_method, pattern, name in self.routes:
+            m = re.fullmatch(pattern, url.path)
+            if route_method == method and m:
+                if query.get('watch', '').lower() == 'true':
+                    name = f'watch_{name}'
+                with self._lock:
+                    self.requests[name] += 1
+                return getattr(self, name)(query, headers, body, *m.groups())
+        return 404, {'message': f'{method} {path} not found'}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeDomino(FakeServer):
+    """nucleus-frontend: principal and organization lookups keyed by API key."""
+
+    routes = (
+        ('GET', r'/v4/auth/principal', 'principal'),
+        ('GET', r'/api/organizations/v1/organizations', 'organizations'),
+    )
+
+    def __init__(self, users: dict = None, latency: float = 0.0):
+        super().__init__(latency)
+        # api key -> {'id': ..., 'orgs': [...], 'admin': bool}
+        self.users = users or {}
+
+    def principal(self, query, headers, body):
+        user = self.users.get(headers.get('X-Domino-Api-Key'))
+        if not user:
+            return 401, {'message': 'unknown api key'}
+        ops = ['ActAsProjectAdmin'] if user.get('admin') else []
+        return 200, {'canonicalId': user['id'], 'allowedSystemOperations': ops}
+
+    def organizations(self, query, headers, body):
+        user = self.users.get(headers.get('X-Domino-Api-Key'))
+        if not user:
+            return 401, {'message': 'unknown api key'}
+        return 200, {'orgs': [{'name': o} for o in user['orgs']]}
+
+
+class FakeKubernetes(FakeServer):
+    """Minimal core/v1 API: pods, service accounts and config maps, with list, watch and patch.
+
+    Watches replay events after the requested resourceVersion and then follow
+    new events until ``timeoutSeconds``; a resourceVersion older than the
+    retained ``event_history`` answers with a 410 Gone ERROR event.
+    """
+
+    routes = (
+        ('GET', r'/api/v1/namespaces/([^/]+)/pods', 'list_pods'),
+        ('GET', r'/api/v1/namespaces/([^/]+)/serviceaccounts/([^/]+)', 'read_service_account'),
+        ('PATCH', r'/api/v1/namespaces/([^/]+)/serviceaccounts/([^/]+)', 'patch_service_account'),
+        ('GET', r'/api/v1/namespaces/([^/]+)/configmaps', 'list_config_maps'),
+        ('POST', r'/api/v1/namespaces/([^/]+)/configmaps', 'create_config_map'),
+        ('GET', r'/api/v1/namespaces/([^/]+)/configmaps/([^/]+)', 'read_config_map'),
+        ('PATCH', r'/api/v1/namespaces/([^/]+)/configmaps/([^/]+)', 'patch_config_map'),
+        ('GET', r'/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases', 'list_leases'),
+        ('POST', r'/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases', 'create_lease'),
+        ('GET', r'/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases/([^/]+)', 'read_lease'),
+        ('PATCH', r'/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases/([^/]+)', 'patch_lease'),
+        ('DELETE', r'/apis/coordination.k8s.io/v1/namespaces/([^/]+)/leases/([^/]+)', 'delete_lease'),
+    )
+
+    def __init__(self, latency: float = 0.0, event_history: int = 10000):
+        super().__init__(latency)
+        self.resource_version = 1
+        self.pods = {}
+        self.service_accounts = {}
+        self.config_maps = {}
+        self.leases = {}
+        self.event_history = event_history
+        self._events = []
+        self._changed = threading.Condition(self._lock)
+
+    def _next_rv(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def _record(self, kind, event_type, obj):
+        # Called with self._lock held
+        obj['metadata']['resourceVersion'] = self._next_rv()
+        self._events.append((self.resource_version, kind, event_type, json.loads(json.dumps(obj))))
+        del self._events[:-self.event_history]
+        self._changed.notify_all()
+
+    def add_run_pod(self, namespace, run_id, user_id, service_account=None):
+        service_account = service_account or f'run-{run_id}'
+        name = f'run-{run_id}-pod'
+        with self._lock:
+            pod = {'metadata': {'name': name, 'namespace': namespace,
+                                'creationTimestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                                'labels': {'dominodatalab.com/execution-id': run_id,
+                                           'dominodatalab.com/starting-user-id': user_id}},
+                   'spec': {'serviceAccountName': service_account, 'serviceAccount': service_account,
+                            'containers': [{'name': 'run', 'image': 'run'}]}}
+            self.pods[(namespace, name)] = pod
+            self._record('pods', 'ADDED', pod)
+            sa = {'metadata': {'name': service_account, 'namespace': namespace, 'annotations': {}}}
+            self.service_accounts[(namespace, service_account)] = sa
+            self._record('serviceaccounts', 'ADDED', sa)
+
+    def delete_run_pod(self, namespace, run_id):
+        with self._lock:
+            pod = self.pods.pop((namespace, f'run-{run_id}-pod'), None)
+            if pod:
+                self._record('pods', 'DELETED', pod)
+
+    def add_config_map(self, namespace, name, data=None):
+        with self._lock:
+            cm = {'metadata': {'name': name, 'namespace': namespace}, 'data': dict(data or {})}
+            self.config_maps[(namespace, name)] = cm
+            self._record('configmaps', 'ADDED', cm)
+
+    def _selected(self, query, namespace, store):
+        items = [o for (ns, _), o in store.items() if ns == namespace]
+        return [o for o in items if _matches(o, query)]
+
+    def _list(self, kind, query, namespace, store):
+        if query.get('watch', '').lower() == 'true':
+            return 200, Stream(self._watch(kind, query, namespace))
+        with self._lock:
+            items = json.loads(json.dumps(self._selected(query, namespace, store)))
+            return 200, {'kind': 'List', 'apiVersion': 'v1',
+                         'metadata': {'resourceVersion': str(self.resource_version)}, 'items': items}
+
+    def _watch(self, kind, query, namespace):
+        since = int(query.get('resourceVersion') or self.resource_version)
+        deadline = time.monotonic() + float(query.get('timeoutSeconds', 30))
+        while True:
+            with self._lock:
+                if self._events and since < self._events[0][0] - 1:
+                    yield {'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410, 'reason': 'Expired',
+                                                       'message': f'too old resource version: {since}'}}
+                    return
+                pending = [e for e in self._events if e[0] > since]
+                if not pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._changed.wait(min(remaining, 1.0))
+                    continue
+            for rv, event_kind, event_type, obj in pending:
+                since = rv
+                if event_kind == kind and obj['metadata']['namespace'] == namespace and _matches(obj, query):
+                    yield {'type': event_type, 'object': obj}
+
+    def _read(self, store, key):
+        with self._lock:
+            obj = store.get(key)
+            if obj is None:
+                return 404, {'kind': 'Status', 'code': 404, 'message': f'{key[1]} not found'}
+            return 200, json.loads(json.dumps(obj))
+
+    def _patch(self, kind, store, key, body):
+        with self._lock:
+            obj = store.get(key)
+            if obj is None:
+                return 404, {'kind': 'Status', 'code': 404, 'message': f'{key[1]} not found'}
+            expected = ((body or {}).get('metadata') or {}).get('resourceVersion')
+            if expected and expected != obj['metadata']['resourceVersion']:
+                return 409, {'kind': 'Status', 'code': 409, 'reason': 'Conflict',
+                             'message': f'the object has been modified; resourceVersion {expected} is stale'}
+            _merge(obj, body or {})
+            self._record(kind, 'MODIFIED', obj)
+            return 200, json.loads(json.dumps(obj))
+
+    def list_pods(self, query, headers, body, namespace):
+        return self._list('pods', query, namespace, self.pods)
+
+    watch_list_pods = list_pods
+
+    def read_service_account(self, query, headers, body, namespace, name):
+        return self._read(self.service_accounts, (namespace, name))
+
+    def patch_service_account(self, query, headers, body, namespace, name):
+        return self._patch('serviceaccounts', self.service_accounts, (namespace, name), body)
+
+    def list_config_maps(self, query, headers, body, namespace):
+        return self._list('configmaps', query, namespace, self.config_maps)
+
+    watch_list_config_maps = list_config_maps
+
+    def create_config_map(self, query, headers, body, namespace):
+        name = body['metadata']['name']
+        with self._lock:
+            if (namespace, name) in self.config_maps:
+                return 409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists', 'message': f'{name} exists'}
+            cm = {'metadata': {'name': name, 'namespace': namespace}, 'data': dict(body.get('data') or {})}
+            self.config_maps[(namespace, name)] = cm
+            self._record('configmaps', 'ADDED', cm)
+            return 201, json.loads(json.dumps(cm))
+
+    def read_config_map(self, query, headers, body, namespace, name):
+        return self._read(self.config_maps, (namespace, name))
+
+    def patch_config_map(self, query, headers, body, namespace, name):
+        return self._patch('configmaps', self.config_maps, (namespace, name), body)
+
+    def list_leases(self, query, headers, body, namespace):
+        return self._list('leases', query, namespace, self.leases)
+
+    watch_list_leases = list_leases
+
+    def create_lease(self, query, headers, body, namespace):
+        name = body['metadata']['name']
+        with self._lock:
+            if (namespace, name) in self.leases:
+                return 409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists', 'message': f'{name} exists'}
+            lease = dict(body, metadata=dict(body['metadata'], namespace=namespace))
+            self.leases[(namespace, name)] = lease
+            self._record('leases', 'ADDED', lease)
+            return 201, json.loads(json.dumps(lease))
+
+    def read_lease(self, query, headers, body, namespace, name):
+        return self._read(self.leases, (namespace, name))
+
+    def patch_lease(self, query, headers, body, namespace, name):
+        return self._patch('leases', self.leases, (namespace, name), body)
+
+    def delete_lease(self, query, headers, body, namespace, name):
+        with self._lock:
+            lease = self.leases.pop((namespace, name), None)
+            if lease is None:
+                return 404, {'kind': 'Status', 'code': 404, 'message': f'{name} not found'}
+            self._record('leases', 'DELETED', lease)
+            return 200, {'kind': 'Status', 'status': 'Success'}
+
+
+def _matches(obj, query):
+    """Equality/existence label selectors and metadata.name field selectors."""
+    labels = obj['metadata'].get('labels') or {}
+    for term in filter(None, query.get('labelSelector', '').split(',')):
+        key, _, value = term.partition('=')
+        if key not in labels or ('=' in term and labels[key] != value):
+            return False
+    for term in filter(None, query.get('fieldSelector', '').split(',')):
+        key, _, value = term.partition('=')
+        if key == 'metadata.name' and obj['metadata']['name'] != value:
+            return False
+    return True
+
+
+def _merge(target: dict, patch: dict):
+    """JSON merge patch (RFC 7386) semantics."""
+    for k, v in patch.items():
+        if v is None:
+            target.pop(k, None)
+        elif isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = v
+
+
+class FakeIam(FakeServer):
+    """IAM serviceAccounts getIamPolicy/setIamPolicy with etag checking (409 on a stale etag)."""
+
+    routes = (
+        ('POST', r'/v1/projects/([^/]+)/serviceAccounts/([^/:]+):getIamPolicy', 'get_iam_policy'),
+        ('POST', r'/v1/projects/([^/]+)/serviceAccounts/([^/:]+):setIamPolicy', 'set_iam_policy'),
+    )
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.policies = {}
+        self.conflicts = 0
+        self._versions = Counter()
+
+    def policy(self, gcp_service_account):
+        with self._lock:
+            return json.loads(json.dumps(self.policies.get(gcp_service_account, {})))
+
+    def members(self, gcp_service_account, role='roles/iam.workloadIdentityUser'):
+        return [m for b in self.policy(gcp_service_account).get('bindings', []) if b['role'] == role
+                for m in b['members']]
+
+    def get_iam_policy(self, query, headers, body, project, gcp_service_account):
+        with self._lock:
+            policy = json.loads(json.dumps(self.policies.get(gcp_service_account, {})))
+            policy['etag'] = f'etag-{self._versions[gcp_service_account]}'
+            policy.setdefault('version', 1)
+            return 200, policy
+
+    def set_iam_policy(self, query, headers, body, project, gcp_service_account):
+        policy = dict(body['policy'])
+        with self._lock:
+            current = f'etag-{self._versions[gcp_service_account]}'
+            if 'etag' in policy and policy['etag'] != current:
+                self.conflicts += 1
+                return 409, {'error': {'code': 409, 'status': 'ABORTED',
+                                       'message': 'There were concurrent policy changes.'}}
+            policy.pop('etag', None)
+            self._versions[gcp_service_account] += 1
+            self.policies[gcp_service_account] = policy
+            policy = dict(policy, etag=f'etag-{self._versions[gcp_service_account]}')
+            return 200, policy
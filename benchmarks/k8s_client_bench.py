@@ -0,0 +1,87 @@
+"""Kubernetes API connection count and latency per request: fresh client per call vs shared KubernetesContext.
+
+Runs the Kubernetes calls made by one /assume_service_account request (remove then apply)
+against the local fake API server and reports connections opened and latency per request.
+
+    python benchmarks/k8s_client_bench.py --requests 200 --latency 0.002
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gcp-workload-identity'))
+
+from kubernetes import client  # noqa: E402
+
+from fakes import FakeDomino, FakeKubernetes  # noqa: E402
+import k8s_context  # noqa: E402
+import utils  # noqa: E402
+
+PLATFORM_NS = 'domino-platform'
+COMPUTE_NS = 'domino-compute'
+API_KEY = 'bench-key'
+GSA = 'bench@project.iam.gserviceaccount.com'
+
+
+class FreshClientContext(k8s_context.KubernetesContext):
+    """Reproduces the old behaviour: a new ApiClient (and connection pool) for every call."""
+
+    @property
+    def core_v1(self):
+        return client.CoreV1Api(client.ApiClient(self.configuration))
+
+    @core_v1.setter
+    def core_v1(self, value):
+        pass
+
+
+def one_request(ctx, run_id):
+    # The Kubernetes calls made by /assume_service_account, minus IAM
+    pod_sa = utils.get_pod_service_account(API_KEY, run_id, COMPUTE_NS, ctx)
+    utils.pod_svc_account_annotations(pod_sa, COMPUTE_NS, ctx)
+    utils.get_orgs_gcp_service_accounts_mapping(PLATFORM_NS, ctx)
+    utils.get_pod_service_account(API_KEY, run_id, COMPUTE_NS, ctx)
+    utils.annotate_pod_service_account(pod_sa, GSA, COMPUTE_NS, ctx)
+    utils.save_user_default_org('user-1', 'org1', PLATFORM_NS, ctx)
+
+
+def run(label, ctx, k8s, n):
+    k8s.reset_counters()
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            one_request(ctx, f'run{i % 10}')
+        latencies.append(time.perf_counter() - start)
+    print(f'{label:>14}: {k8s.connections / n:6.2f} connections/request, '
+          f'{sum(k8s.requests.values()) / n:5.1f} api calls/request, '
+          f'p50 {statistics.median(latencies) * 1000:7.2f} ms, '
+          f'mean {statistics.mean(latencies) * 1000:7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='injected API server latency (s)')
+    args = parser.parse_args()
+
+    with FakeKubernetes(latency=args.latency) as k8s, \
+            FakeDomino({API_KEY: {'id': 'user-1', 'orgs': ['org1']}}) as domino:
+        os.environ['DOMINO_USER_HOST'] = domino.url
+        for i in range(10):
+            k8s.add_run_pod(COMPUTE_NS, f'run{i}', 'user-1')
+        k8s.add_config_map(PLATFORM_NS, utils.CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING, {'org1': GSA})
+        k8s.add_config_map(PLATFORM_NS, utils.CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING)
+
+        configuration = client.Configuration()
+        configuration.host = k8s.url
+        run('fresh client', FreshClientContext(configuration), k8s, args.requests)
+        run('shared context', k8s_context.KubernetesContext(configuration), k8s, args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Closed-loop HTTP load test for the service: throughput, latency percentiles and upstream calls per request.
+
+Drive a running service:
+
+    python benchmarks/load_test.py --url http://127.0.0.1:6000 --path /get_my_orgs --api-key $KEY
+
+or spawn the service against local fakes of nucleus-frontend, the Kubernetes API and GCP IAM (latency
+injected into each) once per server configuration and scenario, to compare configurations and changes:
+
+    python benchmarks/load_test.py --spawn dev prod:1x1 prod:2x1 prod:4x1 prod:4x8
+    python benchmarks/load_test.py --spawn prod:4x8 --scenario get_my_orgs assume reassume reset --pods 2000
+
+Scenarios, each against a random run pod of the load test user:
+    get_my_orgs    GET /get_my_orgs
+    assume         POST /assume_service_account, alternating between two orgs (always a GSA move)
+    reassume       POST /assume_service_account for the org the run already has
+    reset          DELETE /reset_service_account
+    assume_batch   POST /assume_service_accounts with --batch-size runs
+
+When spawning, the time to import the service module and, per configuration, the time until /healthz and
+/readyz first answer are reported too.
+"""
+import argparse
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE = os.path.join(HERE, 'serve_with_fakes.py')
+SERVICE_DIR = os.path.join(HERE, '..', 'gcp-workload-identity')
+PLATFORM_NS = 'domino-platform'
+COMPUTE_NS = 'domino-compute'
+API_KEY = 'load-test-key'
+USER_ID = 'load-test-user'
+PROJECT_ID = 'load-test-project'
+ORGS = {'org1': 'sa1@project.iam.gserviceaccount.com', 'org2': 'sa2@project.iam.gserviceaccount.com'}
+
+
+def scenarios(run_ids, batch_size):
+    """name -> (method, path, payload function)."""
+    def run():
+        return random.choice(run_ids)
+    return {
+        'get_my_orgs': ('GET', '/get_my_orgs', lambda: None),
+        'assume': ('POST', '/assume_service_account',
+                   lambda: {'run_id': run(), 'domino_org': random.choice(list(ORGS))}),
+        'reassume': ('POST', '/assume_service_account', lambda: {'run_id': run(), 'domino_org': 'org1'}),
+        'reset': ('DELETE', '/reset_service_account', lambda: {'run_id': run()}),
+        'assume_batch': ('POST', '/assume_service_accounts',
+                         lambda: {'runs': [{'run_id': r, 'domino_org': random.choice(list(ORGS))}
+                                           for r in random.sample(run_ids, min(batch_size, len(run_ids)))]}),
+    }
+
+
+def drive(url, method, path, api_key, payload, concurrency, duration):
+    """Runs ``concurrency`` clients for ``duration`` seconds; ``payload()`` gives each request's JSON body."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            body = payload()
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, url + path, headers={'X-Domino-Api-Key': api_key},
+                                       json=body, timeout=30)
+                ok = resp.status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors
+
+
+def report(label, latencies, errors, duration, upstreams=None):
+    if not latencies:
+        print(f'{label:>24}: no successful requests, {len(errors)} errors')
+        return
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+    print(f'{label:>24}: {len(latencies) / duration:8.1f} req/s, p50 {q[49] * 1000:7.1f} ms, '
+          f'p95 {q[94] * 1000:7.1f} ms, p99 {q[98] * 1000:7.1f} ms, {len(errors)} errors')
+    if upstreams:
+        requests_made = len(latencies) + len(errors)
+        for name, fake in upstreams.items():
+            calls = {route: n for route, n in sorted(fake.requests.items()) if not route.startswith('watch_')}
+            per_request = ', '.join(f'{route} {n / requests_made:.2f}' for route, n in calls.items())
+            print(f'{"":>24}  {name:>10}: {sum(calls.values()) / requests_made:6.2f} calls/request'
+                  + (f' ({per_request})' if per_request else ''))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _kubeconfig(server_url):
+    f = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False)
+    f.write(f'''apiVersion: v1
+kind: Config
+clusters:
+- name: fake
+  cluster:
+    server: {server_url}
+contexts:
+- name: fake
+  context:
+    cluster: fake
+    user: fake
+current-context: fake
+users:
+- name: fake
+  user:
+    token: fake
+''')
+    f.close()
+    return f.name
+
+
+def import_seconds(env):
+    """Time a fresh interpreter takes to import the service module, best of three."""
+    code = 'import time; t = time.perf_counter(); import workload_identity_service; print(time.perf_counter() - t)'
+    return min(float(subprocess.run([sys.executable, '-c', code], env=env, cwd=SERVICE_DIR, check=True,
+                                    capture_output=True, text=True).stdout) for _ in range(3))
+
+
+def _wait_for(url, deadline):
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def spawn(mode, env, port):
+    """Starts the service; returns the process and the seconds until /healthz and then /readyz answered 200."""
+    env = dict(env, PORT=str(port))
+    if mode != 'dev':
+        workers, threads = mode.split(':', 1)[1].split('x')
+        env.update(SERVER_MODE='production', WEB_CONCURRENCY=workers, WEB_THREADS=threads)
+    started = time.monotonic()
+    proc = subprocess.Popen([sys.executable, SERVICE], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = started + 30
+    if not _wait_for(f'http://127.0.0.1:{port}/healthz', deadline):
+        proc.kill()
+        raise RuntimeError(f'service did not start in mode {mode}')
+    live = time.monotonic() - started
+    if not _wait_for(f'http://127.0.0.1:{port}/readyz', deadline):
+        proc.kill()
+        raise RuntimeError(f'service did not become ready in mode {mode}')
+    return proc, live, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url')
+    parser.add_argument('--spawn', nargs='+', metavar='MODE',
+                        help='dev, or prod:WORKERSxTHREADS (e.g. prod:4x8)')
+    parser.add_argument('--scenario', nargs='+', default=['get_my_orgs'],
+                        choices=['get_my_orgs', 'assume', 'reassume', 'reset', 'assume_batch'])
+    parser.add_argument('--method', default='GET')
+    parser.add_argument('--path', default='/get_my_orgs')
+    parser.add_argument('--api-key', default=API_KEY)
+    parser.add_argument('--run-id')
+    parser.add_argument('--org')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--pods', type=int, default=500, help='run pods in the fake compute namespace')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--upstream-latency', type=float, default=0.05,
+                        help='injected nucleus-frontend latency (s) when spawning')
+    parser.add_argument('--k8s-latency', type=float, default=0.005,
+                        help='injected Kubernetes API latency (s) when spawning')
+    parser.add_argument('--iam-latency', type=float, default=0.1,
+                        help='injected IAM API latency (s) when spawning')
+    parser.add_argument('--domino-cache-ttl', type=float, default=0,
+                        help='PRINCIPAL_CACHE_TTL_SECONDS/ORGS_CACHE_TTL_SECONDS for the spawned service')
+    args = parser.parse_args()
+
+    if args.url:
+        payload = None
+        if args.run_id:
+            payload = {'run_id': args.run_id, 'domino_org': args.org or ''}
+        latencies, errors = drive(args.url, args.method, args.path, args.api_key, lambda: payload,
+                                  args.concurrency, args.duration)
+        report(args.url, latencies, errors, args.duration)
+        return
+
+    sys.path.insert(0, HERE)
+    from fakes import FakeDomino, FakeIam, FakeKubernetes
+
+    with FakeKubernetes(latency=args.k8s_latency) as k8s, \
+            FakeDomino({args.api_key: {'id': USER_ID, 'orgs': list(ORGS)}},
+                       latency=args.upstream_latency) as domino, \
+            FakeIam(latency=args.iam_latency) as iam:
+        k8s.add_config_map(PLATFORM_NS, 'domino-org-gcp-svc-account-mapping', ORGS)
+        k8s.add_config_map(PLATFORM_NS, 'domino-user-current-org-mapping', {})
+        run_ids = []
+        for i in range(args.pods):
+            # Every other pod belongs to someone else, so lookups have to filter by user
+            user_id = USER_ID if i % 2 == 0 else f'other-user-{i}'
+            k8s.add_run_pod(COMPUTE_NS, f'run{i:06d}', user_id)
+            if user_id == USER_ID:
+                run_ids.append(f'run{i:06d}')
+        env = dict(os.environ, KUBECONFIG=_kubeconfig(k8s.url), DOMINO_USER_HOST=domino.url,
+                   GCP_IAM_ENDPOINT=iam.url, GCP_PROJECT_ID=PROJECT_ID,
+                   DEFAULT_PLATFORM_NS=PLATFORM_NS, DEFAULT_COMPUTE_NS=COMPUTE_NS,
+                   SSL_OFF='true', LOG_LEVEL='ERROR',
+                   PRINCIPAL_CACHE_TTL_SECONDS=str(args.domino_cache_ttl),
+                   ORGS_CACHE_TTL_SECONDS=str(args.domino_cache_ttl))
+        env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+        upstreams = {'domino': domino, 'kubernetes': k8s, 'iam': iam}
+        all_scenarios = scenarios(run_ids, args.batch_size)
+        print(f'{"import":>24}: {import_seconds(env) * 1000:8.1f} ms')
+        for mode in args.spawn or ['dev', 'prod:1x1', 'prod:2x1', 'prod:4x1', 'prod:4x8']:
+            port = _free_port()
+            proc, live, ready = spawn(mode, env, port)
+            print(f'{mode + " startup":>24}: live {live * 1000:8.1f} ms, ready {ready * 1000:8.1f} ms')
+            try:
+                for name in args.scenario:
+                    method, path, payload = all_scenarios[name]
+                    if name == 'reassume':
+                        # Give every run the org first, so the measured requests find it already applied
+                        for i in range(0, len(run_ids), 500):
+                            requests.post(f'http://127.0.0.1:{port}/assume_service_accounts',
+                                          headers={'X-Domino-Api-Key': args.api_key},
+                                          json={'runs': [{'run_id': r, 'domino_org': 'org1'}
+                                                         for r in run_ids[i:i + 500]]})
+                        time.sleep(1)
+                    for fake in upstreams.values():
+                        fake.reset_counters()
+                    latencies, errors = drive(f'http://127.0.0.1:{port}', method, path,
+                                              args.api_key, payload, args.concurrency, args.duration)
+                    report(f'{mode} {name}', latencies, errors, args.duration, upstreams)
+            finally:
+                proc.terminate()
+                proc.wait(30)
+
+
+if __name__ == '__main__':
+    main()
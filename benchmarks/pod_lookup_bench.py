@@ -0,0 +1,70 @@
+"""Run pod lookup cost: full namespace list and label scan vs the watch-backed RunPodIndex.
+
+    python benchmarks/pod_lookup_bench.py --pods 2000 --lookups 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gcp-workload-identity'))
+
+from kubernetes import client  # noqa: E402
+
+from fakes import FakeKubernetes  # noqa: E402
+import k8s_context  # noqa: E402
+import pod_index  # noqa: E402
+
+COMPUTE_NS = 'domino-compute'
+
+
+def scan_lookup(core_v1, run_id):
+    # What utils.get_pod_service_account did before the index
+    for p in core_v1.list_namespaced_pod(COMPUTE_NS).items:
+        metadata = p.metadata.to_dict()
+        if metadata['labels'] and metadata['labels'].get(pod_index.EXECUTION_ID_LABEL) == run_id:
+            return [(metadata['labels'][pod_index.STARTING_USER_ID_LABEL], p.spec.service_account)]
+    return []
+
+
+def run(label, lookup, k8s, n, pods):
+    k8s.reset_counters()
+    latencies = []
+    for i in range(n):
+        run_id = f'run{(i * 7919) % pods}'
+        start = time.perf_counter()
+        assert lookup(run_id), run_id
+        latencies.append(time.perf_counter() - start)
+    lists = k8s.requests['list_pods']
+    print(f'{label:>10}: {lists / n:5.2f} list calls/lookup, '
+          f'p50 {statistics.median(latencies) * 1000:9.3f} ms, '
+          f'p99 {sorted(latencies)[int(n * 0.99) - 1] * 1000:9.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pods', type=int, default=2000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    with FakeKubernetes() as k8s:
+        for i in range(args.pods):
+            k8s.add_run_pod(COMPUTE_NS, f'run{i}', f'user-{i % 50}')
+        configuration = client.Configuration()
+        configuration.host = k8s.url
+        ctx = k8s_context.KubernetesContext(configuration)
+
+        run('scan', lambda run_id: scan_lookup(ctx.core_v1, run_id), k8s, args.lookups, args.pods)
+
+        index = pod_index.RunPodIndex(COMPUTE_NS, ctx)
+        run('selector', index.lookup, k8s, args.lookups, args.pods)
+        start = time.perf_counter()
+        index.start().informer.wait_for_sync()
+        print(f'informer sync of {args.pods} pods took {(time.perf_counter() - start) * 1000:.0f} ms')
+        run('index', index.lookup, k8s, args.lookups, args.pods)
+        index.informer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Runs several replicas of the service against shared fakes and checks that no IAM or annotation update is lost.
+
+    python benchmarks/replica_bench.py --replicas 3 --duration 20 --kill-one
+
+Each replica is a separate Gunicorn server with its own POD_NAME and internal update port, joined through
+Leases in the fake Kubernetes API. Client threads own disjoint sets of run pods and move them between two
+orgs through random replicas; with --kill-one the first replica is killed halfway through and its GSAs
+move to the others. At the end every run's GSA annotation and the members of both GSAs must match
+the last org each run was successfully moved to. The same load is run with sharding off for comparison,
+reporting setIamPolicy calls and etag conflicts per request.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from load_test import (API_KEY, COMPUTE_NS, ORGS, PLATFORM_NS, PROJECT_ID, USER_ID, _free_port, _kubeconfig,
+                       report, spawn)
+
+ANNOTATION = 'iam.gke.io/gcp-service-account'
+
+
+def _live_replicas(port):
+    for line in requests.get(f'http://127.0.0.1:{port}/metrics', timeout=1).text.splitlines():
+        if line.startswith('gcpwi_replicas_live '):
+            return float(line.split()[1])
+    return None
+
+
+def _wait_for_replicas(ports, count, deadline):
+    while time.monotonic() < deadline:
+        try:
+            if all(_live_replicas(port) == count for port in ports):
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+def drive(ports, run_ids, clients, duration, kill=None):
+    """Moves runs between orgs; returns latencies, errors and {run_id: last org successfully assumed}."""
+    latencies, errors, last_org = [], [], {}
+    lock = threading.Lock()
+    live_ports = list(ports)
+    stop_at = time.monotonic() + duration
+
+    def client(runs):
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            run_id, org = random.choice(runs), random.choice(list(ORGS))
+            port = random.choice(live_ports)
+            start = time.perf_counter()
+            try:
+                resp = session.post(f'http://127.0.0.1:{port}/assume_service_account',
+                                    headers={'X-Domino-Api-Key': API_KEY},
+                                    json={'run_id': run_id, 'domino_org': org}, timeout=60)
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                (latencies if ok else errors).append(time.perf_counter() - start)
+                if ok:
+                    last_org[run_id] = org
+                else:
+                    # Whether a failed move took effect is unknown until the run is moved again
+                    last_org.pop(run_id, None)
+
+    threads = [threading.Thread(target=client, args=(run_ids[i::clients],)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    if kill:
+        time.sleep(duration / 2)
+        proc, port = kill
+        live_ports.remove(port)
+        proc.kill()
+        print(f'{"":>24}  killed the replica on port {port}')
+    for t in threads:
+        t.join()
+    return latencies, errors, last_org
+
+
+def verify(k8s, iam, last_org):
+    """Runs whose annotation or IAM members do not match their last assumed org."""
+    members = {gsa: set(iam.members(gsa)) for gsa in ORGS.values()}
+    lost = []
+    for run_id, org in last_org.items():
+        service_account = f'run-{run_id}'
+        member = f'serviceAccount:{PROJECT_ID}.svc.id.goog[{COMPUTE_NS}/{service_account}]'
+        annotation = k8s.service_accounts[(COMPUTE_NS, service_account)]['metadata']['annotations'].get(ANNOTATION)
+        bound = {gsa for gsa, m in members.items() if member in m}
+        if annotation != ORGS[org] or bound != {ORGS[org]}:
+            lost.append((run_id, org, annotation, sorted(bound)))
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--mode', default='prod:2x8', help='server mode of each replica, as in load_test.py')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--pods', type=int, default=200)
+    parser.add_argument('--kill-one', action='store_true', help='kill one replica halfway through')
+    parser.add_argument('--lease-seconds', type=int, default=3)
+    parser.add_argument('--iam-latency', type=float, default=0.1)
+    parser.add_argument('--k8s-latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    from fakes import FakeDomino, FakeIam, FakeKubernetes
+
+    failed = False
+    for sharding in (False, True):
+        with FakeKubernetes(latency=args.k8s_latency) as k8s, \
+                FakeDomino({API_KEY: {'id': USER_ID, 'orgs': list(ORGS)}}) as domino, \
+                FakeIam(latency=args.iam_latency) as iam:
+            k8s.add_config_map(PLATFORM_NS, 'domino-org-gcp-svc-account-mapping', ORGS)
+            k8s.add_config_map(PLATFORM_NS, 'domino-user-current-org-mapping', {})
+            run_ids = [f'run{i:06d}' for i in range(args.pods)]
+            for run_id in run_ids:
+                k8s.add_run_pod(COMPUTE_NS, run_id, USER_ID)
+            env = dict(os.environ, KUBECONFIG=_kubeconfig(k8s.url), DOMINO_USER_HOST=domino.url,
+                       GCP_IAM_ENDPOINT=iam.url, GCP_PROJECT_ID=PROJECT_ID,
+                       DEFAULT_PLATFORM_NS=PLATFORM_NS, DEFAULT_COMPUTE_NS=COMPUTE_NS,
+                       SSL_OFF='true', LOG_LEVEL='ERROR', POD_IP='127.0.0.1',
+                       SHARDING_ENABLED=str(sharding).lower(), REPLICA_LEASE_SECONDS=str(args.lease_seconds))
+            env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+            replicas = []
+            try:
+                for i in range(args.replicas):
+                    port = _free_port()
+                    proc, _, _ = spawn(args.mode, dict(env, POD_NAME=f'replica-{i}', REPLICA_PORT=str(_free_port()),
+                                                       JOBS_DIR=f'/tmp/gcpwi-bench-jobs-{i}'), port)
+                    replicas.append((proc, port))
+                ports = [port for _, port in replicas]
+                if sharding and not _wait_for_replicas(ports, args.replicas, time.monotonic() + 30):
+                    raise RuntimeError('replicas did not see each other')
+                label = f'sharding {"on" if sharding else "off"}'
+                latencies, errors, last_org = drive(ports, run_ids, args.clients, args.duration,
+                                                    replicas[0] if args.kill_one else None)
+                report(label, latencies, errors, args.duration)
+                # Let writes of requests that timed out on the client side settle
+                time.sleep(2)
+                requests_made = len(latencies) + len(errors)
+                print(f'{"":>24}  setIamPolicy {iam.requests["set_iam_policy"] / requests_made:.2f}/request, '
+                      f'{iam.conflicts} etag conflicts')
+                lost = verify(k8s, iam, last_org)
+                print(f'{"":>24}  {len(last_org)} runs checked, {len(lost)} lost updates')
+                for run_id, org, annotation, bound in lost[:10]:
+                    print(f'{"":>24}    {run_id}: assumed {org}, annotation {annotation}, members of {bound}')
+                # Without sharding, a write still queued in one process for a request that failed can land after
+                # another process moved the same run again; sharding keeps every write for a GSA in one queue
+                failed = failed or (sharding and bool(lost))
+            finally:
+                for proc, _ in replicas:
+                    proc.terminate()
+                for proc, _ in replicas:
+                    proc.wait(30)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""Runs workload_identity_service.py with anonymous GCP credentials, for use against FakeIam.
+
+Started by load_test.py --spawn with GCP_IAM_ENDPOINT pointing at the fake;
+everything else is configured through the environment as usual.
+"""
+import os
+import runpy
+import sys
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gcp-workload-identity')
+sys.path.insert(0, SERVICE_DIR)
+
+from google.auth.credentials import AnonymousCredentials  # noqa: E402
+
+import gcp_utils  # noqa: E402
+
+gcp_utils.IamClient._load_credentials = lambda self: AnonymousCredentials()
+
+if __name__ == '__main__':
+    runpy.run_path(os.path.join(SERVICE_DIR, 'workload_identity_service.py'), run_name='__main__')
@@ -0,0 +1,74 @@
+"""Saving user default orgs: whole-ConfigMap patches vs batched merge patches, optionally sharded.
+
+A burst of concurrent saves is written to a mapping that already holds --users
+entries; the report shows API calls, bytes sent to the API server and wall time.
+
+    python benchmarks/user_org_mapping_bench.py --users 10000 100000 --saves 200
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gcp-workload-identity'))
+
+from kubernetes import client  # noqa: E402
+
+from fakes import FakeKubernetes  # noqa: E402
+import k8s_context  # noqa: E402
+import user_org_mapping  # noqa: E402
+
+PLATFORM_NS = 'domino-platform'
+NAME = user_org_mapping.CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING
+
+
+def whole_object_save(core_v1, user_id, org):
+    # What save_user_default_org did before: read everything, patch everything back
+    config_map = core_v1.read_namespaced_config_map(NAME, PLATFORM_NS)
+    config_map.data[user_id] = org
+    core_v1.patch_namespaced_config_map(NAME, PLATFORM_NS, config_map.to_dict())
+
+
+def run(label, k8s, saves, save, finish=lambda: None):
+    k8s.reset_counters()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        list(pool.map(save, [f'new-user-{i}' for i in range(saves)]))
+    finish()
+    elapsed = time.perf_counter() - start
+    calls = sum(n for route, n in k8s.requests.items() if not route.startswith('watch_'))
+    print(f'  {label:>18}: {calls:4d} API calls, {k8s.bytes_received / 1e6:9.2f} MB sent, {elapsed:6.2f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[10000])
+    parser.add_argument('--saves', type=int, default=200)
+    parser.add_argument('--shards', type=int, default=8)
+    args = parser.parse_args()
+    os.environ['CONFIGMAP_CACHE_ENABLED'] = 'false'
+
+    for users in args.users:
+        print(f'{users} existing users, {args.saves} concurrent saves')
+        with FakeKubernetes() as k8s:
+            configuration = client.Configuration()
+            configuration.host = k8s.url
+            configuration.connection_pool_maxsize = 64
+            ctx = k8s_context.KubernetesContext(configuration)
+            existing = {f'user-{i}': f'org{i % 20}' for i in range(users)}
+
+            k8s.add_config_map(PLATFORM_NS, NAME, existing)
+            run('whole object', k8s, args.saves, lambda u: whole_object_save(ctx.core_v1, u, 'org1'))
+
+            k8s.add_config_map(PLATFORM_NS, NAME, existing)
+            store = user_org_mapping.UserOrgMappingStore(PLATFORM_NS, ctx, shards=1, flush_interval=0.05)
+            run('merge patch', k8s, args.saves, lambda u: store.set(u, 'org1'), store.flush)
+
+            k8s.add_config_map(PLATFORM_NS, NAME, existing)
+            store = user_org_mapping.UserOrgMappingStore(PLATFORM_NS, ctx, shards=args.shards, flush_interval=0.05)
+            run(f'merge patch/{args.shards} shards', k8s, args.saves, lambda u: store.set(u, 'org1'), store.flush)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import metrics
+from informer import Informer
+from k8s_context import KubernetesContext, get_k8s_context
+
+if TYPE_CHECKING:
+    from kubernetes.client import V1ConfigMap
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+# Watches are re-established at least this often, bounding how long a silent watch goes unconfirmed
+CONFIG_MAP_WATCH_TIMEOUT_SECONDS = 60
+
+
+def _newer_or_equal(resource_version, target):
+    try:
+        return int(resource_version) >= int(target)
+    except (TypeError, ValueError):
+        return resource_version == target
+
+
+class ConfigMapCache:
+    """Named ConfigMaps in one namespace, served from memory by one watch per ConfigMap.
+
+    A read falls back to the API server while the watch has not synced or when
+    its last confirmation is older than ``max_staleness`` seconds. Writers do not
+    update the cache themselves; they call ``wait_for`` with the resourceVersion
+    their patch returned, and the watch delivers the change.
+    """
+
+    def __init__(self, namespace, k8s_ctx: KubernetesContext = None, max_staleness: float = None):
+        if k8s_ctx is None:
+            k8s_ctx = get_k8s_context()
+        if max_staleness is None:
+            max_staleness = float(os.environ.get('CONFIGMAP_CACHE_MAX_STALENESS_SECONDS', 120))
+        self.namespace = namespace
+        self.max_staleness = max_staleness
+        self._core_v1 = k8s_ctx.core_v1
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._informers = {}
+        self._hits = metrics.CACHE_LOOKUPS.labels('configmap', 'hit')
+        self._misses = metrics.CACHE_LOOKUPS.labels('configmap', 'miss')
+
+    def _informer(self, name) -> Informer:
+        informer = self._informers.get(name)
+        if informer is None:
+            with self._lock:
+                informer = self._informers.get(name)
+                if informer is None:
+                    informer = Informer(self._core_v1.list_namespaced_config_map, self.namespace,
+                                        name=f'configmap-{self.namespace}-{name}',
+                                        watch_timeout_seconds=CONFIG_MAP_WATCH_TIMEOUT_SECONDS,
+                                        field_selector=f'metadata.name={name}')
+                    informer.add_event_handler(self._on_event)
+                    self._informers[name] = informer.start()
+        return informer
+
+    def _on_event(self, event_type, obj):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _fresh(self, informer: Informer) -> bool:
+        if not informer.has_synced():
+            return False
+        age = informer.sync_age()
+        return age is not None and age <= self.max_staleness
+
+    def get(self, name) -> V1ConfigMap:
+        """The ConfigMap, or None if it does not exist."""
+        informer = self._informer(name)
+        if self._fresh(informer):
+            self._hits.inc()
+            return informer.get(name)
+        self._misses.inc()
+        return self._core_v1.read_namespaced_config_map(name, self.namespace)
+
+    def warm(self, names, timeout: float = None) -> bool:
+        """Starts the watches of ``names`` and waits until each has synced."""
+        informers = [self._informer(name) for name in names]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return all(informer.wait_for_sync(None if deadline is None else max(deadline - time.monotonic(), 0))
+                   for informer in informers)
+
+    def wait_for(self, name, resource_version, timeout: float = 5.0) -> bool:
+        """Blocks until the cached ConfigMap is at ``resource_version`` or newer."""
+        informer = self._informer(name)
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                cached = informer.get(name)
+                if cached is not None and _newer_or_equal(cached.metadata.resource_version, resource_version):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f'ConfigMap cache for {name} did not observe resourceVersion '
+                                   f'{resource_version} within {timeout}s')
+                    return False
+                self._changed.wait(remaining)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def config_map_cache_enabled() -> bool:
+    return os.environ.get('CONFIGMAP_CACHE_ENABLED', 'true') == 'true'
+
+
+def get_config_map_cache(namespace, k8s_ctx: KubernetesContext = None) -> ConfigMapCache:
+    cache = _caches.get(namespace)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(namespace)
+            if cache is None:
+                cache = _caches[namespace] = ConfigMapCache(namespace, k8s_ctx)
+    return cache
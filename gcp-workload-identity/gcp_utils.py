@@ -1,23 +1,156 @@
 from pprint import pprint
 
-from googleapiclient import discovery
-from oauth2client.service_account import ServiceAccountCredentials
+from googleapiclient.errors import HttpError
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
+import logging
 import os
-import google.auth.transport.requests
-import google.auth
+import random
+import threading
+import socket
+import time
+import google.auth.exceptions
+import metrics
+import scheduler
+from ttl_cache import TTLCache
 
-def get_service():
-    if os.environ.get("GCP_KEYS_PATH"):
-        key_file_path = os.environ.get("GCP_KEYS_PATH")
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-                key_file_path)
-    else:
-        auth_req = google.auth.transport.requests.Request()
+logger = logging.getLogger("gcpworkloadidentity")
+
+# Refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+
+class IamClient:
+    """Long-lived IAM v1 client shared by all request threads.
+
+    The service object is built once from the discovery document bundled with
+    google-api-python-client, so no discovery fetch happens at runtime.
+    Credentials are refreshed under a lock only when close to expiry. Each
+    thread executes requests on its own authorized Http, as httplib2 is not
+    thread safe. On an authentication failure the credentials and service are
+    rebuilt and the request is retried once. Every request goes through the
+    ``iam`` upstream of the scheduler, which caps concurrency, rate limits
+    writes and retries 429s and 5xx responses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._credentials = None
+        self._service = None
+        self._generation = 0
+
+    def _load_credentials(self):
+        # The Google client libraries are imported on first use, keeping them off the service's import path
+        if os.environ.get("GCP_KEYS_PATH"):
+            from oauth2client.service_account import ServiceAccountCredentials
+            key_file_path = os.environ.get("GCP_KEYS_PATH")
+            return ServiceAccountCredentials.from_json_keyfile_name(
+                    key_file_path)
+        import google.auth
         credentials, project = google.auth.default()
-        credentials.refresh(auth_req)
-    service = discovery.build('iam', 'v1', credentials=credentials)
+        return credentials
+
+    def _build(self):
+        with self._lock:
+            if self._service is None:
+                from googleapiclient import discovery
+                self._credentials = self._load_credentials()
+                client_options = None
+                if os.environ.get('GCP_IAM_ENDPOINT'):
+                    client_options = {'api_endpoint': os.environ['GCP_IAM_ENDPOINT']}
+                self._service = discovery.build('iam', 'v1', credentials=self._credentials,
+                                                static_discovery=True, cache_discovery=False,
+                                                client_options=client_options)
+                self._generation += 1
+            return self._service, self._credentials, self._generation
+
+    def _ensure_fresh(self, credentials):
+        if _is_oauth2client(credentials):
+            if credentials.access_token_expired:
+                with self._lock, metrics.observe('iam', 'refresh_credentials'):
+                    # get_access_token refreshes when the token is missing or expired
+                    credentials.get_access_token()
+            return
+        if self._needs_refresh(credentials):
+            with self._lock:
+                if self._needs_refresh(credentials):
+                    import google.auth.transport.requests
+                    with metrics.observe('iam', 'refresh_credentials'):
+                        credentials.refresh(google.auth.transport.requests.Request())
+
+    @staticmethod
+    def _needs_refresh(credentials):
+        if not credentials.token or not credentials.expiry:
+            return not credentials.valid
+        return credentials.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
+    def _http(self, credentials, generation):
+        if getattr(self._local, 'generation', None) != generation:
+            import httplib2
+            if _is_oauth2client(credentials):
+                self._local.http = credentials.authorize(httplib2.Http(timeout=scheduler.iam.timeout))
+            else:
+                import google_auth_httplib2
+                self._local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=scheduler.iam.timeout))
+            self._local.generation = generation
+        return self._local.http
+
+    def warm(self):
+        """Builds the service, refreshes the credentials and this thread's Http ahead of the first request."""
+        service, credentials, generation = self._build()
+        self._ensure_fresh(credentials)
+        self._http(credentials, generation)
+
+    def reset(self):
+        with self._lock:
+            self._service = None
+            self._credentials = None
+
+    @property
+    def service(self):
+        return self._build()[0]
+
+    def execute(self, build_request, write=False):
+        """Runs ``build_request(service).execute()`` on this thread's Http."""
+        return scheduler.iam.call(lambda timeout: self._execute(build_request), _iam_retryable, write)
+
+    def _execute(self, build_request):
+        for attempt in range(2):
+            service, credentials, generation = self._build()
+            try:
+                self._ensure_fresh(credentials)
+                return build_request(service).execute(http=self._http(credentials, generation))
+            except HttpError as e:
+                if e.resp.status != 401 or attempt:
+                    raise
+            except google.auth.exceptions.RefreshError:
+                if attempt:
+                    raise
+            logger.warning("IAM authentication failed, rebuilding the IAM client")
+            self.reset()
+
+
+def _is_oauth2client(credentials):
+    return type(credentials).__module__.startswith('oauth2client.')
 
-    return service
+
+def _iam_retryable(error, result):
+    if isinstance(error, HttpError):
+        return scheduler.retryable_status(error.resp.status)
+    return isinstance(error, (socket.timeout, ConnectionError))
+
+
+_iam_client = IamClient()
+
+
+def get_iam_client() -> IamClient:
+    return _iam_client
+
+
+def get_service():
+    return _iam_client.service
 
 def add_iam_policy_binding(gcp_service_account,domino_compute_namespace,domino_service_account):
     return update_iam_policy_binding(gcp_service_account,domino_compute_namespace,domino_service_account)
@@ -27,56 +160,308 @@ def remove_iam_policy_binding(domino_service_account,gcp_service_account,domino_
 
 
 def update_iam_policy_binding(gcp_service_account,domino_compute_namespace,domino_service_account,add=True):
-    service = get_service()
+    return submit_iam_policy_update(gcp_service_account,domino_compute_namespace,domino_service_account,add).result()
+
+
+def iam_policy_members(gcp_service_account, refresh=False) -> set:
+    """All workload identity members of the GSA, including updates still queued."""
+    return _policy_updater.members(gcp_service_account, refresh)
+
+
+def workload_identity_member(domino_compute_namespace,domino_service_account):
+    project_id = os.environ.get('GCP_PROJECT_ID')
+    return f"serviceAccount:{project_id}.svc.id.goog[{domino_compute_namespace}/{domino_service_account}]"
+
+
+def parse_member(member):
+    """(namespace, Kubernetes service account) of a workload identity member of this project, else None."""
+    project_id = os.environ.get('GCP_PROJECT_ID')
+    prefix = f"serviceAccount:{project_id}.svc.id.goog["
+    if not member.startswith(prefix) or not member.endswith(']') or '/' not in member:
+        return None
+    namespace, service_account = member[len(prefix):-1].split('/', 1)
+    return namespace, service_account
+
+
+def submit_iam_policy_update(gcp_service_account,domino_compute_namespace,domino_service_account,add=True) -> Future:
+    """Queues a member add/remove on the GSA's policy; the future resolves to the setIamPolicy response, or to the policy read if it already held."""
+    return _policy_updater.submit(gcp_service_account, workload_identity_member(domino_compute_namespace,domino_service_account), add)
+
+
+def ensure_iam_policy_members(gcp_service_account,domino_compute_namespace,changes,cached=False) -> list:
+    """Makes each of ``changes`` [(domino_service_account, bound)] hold on the GSA; one future per change.
+
+    The changes are queued together and checked against the policy read by
+    the batched update, which skips setIamPolicy when they all hold already.
+    Only the single writer of the GSA's policy (its sharding owner) may pass
+    ``cached`` to resolve changes that hold in the members it remembers
+    without queueing them, as any other process can miss writes made elsewhere.
+    For GSAs in IAM_NAMESPACE_PRINCIPAL_GSAS the namespace principal is bound
+    instead of each service account, and removals do nothing.
+    """
+    current = _policy_updater.members(gcp_service_account) if cached else None
+    if _namespace_scoped(gcp_service_account):
+        # The namespace principal stays bound for the other runs; per-run removals are left to the annotation
+        principal = namespace_principal(domino_compute_namespace)
+        members = [principal] * len(changes)
+        needed = [i for i, (_, bound) in enumerate(changes) if bound and (current is None or principal not in current)]
+    else:
+        members = [workload_identity_member(domino_compute_namespace,sa) for sa, _ in changes]
+        needed = [i for i, (member, (_, bound)) in enumerate(zip(members, changes))
+                  if current is None or (member in current) != bound]
+    futures = [None] * len(changes)
+    submitted = _policy_updater.submit_all(gcp_service_account,
+                                           [(members[i], changes[i][1]) for i in needed]) if needed else []
+    for i, f in zip(needed, submitted):
+        futures[i] = f
+    for i, f in enumerate(futures):
+        if f is None:
+            futures[i] = f = Future()
+            f.set_result(None)
+    return futures
+
+
+def invalidate_iam_policy_cache():
+    """Forgets every cached policy, for when another process may have written them."""
+    _policy_updater.invalidate()
+
+
+WORKLOAD_IDENTITY_ROLE = 'roles/iam.workloadIdentityUser'
+
+
+def _workload_identity_binding():
     project_id =  os.environ.get('GCP_PROJECT_ID')
     project_location = os.environ.get('GCP_PROJECT_LOCATION',"")
     gke_id = os.environ.get('GCP_GKE_ID', "")
     providerId= f"https://container.googleapis.com/v1/projects/{project_id}/locations/{project_location}/clusters/{gke_id}"
-    # REQUIRED: The resource for which the policy is being specified.
-    # See the operation documentation for the appropriate value for this field.
-    resource = f'projects/{project_id}/serviceAccounts/{gcp_service_account}'  # TODO: Update placeholder value.
-    set_iam_policy_request_body = {"policy":
-                                       {"bindings": [
-                                           ],
-                                        "version": 3
-                                       }
-
-                                 }
-    member = {"members":
+    return {"members":
          [],
-     "role": "roles/iam.workloadIdentityUser",
+     "role": WORKLOAD_IDENTITY_ROLE,
      "condition": {
          "title": f"single-cluster-acl-domino_service_account",
          "description": "single-cluster-acl",
          "expression": f"request.auth.claims.google.providerId=='{providerId}'",
         }
      }
-    s = f"serviceAccount:{project_id}.svc.id.goog[{domino_compute_namespace}/{domino_service_account}]"
-    #set_iam_policy_request_body["policy"]["bindings"][0]["members"] = [s]
-    response = service.projects().serviceAccounts().getIamPolicy(resource=resource).execute()
-    if 'bindings' in response:
-        bindings = response['bindings']
-    else:
-        bindings = [member]
-    members = []
-    for r in bindings:
-        if r['role'].startswith('roles/iam.workloadIdentityUser'):
-            members = r['members']
-            break
-
-    if add:
-        members.append(s)
-    else:
-        members.remove(s)
-    member['members'] = members
-    set_iam_policy_request_body['policy']['bindings'].append(member)
-    #This might be a good time to do cleanup for workspaces that have terminated
-    #But this needs a domino token for admin or access to mongo which elevates the pod access control profile
-    request = service.projects().serviceAccounts().setIamPolicy(resource=resource, body=set_iam_policy_request_body)
-    response = request.execute()
-    return response
 
 
+def _is_managed_binding(binding, condition) -> bool:
+    # Only the workloadIdentityUser binding restricted to this cluster is ours; other roles and conditions are kept
+    return binding.get('role') == WORKLOAD_IDENTITY_ROLE and \
+        (binding.get('condition') or {}).get('expression') == condition['expression']
+
+
+def _workload_identity_members(policy) -> frozenset:
+    condition = _workload_identity_binding()['condition']
+    for r in policy.get('bindings', []):
+        if _is_managed_binding(r, condition):
+            return frozenset(r.get('members', []))
+    return frozenset()
+
+
+def namespace_principal(domino_compute_namespace):
+    """The principal of every Kubernetes service account in the namespace, or None without GCP_PROJECT_NUMBER."""
+    project_number = os.environ.get('GCP_PROJECT_NUMBER')
+    if not project_number:
+        return None
+    project_id = os.environ.get('GCP_PROJECT_ID')
+    return (f"principalSet://iam.googleapis.com/projects/{project_number}/locations/global/"
+            f"workloadIdentityPools/{project_id}.svc.id.goog/namespace/{domino_compute_namespace}")
+
+
+def _namespace_scoped(gcp_service_account) -> bool:
+    configured = os.environ.get('IAM_NAMESPACE_PRINCIPAL_GSAS', '')
+    if not configured or not os.environ.get('GCP_PROJECT_NUMBER'):
+        return False
+    return configured == '*' or gcp_service_account in {gsa.strip() for gsa in configured.split(',')}
+
+
+def _compact(members) -> set:
+    """``members`` without the per-service-account members of namespaces that are bound as a whole."""
+    namespaces = {m.rsplit('/namespace/', 1)[1] for m in members
+                  if m.startswith('principalSet://') and '/namespace/' in m}
+    if not namespaces:
+        return members
+    return {m for m in members if (parse_member(m) or (None,))[0] not in namespaces}
+
+
+def _apply_member_changes(policy, changes):
+    """Builds the setIamPolicy body for ``changes`` [(member, add)] applied in order to ``policy``.
+
+    Members are handled as a set: adding a present member or removing a missing
+    one changes nothing. Bindings other than this cluster's workloadIdentityUser
+    binding, their conditions and the policy's audit configs are sent back as read.
+    """
+    managed = _workload_identity_binding()
+    bindings = []
+    members = set()
+    for r in policy.get('bindings', []):
+        if _is_managed_binding(r, managed['condition']):
+            members.update(r.get('members', []))
+        else:
+            bindings.append(r)
+    for s, add in changes:
+        if add:
+            members.add(s)
+        else:
+            members.discard(s)
+    members = _compact(members)
+    if members:
+        managed['members'] = sorted(members)
+        bindings.append(managed)
+    body = {k: v for k, v in policy.items() if k in ('auditConfigs', 'etag')}
+    # Version 3 is required for conditional bindings
+    body.update(bindings=bindings, version=3)
+    # With the etag, setIamPolicy fails with 409 if the policy changed since it was read
+    return {"policy": body}
+
+
+class PolicyUpdateBatcher:
+    """Coalesces member changes per GCP service account into one etag-guarded read-modify-write.
+
+    Changes submitted for a GSA within ``window`` seconds, or while an update
+    for that GSA is in flight, are applied together by a single
+    getIamPolicy/setIamPolicy pair; the write is skipped when the policy read
+    already holds every change. Only one update per GSA runs at a time;
+    a concurrent writer elsewhere is detected through the etag and the whole
+    batch is re-read and retried with jittered exponential backoff.
+
+    The workload identity members of every policy read or written are kept
+    for ``policy_ttl`` seconds so ``members`` rarely needs a getIamPolicy.
+    Once ``max_pending`` changes are queued, new ones are rejected with
+    Overloaded rather than waiting behind the IAM write quota.
+    """
+
+    def __init__(self, iam: IamClient, window: float, max_workers: int, max_conflict_retries: int,
+                 policy_ttl: float = 0, policy_cache_size: int = 1024, max_pending: int = None):
+        self._iam = iam
+        self._window = window
+        self._max_conflict_retries = max_conflict_retries
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = {}
+        self._max_pending = max_pending
+        self._queued = 0
+        self._members = TTLCache(policy_cache_size, policy_ttl, 'iam_policy')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='iam-update')
+        self.stats = Counter()
+
+    def submit(self, gcp_service_account, member, add) -> Future:
+        return self.submit_all(gcp_service_account, [(member, add)])[0]
+
+    def submit_all(self, gcp_service_account, changes) -> list:
+        """Queues [(member, add)] so that they are all written by the same policy update."""
+        futures = [Future() for _ in changes]
+        with self._lock:
+            if self._max_pending is not None and self._queued + len(changes) > self._max_pending:
+                self.stats['shed'] += len(changes)
+                metrics.UPSTREAM_SHED.labels('iam').inc()
+                # Roughly one write per GSA with queued changes is still ahead of the caller
+                writes = scheduler.iam.writes
+                raise scheduler.Overloaded('iam', max(1, round(len(self._pending) / writes.rate)) if writes else 1)
+            self._queued += len(changes)
+            self.stats['changes'] += len(changes)
+            queue = self._pending.get(gcp_service_account)
+            if queue is None:
+                self._pending[gcp_service_account] = queue = []
+                self._executor.submit(self._drain, gcp_service_account)
+            queue.extend((member, add, future) for (member, add), future in zip(changes, futures))
+        return futures
+
+    def members(self, gcp_service_account, refresh=False) -> set:
+        with self._lock:
+            queued = self._in_flight.get(gcp_service_account, []) + self._pending.get(gcp_service_account, [])
+        current = None if refresh else self._members.get(gcp_service_account)
+        if current is None:
+            current = _workload_identity_members(self._get_policy(gcp_service_account))
+        members = set(current)
+        # The last queued change for a member is what the policy will hold
+        for m, add, _ in queued:
+            if add:
+                members.add(m)
+            else:
+                members.discard(m)
+        return members
+
+    def invalidate(self, gcp_service_account=None):
+        if gcp_service_account is None:
+            self._members.invalidate()
+        else:
+            self._members.invalidate(gcp_service_account)
+
+    def _get_policy(self, gcp_service_account):
+        project_id = os.environ.get('GCP_PROJECT_ID')
+        resource = f'projects/{project_id}/serviceAccounts/{gcp_service_account}'
+        self.stats['get_iam_policy'] += 1
+        with metrics.observe('iam', 'getIamPolicy'):
+            policy = self._iam.execute(lambda service: service.projects().serviceAccounts().getIamPolicy(
+                resource=resource, options_requestedPolicyVersion=3))
+        self._members.put(gcp_service_account, _workload_identity_members(policy))
+        return policy
+
+    def _drain(self, gcp_service_account):
+        time.sleep(self._window)
+        while True:
+            with self._lock:
+                changes = self._pending[gcp_service_account]
+                if not changes:
+                    del self._pending[gcp_service_account]
+                    return
+                self._pending[gcp_service_account] = []
+                self._in_flight[gcp_service_account] = changes
+            try:
+                self._update(gcp_service_account, changes)
+            except Exception as e:
+                self._members.invalidate(gcp_service_account)
+                for _, _, future in changes:
+                    future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[gcp_service_account]
+                    self._queued -= len(changes)
+
+    def _update(self, gcp_service_account, changes):
+        project_id = os.environ.get('GCP_PROJECT_ID')
+        resource = f'projects/{project_id}/serviceAccounts/{gcp_service_account}'
+        for attempt in range(self._max_conflict_retries + 1):
+            policy = self._get_policy(gcp_service_account)
+            body = _apply_member_changes(policy, [(member, add) for member, add, _ in changes])
+            if _workload_identity_members(body['policy']) == _workload_identity_members(policy):
+                # Every change holds already: nothing to write
+                self.stats['unchanged'] += 1
+                response = policy
+                break
+            try:
+                self.stats['set_iam_policy'] += 1
+                with metrics.observe('iam', 'setIamPolicy'):
+                    response = self._iam.execute(lambda service: service.projects().serviceAccounts().setIamPolicy(
+                        resource=resource, body=body), write=True)
+                break
+            except HttpError as e:
+                if e.resp.status != 409 or attempt == self._max_conflict_retries:
+                    raise
+                self.stats['conflicts'] += 1
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        self._members.put(gcp_service_account, _workload_identity_members(response))
+        for _, _, future in changes:
+            future.set_result(response)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_policy_updater = PolicyUpdateBatcher(_iam_client,
+                                      float(os.environ.get('IAM_BATCH_WINDOW_SECONDS', 0.05)),
+                                      int(os.environ.get('IAM_UPDATE_WORKERS', 8)),
+                                      int(os.environ.get('IAM_CONFLICT_RETRIES', 5)),
+                                      float(os.environ.get('IAM_POLICY_CACHE_TTL_SECONDS', 30)),
+                                      max_pending=int(os.environ.get('IAM_MAX_PENDING_CHANGES', 2000)))
+
+
+def shutdown_policy_updates():
+    """Waits for all queued policy updates to be written; no new ones are accepted."""
+    _policy_updater.shutdown(wait=True)
+
 
 if __name__ == "__main__":
     os.environ['GCP_KEYS_PATH'] = '/Users/sameerwadkar/Documents/GitHub2/enable-workload-identities-service/root/etc/keys/key.json'
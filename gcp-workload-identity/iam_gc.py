@@ -0,0 +1,162 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import gcp_utils
+import metrics
+import sharding
+import utils
+from k8s_context import KubernetesContext
+from leader import LeaderLock, lock_path as leader_lock_path
+from pod_index import get_run_pod_index
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+RUN_SERVICE_ACCOUNT_PREFIX = 'run-'
+
+
+class StaleBindingCollector:
+    """Removes workload identity members of terminated runs from the mapped GCP service accounts.
+
+    Each pass reads the policy of every GSA in the org mapping and finds the
+    ``run-*`` members of the compute namespace whose service account no live
+    run pod uses. A member is removed once it has been stale for ``grace``
+    seconds, which covers pods the watch has not delivered yet. All removals
+    for a GSA go out in one policy update, and at most ``max_updates_per_second``
+    GSAs are updated. With ``dry_run`` the members are only logged.
+
+    Live pods come from the pod index while its watch was confirmed current
+    within ``max_pod_index_age`` seconds, and from a fresh list otherwise, so
+    a stalled watch cannot make running pods look ended. Only one Gunicorn
+    worker per pod collects, the holder of a ``LeaderLock``, and with several
+    replicas each collects only the GSAs it owns.
+    """
+
+    def __init__(self, pod_namespace, platform_namespace, k8s_ctx: KubernetesContext = None,
+                 interval: float = 600, grace: float = 300, max_updates_per_second: float = 1,
+                 dry_run: bool = False, max_pod_index_age: float = 60, lock_path: str = None):
+        self.pod_namespace = pod_namespace
+        self.platform_namespace = platform_namespace
+        self.interval = interval
+        self.grace = grace
+        self.max_updates_per_second = max_updates_per_second
+        self.dry_run = dry_run
+        self.max_pod_index_age = max_pod_index_age
+        self._leader = LeaderLock(lock_path or leader_lock_path(f'iam-gc-{pod_namespace}'),
+                                  on_acquire=lambda: metrics.LEADERS.labels('iam_gc').set(1))
+        self._k8s_ctx = k8s_ctx
+        self._stale_since = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='iam-gc', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def leader(self) -> bool:
+        return self._leader.held
+
+    def _loop(self):
+        # Replicas and workers started together should not all collect at once
+        self._stop.wait(random.uniform(0, self.interval))
+        while not self._stop.is_set():
+            try:
+                if self._leader.try_acquire():
+                    self.collect()
+            except Exception:
+                metrics.IAM_GC_PASSES.labels('failed').inc()
+                logger.exception('Collecting stale workload identity members failed')
+            self._stop.wait(self.interval)
+
+    def _stale_members(self, gcp_service_account, live_service_accounts, now):
+        stale = []
+        members = gcp_utils.iam_policy_members(gcp_service_account, refresh=True)
+        for member in sorted(members):
+            parsed = gcp_utils.parse_member(member)
+            if parsed is None:
+                continue
+            namespace, service_account = parsed
+            if (namespace != self.pod_namespace or not service_account.startswith(RUN_SERVICE_ACCOUNT_PREFIX)
+                    or service_account in live_service_accounts):
+                self._stale_since.pop((gcp_service_account, member), None)
+                continue
+            first_seen = self._stale_since.setdefault((gcp_service_account, member), now)
+            if now - first_seen >= self.grace:
+                stale.append(service_account)
+        return stale, len(members)
+
+    def collect(self) -> dict:
+        """Runs one pass; returns {gsa: [service accounts removed, or that would be with dry_run]}."""
+        # With several replicas each collects the GSAs it owns
+        gcp_service_accounts = {gsa for gsa in utils.get_orgs_gcp_service_accounts_mapping(
+            self.platform_namespace, self._k8s_ctx).values() if gsa and sharding.is_local(gsa)}
+        live_service_accounts = get_run_pod_index(self.pod_namespace, self._k8s_ctx).live_service_accounts(
+            self.max_pod_index_age)
+        now = time.monotonic()
+        self._stale_since = {k: v for k, v in self._stale_since.items() if k[0] in gcp_service_accounts}
+
+        pruned = {}
+        last_update = 0
+        largest = 0
+        for gcp_service_account in sorted(gcp_service_accounts):
+            stale, size = self._stale_members(gcp_service_account, live_service_accounts, now)
+            if stale and self.dry_run:
+                logger.info(f'Dry run: would remove {len(stale)} stale members from {gcp_service_account}: {stale}')
+                metrics.IAM_GC_MEMBERS.labels('stale').inc(len(stale))
+            elif stale:
+                wait = last_update + 1 / self.max_updates_per_second - time.monotonic()
+                if wait > 0:
+                    self._stop.wait(wait)
+                last_update = time.monotonic()
+                futures = sharding.ensure_iam_policy_members(gcp_service_account, self.pod_namespace,
+                                                             [(sa, False) for sa in stale])
+                removed = [sa for sa, f in zip(stale, futures) if f.exception() is None]
+                for sa in removed:
+                    member = gcp_utils.workload_identity_member(self.pod_namespace, sa)
+                    self._stale_since.pop((gcp_service_account, member), None)
+                logger.info(f'Removed {len(removed)} stale members from {gcp_service_account}')
+                metrics.IAM_GC_MEMBERS.labels('removed').inc(len(removed))
+                metrics.IAM_GC_POLICY_UPDATES.inc()
+                size -= len(removed)
+                stale = removed
+            largest = max(largest, size)
+            if stale:
+                pruned[gcp_service_account] = stale
+        metrics.IAM_GC_LARGEST_POLICY.set(largest)
+        metrics.IAM_GC_PENDING.set(len(self._stale_since))
+        metrics.IAM_GC_PASSES.labels('done').inc()
+        return pruned
+
+
+_collector = None
+_collector_lock = threading.Lock()
+
+
+def iam_gc_enabled() -> bool:
+    return os.environ.get('IAM_GC_ENABLED', 'false') == 'true'
+
+
+def start_collector(pod_namespace, platform_namespace, k8s_ctx: KubernetesContext = None) -> StaleBindingCollector:
+    """Starts the collector configured from the environment, once per process."""
+    global _collector
+    with _collector_lock:
+        if _collector is None:
+            _collector = StaleBindingCollector(
+                pod_namespace, platform_namespace, k8s_ctx,
+                interval=float(os.environ.get('IAM_GC_INTERVAL_SECONDS', 600)),
+                grace=float(os.environ.get('IAM_GC_GRACE_SECONDS', 300)),
+                max_updates_per_second=float(os.environ.get('IAM_GC_MAX_UPDATES_PER_SECOND', 1)),
+                dry_run=os.environ.get('IAM_GC_DRY_RUN', 'false') == 'true',
+                max_pod_index_age=float(os.environ.get('IAM_GC_MAX_POD_INDEX_AGE_SECONDS', 60))).start()
+        return _collector
+
+
+def get_collector() -> StaleBindingCollector:
+    return _collector
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+HTTP_GONE = 410
+DEFAULT_WATCH_TIMEOUT_SECONDS = 300
+MAX_BACKOFF_SECONDS = 30
+
+
+class Informer:
+    """List once, then watch from the list's resourceVersion, keeping an in-memory store.
+
+    The store is keyed by object name and can carry secondary indices
+    (``indexers`` maps an index name to a function returning the index keys
+    for an object). When the watch expires with 410 Gone the informer relists.
+    Event handlers are called as ``handler(event_type, obj)`` for ADDED,
+    MODIFIED and DELETED, including changes discovered by a relist.
+    """
+
+    def __init__(self, list_func, namespace, indexers: dict = None, name: str = None,
+                 watch_timeout_seconds: int = DEFAULT_WATCH_TIMEOUT_SECONDS, **list_kwargs):
+        self.name = name or getattr(list_func, '__name__', 'informer')
+        self._list_func = list_func
+        self._namespace = namespace
+        self._list_kwargs = list_kwargs
+        self._watch_timeout_seconds = watch_timeout_seconds
+        self._indexers = indexers or {}
+        self._lock = threading.RLock()
+        self._store = {}
+        self._indices = {index_name: {} for index_name in self._indexers}
+        self._handlers = []
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._watch = None
+        self._thread = None
+        self.resource_version = None
+        self.last_sync = None
+        self._synced_at = metrics.WATCH_SYNCED.labels(self.name)
+
+    def add_event_handler(self, handler):
+        self._handlers.append(handler)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'informer-{self.name}', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch:
+            self._watch.stop()
+
+    def has_synced(self) -> bool:
+        return self._synced.is_set()
+
+    def wait_for_sync(self, timeout: float = None) -> bool:
+        return self._synced.wait(timeout)
+
+    def sync_age(self):
+        """Seconds since the store was last confirmed current by a list or watch event."""
+        if self.last_sync is None:
+            return None
+        return time.monotonic() - self.last_sync
+
+    def _confirm(self):
+        self.last_sync = time.monotonic()
+        self._synced_at.set_to_current_time()
+
+    def get(self, name):
+        with self._lock:
+            return self._store.get(name)
+
+    def list(self):
+        with self._lock:
+            return list(self._store.values())
+
+    def by_index(self, index_name, key):
+        with self._lock:
+            return [self._store[n] for n in self._indices[index_name].get(key, ())]
+
+    def _run(self):
+        from kubernetes.client.rest import ApiException
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self._relist()
+                self._watch_once()
+                backoff = 1
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    logger.info(f'Informer {self.name}: resourceVersion {self.resource_version} expired, relisting')
+                    self.resource_version = None
+                    continue
+                logger.warning(f'Informer {self.name}: API error {e.status} {e.reason}, retrying in {backoff}s')
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+            except Exception:
+                logger.exception(f'Informer {self.name}: watch failed, retrying in {backoff}s')
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+
+    def _relist(self):
+        resp = self._list_func(self._namespace, **self._list_kwargs)
+        new_store = {item.metadata.name: item for item in resp.items}
+        events = []
+        with self._lock:
+            for name, obj in new_store.items():
+                old = self._store.get(name)
+                if old is None:
+                    events.append(('ADDED', obj))
+                elif old.metadata.resource_version != obj.metadata.resource_version:
+                    events.append(('MODIFIED', obj))
+            for name, obj in self._store.items():
+                if name not in new_store:
+                    events.append(('DELETED', obj))
+            self._store = new_store
+            self._indices = {index_name: {} for index_name in self._indexers}
+            for name, obj in new_store.items():
+                self._index(name, obj)
+            self.resource_version = resp.metadata.resource_version
+            self._confirm()
+        self._synced.set()
+        for event_type, obj in events:
+            self._notify(event_type, obj)
+
+    def _watch_once(self):
+        from kubernetes import watch
+        self._watch = watch.Watch()
+        for event in self._watch.stream(self._list_func, self._namespace,
+                                        resource_version=self.resource_version,
+                                        timeout_seconds=self._watch_timeout_seconds,
+                                        allow_watch_bookmarks=True,
+                                        **self._list_kwargs):
+            if self._stopped.is_set():
+                break
+            event_type = event['type']
+            if event_type == 'BOOKMARK':
+                self.resource_version = event['raw_object']['metadata']['resourceVersion']
+                self._confirm()
+                continue
+            self._apply(event_type, event['object'])
+        # A watch that ends at its timeout without errors is still current
+        self._confirm()
+
+    def _apply(self, event_type, obj):
+        name = obj.metadata.name
+        with self._lock:
+            self._unindex(name)
+            if event_type == 'DELETED':
+                self._store.pop(name, None)
+            else:
+                self._store[name] = obj
+                self._index(name, obj)
+            self.resource_version = obj.metadata.resource_version
+            self._confirm()
+        self._notify(event_type, obj)
+
+    def _index(self, name, obj):
+        for index_name, index_func in self._indexers.items():
+            for key in index_func(obj) or ():
+                self._indices[index_name].setdefault(key, set()).add(name)
+
+    def _unindex(self, name):
+        old = self._store.get(name)
+        if old is None:
+            return
+        for index_name, index_func in self._indexers.items():
+            index = self._indices[index_name]
+            for key in index_func(old) or ():
+                names = index.get(key)
+                if names:
+                    names.discard(name)
+                    if not names:
+                        del index[key]
+
+    def _notify(self, event_type, obj):
+        for handler in self._handlers:
+            try:
+                handler(event_type, obj)
+            except Exception:
+                logger.exception(f'Informer {self.name}: event handler failed for {event_type}')
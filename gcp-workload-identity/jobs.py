@@ -0,0 +1,157 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import scheduler
+import sharding
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+
+# A random id, followed with sharding by '.' and the name of the replica running the job
+_JOB_ID = re.compile(r'^[0-9a-f]{32}(\.[a-z0-9]([-.a-z0-9]*[a-z0-9])?)?$')
+
+
+class JobStore:
+    """Runs assume/reset work in the background and keeps its outcome for ``ttl`` seconds.
+
+    Each job is a small JSON file in ``directory``, rewritten atomically on
+    every state change, so a job started by one Gunicorn worker can be polled
+    through any other. ``wait`` blocks on an event for jobs of this process
+    and re-reads the file for the others. Jobs run on ``max_workers`` threads
+    with a deadline of ``deadline`` seconds each, in place of the request's.
+    Given ``replica``, job ids end with it, so other replicas know where to
+    ask for the job.
+    """
+
+    def __init__(self, directory, max_workers: int, ttl: float, deadline: float, poll_interval: float = 0.1,
+                 replica: str = None):
+        self.directory = directory
+        self.replica = replica
+        self.ttl = ttl
+        self.deadline = deadline
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._done = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def _write(self, job):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, self._path(job['job_id']))
+
+    def get(self, job_id):
+        if not _JOB_ID.match(job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def submit(self, kind, user_id, run_id, fn):
+        """Queues ``fn()``, which returns (status, message); returns the new job."""
+        job_id = uuid.uuid4().hex if self.replica is None else f'{uuid.uuid4().hex}.{self.replica}'
+        job = {'job_id': job_id, 'kind': kind, 'user_id': user_id, 'run_id': run_id,
+               'state': PENDING, 'status': None, 'message': None, 'created': time.time(), 'finished': None}
+        self._write(job)
+        with self._lock:
+            self._done[job['job_id']] = threading.Event()
+        # A fresh context, so the job gets its own deadline rather than the submitting request's
+        self._executor.submit(contextvars.Context().run, self._run, job, fn)
+        self._cleanup()
+        return job
+
+    def _run(self, job, fn):
+        token = scheduler.start_deadline(self.deadline)
+        try:
+            self._write(dict(job, state=RUNNING))
+            try:
+                status, message = fn()
+            except Exception as e:
+                logger.exception(f'{job["kind"]} job {job["job_id"]} for run {job["run_id"]} failed')
+                status, message = False, f'Error: {e}'
+            self._write(dict(job, state=DONE, status=status, message=str(message), finished=time.time()))
+        finally:
+            scheduler.end_deadline(token)
+            with self._lock:
+                done = self._done.pop(job['job_id'], None)
+            if done is not None:
+                done.set()
+
+    def wait(self, job_id, timeout: float):
+        """The job once done, or as it stands after ``timeout`` seconds; None if unknown."""
+        with self._lock:
+            done = self._done.get(job_id)
+        if done is not None:
+            done.wait(timeout)
+            return self.get(job_id)
+        # Started by another worker process
+        give_up_at = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['state'] == DONE or time.monotonic() >= give_up_at:
+                return job
+            time.sleep(min(self.poll_interval, max(give_up_at - time.monotonic(), 0)))
+
+    def _cleanup(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < min(self.ttl, 60):
+                return
+            self._last_cleanup = now
+        expired_before = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def replica_of(job_id):
+    """The replica named by ``job_id``, or None."""
+    if not _JOB_ID.match(job_id) or '.' not in job_id:
+        return None
+    return job_id.split('.', 1)[1]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore(os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'gcpwi-jobs')),
+                              max_workers=int(os.environ.get('JOB_WORKERS', 8)),
+                              ttl=float(os.environ.get('JOB_TTL_SECONDS', 600)),
+                              deadline=float(os.environ.get('JOB_DEADLINE_SECONDS', 120)),
+                              replica=sharding.replica_identity() if sharding.sharding_enabled() else None)
+        return _store
+
+
+def drain():
+    """Finishes the queued jobs of this process."""
+    if _store is not None:
+        _store.shutdown(wait=True)
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import TYPE_CHECKING
+
+import metrics
+import scheduler
+
+if TYPE_CHECKING:
+    from kubernetes import client
+
+DEFAULT_CONNECTION_POOL_MAXSIZE = 32
+
+# The CoreV1Api calls the service makes; they are timed and go through the kubernetes upstream scheduler
+CORE_V1_OPERATIONS = (
+    'list_namespaced_pod',
+    'read_namespaced_config_map',
+    'patch_namespaced_config_map',
+    'create_namespaced_config_map',
+    'read_namespaced_service_account',
+    'patch_namespaced_service_account',
+)
+
+
+class KubernetesContext:
+    """Process wide Kubernetes configuration and pooled API client.
+
+    The in-cluster config (token and CA files) is loaded once. The projected
+    service account token is re-read by the client configuration when it
+    rotates, and all API calls share a single keep-alive connection pool.
+    """
+
+    def __init__(self, configuration: client.Configuration = None):
+        # Imported here so the service starts without paying for the kubernetes package up front
+        from kubernetes import client, config
+        if configuration is None:
+            configuration = client.Configuration()
+            try:
+                # try_refresh_token re-reads the projected token file when it rotates
+                config.load_incluster_config(client_configuration=configuration, try_refresh_token=True)
+            except config.ConfigException:
+                print("Loading local k8s config")
+                config.load_kube_config(client_configuration=configuration)
+        configuration.connection_pool_maxsize = int(os.environ.get('K8S_CONNECTION_POOL_MAXSIZE',
+                                                                   DEFAULT_CONNECTION_POOL_MAXSIZE))
+        self.configuration = configuration
+        self.api_client = client.ApiClient(configuration)
+        core_v1 = scheduler.schedule_core_v1(client.CoreV1Api(self.api_client), CORE_V1_OPERATIONS)
+        self.core_v1 = metrics.instrument_core_v1(core_v1, CORE_V1_OPERATIONS)
+
+    def close(self):
+        self.api_client.rest_client.pool_manager.clear()
+        self.api_client.close()
+
+
+_context: KubernetesContext = None
+_context_lock = threading.Lock()
+
+
+def get_k8s_context() -> KubernetesContext:
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                _context = KubernetesContext()
+    return _context
+
+
+def set_k8s_context(context: KubernetesContext):
+    global _context
+    with _context_lock:
+        _context = context
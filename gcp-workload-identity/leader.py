@@ -0,0 +1,49 @@
+import fcntl
+import os
+import tempfile
+import threading
+
+
+def lock_path(name) -> str:
+    return os.path.join(tempfile.gettempdir(), f'gcpwi-{name}.lock')
+
+
+class LeaderLock:
+    """Picks one process of the pod for a background job: the holder of an exclusive lock on ``path``.
+
+    The lock is taken without blocking and held until the process exits, when
+    the kernel releases it and the next ``try_acquire`` of another worker
+    succeeds. ``on_acquire`` runs before the lock counts as held; if it
+    raises, the lock is given up again.
+    """
+
+    def __init__(self, path, on_acquire=None):
+        self.path = path
+        self._on_acquire = on_acquire
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        with self._lock:
+            if self._file is not None:
+                return True
+            f = open(self.path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            try:
+                if self._on_acquire:
+                    self._on_acquire()
+            except Exception:
+                f.close()
+                raise
+            self._file = f
+            return True
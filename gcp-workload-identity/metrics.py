@@ -0,0 +1,138 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+
+# Upstream calls range from sub-millisecond cache-backed reads to multi-second IAM writes
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REQUESTS = Counter('gcpwi_http_requests_total', 'HTTP requests handled',
+                   ['route', 'method', 'status'])
+REQUEST_LATENCY = Histogram('gcpwi_http_request_duration_seconds', 'HTTP request latency',
+                            ['route', 'method'], buckets=LATENCY_BUCKETS)
+UPSTREAM_LATENCY = Histogram('gcpwi_upstream_request_duration_seconds', 'Latency of calls to upstream services',
+                             ['upstream', 'operation'], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter('gcpwi_upstream_errors_total', 'Upstream calls that raised or returned an error',
+                          ['upstream', 'operation'])
+UPSTREAM_RETRIES = Counter('gcpwi_upstream_retries_total', 'Upstream call attempts that were retried', ['upstream'])
+UPSTREAM_SHED = Counter('gcpwi_upstream_shed_total', 'Upstream calls rejected because too many were waiting',
+                        ['upstream'])
+UPSTREAM_WAITING = Gauge('gcpwi_upstream_waiting', 'Calls waiting for a slot or write quota of an upstream',
+                         ['upstream'], multiprocess_mode='livesum')
+IAM_FORWARDS = Counter('gcpwi_iam_updates_forwarded_total',
+                       'IAM policy updates sent to the replica owning the GCP service account', ['outcome'])
+LEADERS = Gauge('gcpwi_leader', 'Gunicorn workers holding the per-pod lock of a background job', ['job'],
+                multiprocess_mode='livesum')
+REPLICAS_LIVE = Gauge('gcpwi_replicas_live', 'Replicas with a current Lease', multiprocess_mode='livemax')
+LEASE_RENEWED = Gauge('gcpwi_replica_lease_renewed_timestamp_seconds', 'When this replica last renewed its Lease',
+                      multiprocess_mode='livemax')
+IAM_GC_PASSES = Counter('gcpwi_iam_gc_passes_total', 'Stale member collection passes', ['outcome'])
+IAM_GC_MEMBERS = Counter('gcpwi_iam_gc_members_total', 'Workload identity members of ended runs', ['action'])
+IAM_GC_POLICY_UPDATES = Counter('gcpwi_iam_gc_policy_updates_total', 'Policy updates removing stale members')
+IAM_GC_PENDING = Gauge('gcpwi_iam_gc_members_pending_grace', 'Stale members waiting out the grace period',
+                       multiprocess_mode='livesum')
+IAM_GC_LARGEST_POLICY = Gauge('gcpwi_iam_gc_largest_policy_members',
+                              'Workload identity members of the largest policy in the last pass',
+                              multiprocess_mode='livemax')
+PREWARM_RUNS = Counter('gcpwi_prewarm_runs_total', 'New run pods seen by the pre-warming controller', ['outcome'])
+PREWARM_BATCHES = Counter('gcpwi_prewarm_batches_total', 'Batches of runs pre-warmed', ['outcome'])
+PREWARM_QUEUED = Gauge('gcpwi_prewarm_queued', 'Runs waiting to be pre-warmed', multiprocess_mode='livesum')
+CACHE_LOOKUPS = Counter('gcpwi_cache_lookups_total', 'Lookups of in-memory caches', ['cache', 'result'])
+WATCH_SYNCED = Gauge('gcpwi_watch_synced_timestamp_seconds',
+                     'When a watch was last confirmed current, in the worker where that is longest ago', ['watch'],
+                     multiprocess_mode='livemin')
+
+
+class _Upstream:
+    __slots__ = ('latency', 'errors')
+
+    def __init__(self, upstream, operation):
+        self.latency = UPSTREAM_LATENCY.labels(upstream, operation)
+        self.errors = UPSTREAM_ERRORS.labels(upstream, operation)
+
+
+# Label lookups take a lock, so the children for each (upstream, operation) are resolved once
+_upstreams = {}
+
+
+def _upstream(upstream, operation) -> _Upstream:
+    children = _upstreams.get((upstream, operation))
+    if children is None:
+        children = _upstreams.setdefault((upstream, operation), _Upstream(upstream, operation))
+    return children
+
+
+@contextmanager
+def observe(upstream, operation):
+    """Records the latency of the enclosed upstream call, and an error if it raises."""
+    children = _upstream(upstream, operation)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        children.errors.inc()
+        raise
+    finally:
+        children.latency.observe(time.perf_counter() - start)
+
+
+def timed(upstream, operation, failed=None):
+    """Decorator form of ``observe``; ``failed(result)`` marks returned values as errors too."""
+    def decorate(fn):
+        children = _upstream(upstream, operation)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException:
+                children.errors.inc()
+                raise
+            finally:
+                children.latency.observe(time.perf_counter() - start)
+            if failed is not None and failed(result):
+                children.errors.inc()
+            return result
+        return wrapper
+    return decorate
+
+
+def instrument_core_v1(core_v1, operations):
+    """Times the given CoreV1Api calls; watch requests, which stream, are left alone."""
+    for operation in operations:
+        method = getattr(core_v1, operation)
+        timed_method = timed('kubernetes', operation)(method)
+
+        # functools.wraps keeps the docstring, which Watch.stream parses for the return type
+        @functools.wraps(method)
+        def call(*args, _method=method, _timed=timed_method, **kwargs):
+            if kwargs.get('watch'):
+                return _method(*args, **kwargs)
+            return _timed(*args, **kwargs)
+        setattr(core_v1, operation, call)
+    return core_v1
+
+
+def record_request(route, method, status, seconds):
+    REQUESTS.labels(route, method, status).inc()
+    REQUEST_LATENCY.labels(route, method).observe(seconds)
+
+
+def exposition():
+    """(body, content type) for /metrics, aggregated over Gunicorn workers when in multiprocess mode."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,74 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('PIPELINE_WORKERS', 32)),
+                               thread_name_prefix='pipeline')
+
+
+class Pipeline:
+    """A small dependency graph of request stages run concurrently on a shared thread pool.
+
+    ``stage(name, fn, *deps)`` schedules ``fn(*dep_results)`` as soon as all of
+    its dependency futures have completed and returns the stage's own future.
+    A failed dependency fails every stage that depends on it. Stages run in a
+    copy of the caller's context, so per-request state (such as the Domino
+    lookup memo) is shared with them. Wall time per stage is kept in ``timings``;
+    for stages sharing a name (one per item of a batch) the slowest is kept.
+    """
+
+    def __init__(self, name: str, executor: ThreadPoolExecutor = None):
+        self.name = name
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._executor = executor or _executor
+        self._context = contextvars.copy_context()
+        self._started = time.perf_counter()
+
+    def stage(self, name, fn, *deps: Future) -> Future:
+        result = Future()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                args = [d.result() for d in deps]
+                # A Context can only be entered by one thread at a time
+                value = self._context.copy().run(fn, *args)
+            except BaseException as e:
+                error = e
+            else:
+                error = None
+            # Recorded before the future resolves, so dependent stages and log_timings see it
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] = max(self.timings.get(name, 0), elapsed)
+            if error is None:
+                result.set_result(value)
+            else:
+                result.set_exception(error)
+
+        remaining = [len(deps)]
+        lock = threading.Lock()
+
+        def dep_done(_):
+            with lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._executor.submit(run)
+
+        if not deps:
+            self._executor.submit(run)
+        for d in deps:
+            d.add_done_callback(dep_done)
+        return result
+
+    def log_timings(self):
+        total = time.perf_counter() - self._started
+        stages = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.timings.items())
+        logger.info(f'{self.name}: total={total * 1000:.1f}ms {stages}')
@@ -0,0 +1,102 @@
+import os
+import re
+import threading
+
+from informer import Informer
+from k8s_context import KubernetesContext, get_k8s_context
+
+EXECUTION_ID_LABEL = 'dominodatalab.com/execution-id'
+STARTING_USER_ID_LABEL = 'dominodatalab.com/starting-user-id'
+EXECUTION_ID_INDEX = 'execution-id'
+
+# Kubernetes label value syntax; anything else can never match and must not reach a label selector
+_LABEL_VALUE_RE = re.compile(r'^(([A-Za-z0-9][-A-Za-z0-9_.]*)?[A-Za-z0-9])?$')
+
+
+def _execution_ids(pod):
+    labels = pod.metadata.labels or {}
+    if EXECUTION_ID_LABEL in labels:
+        return [labels[EXECUTION_ID_LABEL]]
+    return []
+
+
+def _run_pod_entry(pod):
+    labels = pod.metadata.labels or {}
+    service_account = pod.spec.service_account_name or pod.spec.service_account
+    return labels.get(STARTING_USER_ID_LABEL), service_account
+
+
+def _owned_entries(pods):
+    return [entry for entry in map(_run_pod_entry, pods) if entry[0]]
+
+
+class RunPodIndex:
+    """Execution id -> (starting user id, pod service account) for run pods in one namespace.
+
+    Served from a pod informer once it has synced. Until then, and for run ids
+    the informer has not seen yet, a label-selector list for that one run is used.
+    """
+
+    def __init__(self, namespace, k8s_ctx: KubernetesContext = None):
+        if k8s_ctx is None:
+            k8s_ctx = get_k8s_context()
+        self.namespace = namespace
+        self._core_v1 = k8s_ctx.core_v1
+        self.informer = Informer(self._core_v1.list_namespaced_pod, namespace,
+                                 indexers={EXECUTION_ID_INDEX: _execution_ids},
+                                 name=f'pods-{namespace}',
+                                 label_selector=EXECUTION_ID_LABEL)
+
+    def start(self):
+        self.informer.start()
+        return self
+
+    def lookup(self, run_id):
+        """Returns a list of (starting user id, service account) for the pods of a run.
+
+        Pods without a starting user id are left out, as they can belong to no caller.
+        """
+        if not run_id or not _LABEL_VALUE_RE.match(run_id) or len(run_id) > 63:
+            return []
+        if self.informer.has_synced():
+            pods = self.informer.by_index(EXECUTION_ID_INDEX, run_id)
+            if pods:
+                return _owned_entries(pods)
+        pods = self._core_v1.list_namespaced_pod(self.namespace,
+                                                 label_selector=f'{EXECUTION_ID_LABEL}={run_id}').items
+        return _owned_entries(pods)
+
+    def live_service_accounts(self, max_age: float = None) -> set:
+        """Service accounts of run pods that have not finished.
+
+        From the informer when it has synced and, given ``max_age``, was
+        confirmed current within that many seconds; otherwise from a fresh list.
+        """
+        age = self.informer.sync_age()
+        if self.informer.has_synced() and (max_age is None or (age is not None and age <= max_age)):
+            pods = self.informer.list()
+        else:
+            pods = self._core_v1.list_namespaced_pod(self.namespace, label_selector=EXECUTION_ID_LABEL).items
+        return {_run_pod_entry(p)[1] for p in pods
+                if (p.status is None or p.status.phase not in ('Succeeded', 'Failed'))}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def pod_index_enabled() -> bool:
+    return os.environ.get('POD_INDEX_ENABLED', 'true') == 'true'
+
+
+def get_run_pod_index(namespace, k8s_ctx: KubernetesContext = None) -> RunPodIndex:
+    index = _indexes.get(namespace)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(namespace)
+            if index is None:
+                index = RunPodIndex(namespace, k8s_ctx)
+                if pod_index_enabled():
+                    index.start()
+                _indexes[namespace] = index
+    return index
@@ -0,0 +1,158 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import metrics
+import sharding
+import utils
+from k8s_context import KubernetesContext
+from leader import LeaderLock, lock_path as leader_lock_path
+from pod_index import EXECUTION_ID_LABEL, STARTING_USER_ID_LABEL, get_run_pod_index
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+
+class PrewarmController:
+    """Applies the starting user's default org GSA to new run pods before anyone asks for it.
+
+    Watches run pods in the compute namespace through the pod index informer.
+    Pods created less than ``max_pod_age`` seconds ago are queued, collected
+    for ``window`` seconds and handed to ``utils.prewarm_service_accounts``
+    ``max_batch`` at a time, so each GSA gets one policy update per batch.
+    Runs whose service account already has a GSA are skipped, and a later
+    /assume_service_account still moves the run to any other org.
+
+    Only one Gunicorn worker per pod does the work: the one holding a
+    ``LeaderLock`` on ``lock_path``. The others retry the lock every
+    ``window`` seconds, so the work moves on when that worker exits.
+    """
+
+    def __init__(self, pod_namespace, platform_namespace, k8s_ctx: KubernetesContext = None,
+                 window: float = 1, max_batch: int = 100, max_pod_age: float = 120, lock_path: str = None):
+        self.pod_namespace = pod_namespace
+        self.platform_namespace = platform_namespace
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pod_age = max_pod_age
+        self._leader = LeaderLock(lock_path or leader_lock_path(f'prewarm-{pod_namespace}'), on_acquire=self._on_lead)
+        self._k8s_ctx = k8s_ctx
+        self._queue = {}
+        self._queue_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._leader.try_acquire()
+        index = get_run_pod_index(self.pod_namespace, self._k8s_ctx)
+        index.informer.add_event_handler(self._on_pod_event)
+        # Runs even with POD_INDEX_ENABLED=false, as the watch is what drives the controller
+        index.start()
+        self._thread = threading.Thread(target=self._loop, name='prewarm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    @property
+    def leader(self) -> bool:
+        return self._leader.held
+
+    def _on_lead(self):
+        metrics.LEADERS.labels('prewarm').set(1)
+        logger.info(f'Pre-warming workload identities of new runs in {self.pod_namespace}')
+
+    def _is_new(self, pod):
+        created = pod.metadata.creation_timestamp
+        if created is None:
+            return True
+        age = datetime.datetime.now(datetime.timezone.utc) - created
+        return age.total_seconds() <= self.max_pod_age
+
+    def _on_pod_event(self, event_type, pod):
+        if event_type != 'ADDED' or not self.leader:
+            return
+        if pod.status is not None and pod.status.phase in ('Succeeded', 'Failed'):
+            return
+        # The initial list and relists deliver every existing pod as ADDED; only new runs are pre-warmed
+        if not self._is_new(pod):
+            metrics.PREWARM_RUNS.labels('too_old').inc()
+            return
+        labels = pod.metadata.labels or {}
+        service_account = pod.spec.service_account_name or pod.spec.service_account
+        if not service_account or not labels.get(STARTING_USER_ID_LABEL):
+            return
+        # With several replicas each pre-warms the runs it owns
+        if not sharding.is_local(labels.get(EXECUTION_ID_LABEL) or pod.metadata.name):
+            metrics.PREWARM_RUNS.labels('not_owned').inc()
+            return
+        with self._queue_lock:
+            self._queue[labels.get(EXECUTION_ID_LABEL)] = (labels[STARTING_USER_ID_LABEL], service_account)
+            metrics.PREWARM_QUEUED.set(len(self._queue))
+        self._wakeup.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not self._leader.try_acquire():
+                self._stop.wait(self.window)
+                continue
+            self._wakeup.wait()
+            # Let the pods of runs started together arrive, so they share policy updates
+            self._stop.wait(self.window)
+            self._wakeup.clear()
+            while not self._stop.is_set():
+                with self._queue_lock:
+                    run_ids = list(self._queue)[:self.max_batch]
+                    runs = [self._queue.pop(run_id) for run_id in run_ids]
+                    metrics.PREWARM_QUEUED.set(len(self._queue))
+                if not runs:
+                    break
+                try:
+                    self.prewarm(run_ids, runs)
+                except Exception:
+                    metrics.PREWARM_BATCHES.labels('failed').inc()
+                    logger.exception(f'Pre-warming {len(runs)} runs failed')
+
+    def prewarm(self, run_ids, runs):
+        start = time.perf_counter()
+        results = utils.prewarm_service_accounts(runs, self.pod_namespace, self.platform_namespace, self._k8s_ctx)
+        for run_id, result in zip(run_ids, results):
+            if isinstance(result, Exception):
+                metrics.PREWARM_RUNS.labels('failed').inc()
+                logger.warning(f'Could not pre-warm the workload identity of run {run_id}: {result}')
+            elif result:
+                metrics.PREWARM_RUNS.labels('prewarmed').inc()
+            else:
+                metrics.PREWARM_RUNS.labels('skipped').inc()
+        metrics.PREWARM_BATCHES.labels('done').inc()
+        logger.info(f'Pre-warmed {len(runs)} runs in {(time.perf_counter() - start) * 1000:.0f}ms')
+        return results
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def prewarm_enabled() -> bool:
+    return os.environ.get('PREWARM_ENABLED', 'false') == 'true'
+
+
+def start_controller(pod_namespace, platform_namespace, k8s_ctx: KubernetesContext = None) -> PrewarmController:
+    """Starts the controller configured from the environment, once per process."""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = PrewarmController(
+                pod_namespace, platform_namespace, k8s_ctx,
+                window=float(os.environ.get('PREWARM_BATCH_WINDOW_SECONDS', 1)),
+                max_batch=int(os.environ.get('PREWARM_MAX_BATCH', 100)),
+                max_pod_age=float(os.environ.get('PREWARM_MAX_POD_AGE_SECONDS', 120))).start()
+        return _controller
+
+
+def get_controller() -> PrewarmController:
+    return _controller
@@ -0,0 +1,211 @@
+import contextvars
+import functools
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import urllib3.exceptions
+
+import metrics
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing when an upstream already has too many callers waiting."""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f'Too many requests waiting for {upstream}')
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Absolute time.monotonic() by which the current request must finish, if any
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+def start_deadline(seconds: float):
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def end_deadline(token):
+    _deadline.reset(token)
+
+
+def remaining(default: float = None):
+    """Seconds left before the request deadline, at most ``default``; ``default`` outside a request."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    return left if default is None else min(default, max(left, 0))
+
+
+class TokenBucket:
+    """``rate`` tokens per second, up to ``burst`` saved; ``acquire`` waits for a token."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # Takes a token, possibly going into debt; returns how long the caller must wait for it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def _refund(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def acquire(self, timeout: float = None) -> bool:
+        wait = self._reserve()
+        if timeout is not None and wait > timeout:
+            self._refund()
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class Upstream:
+    """Concurrency cap, write rate limit, timeouts and retries for calls to one upstream service.
+
+    At most ``max_concurrency`` calls run at once. Callers beyond that wait
+    for a slot, up to their request deadline; once ``max_queue`` are waiting,
+    new callers fail fast with Overloaded. Writes also take a token from the
+    ``write_rate`` bucket. Each attempt is given the lesser of ``timeout``
+    and the time left before the deadline, and failures that ``retryable``
+    accepts are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, name, max_concurrency: int, max_queue: int, timeout: float, max_retries: int,
+                 write_rate: float = None, write_burst: float = None, backoff: float = 0.1,
+                 max_backoff: float = 5.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.writes = TokenBucket(write_rate, write_burst or write_rate) if write_rate else None
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._waiting_gauge = metrics.UPSTREAM_WAITING.labels(name)
+        # Moving average of attempt latency, used to suggest a Retry-After
+        self._latency = 0.1
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._waiting / self.max_concurrency * self._latency))
+
+    def _acquire(self, write):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                metrics.UPSTREAM_SHED.labels(self.name).inc()
+                raise Overloaded(self.name, self._retry_after())
+            self._waiting += 1
+        self._waiting_gauge.inc()
+        try:
+            # Writers wait for quota before taking a slot, so they do not hold one while throttled
+            if write and self.writes and not self.writes.acquire(remaining()):
+                raise DeadlineExceeded(f'Request deadline passed waiting for {self.name} write quota')
+            if not self._slots.acquire(timeout=remaining()):
+                raise DeadlineExceeded(f'Request deadline passed waiting for {self.name}')
+        finally:
+            with self._lock:
+                self._waiting -= 1
+            self._waiting_gauge.dec()
+
+    def call(self, fn, retryable, write=False):
+        """Runs ``fn(timeout)``; ``retryable(exception, result)`` says whether to try again."""
+        for attempt in range(self.max_retries + 1):
+            timeout = remaining(self.timeout)
+            if timeout is not None and timeout <= 0:
+                raise DeadlineExceeded(f'Request deadline passed before calling {self.name}')
+            self._acquire(write)
+            start = time.monotonic()
+            error, result = None, None
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                error = e
+            finally:
+                self._slots.release()
+                self._latency = 0.8 * self._latency + 0.2 * (time.monotonic() - start)
+            if attempt == self.max_retries or not retryable(error, result):
+                if error is not None:
+                    raise error
+                return result
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            left = remaining()
+            if left is not None and delay >= left:
+                if error is not None:
+                    raise error
+                return result
+            metrics.UPSTREAM_RETRIES.labels(self.name).inc()
+            logger.info(f'Retrying {self.name} call in {delay:.2f}s after {error or result}')
+            time.sleep(delay)
+
+
+def retryable_status(status) -> bool:
+    return status == 429 or (status is not None and status >= 500)
+
+
+def _kubernetes_retryable(error, result):
+    from kubernetes.client.rest import ApiException
+    if isinstance(error, ApiException):
+        return retryable_status(error.status)
+    # Connection failures and timeouts
+    return isinstance(error, urllib3.exceptions.HTTPError)
+
+
+def schedule_core_v1(core_v1, operations):
+    """Routes the given CoreV1Api calls through the kubernetes upstream; watch requests are left alone."""
+    for operation in operations:
+        method = getattr(core_v1, operation)
+
+        # functools.wraps keeps the docstring, which Watch.stream parses for the return type
+        @functools.wraps(method)
+        def call(*args, _method=method, **kwargs):
+            if kwargs.get('watch') or '_request_timeout' in kwargs:
+                return _method(*args, **kwargs)
+            return kubernetes.call(lambda timeout: _method(*args, _request_timeout=timeout, **kwargs),
+                                   _kubernetes_retryable)
+        setattr(core_v1, operation, call)
+    return core_v1
+
+
+def call_kubernetes(fn):
+    """Runs ``fn(timeout)``, an API call not made through CoreV1Api, as a kubernetes upstream call."""
+    return kubernetes.call(fn, _kubernetes_retryable)
+
+
+def _from_env(name, prefix, max_concurrency, max_queue, timeout, max_retries, **kwargs):
+    return Upstream(name,
+                    int(os.environ.get(f'{prefix}_MAX_CONCURRENCY', max_concurrency)),
+                    int(os.environ.get(f'{prefix}_MAX_QUEUE', max_queue)),
+                    float(os.environ.get(f'{prefix}_TIMEOUT_SECONDS', timeout)),
+                    int(os.environ.get(f'{prefix}_MAX_RETRIES', max_retries)),
+                    **kwargs)
+
+
+domino = _from_env('domino', 'DOMINO', 32, 256, 10, 2)
+kubernetes = _from_env('kubernetes', 'K8S', 32, 512, 30, 2)
+iam = _from_env('iam', 'IAM', 8, 256, 30, 3,
+                write_rate=float(os.environ.get('IAM_WRITE_RATE_PER_SECOND', 5)),
+                write_burst=float(os.environ.get('IAM_WRITE_BURST', 10)))
@@ -0,0 +1,74 @@
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+DEFAULT_PORT = 6000
+
+
+def _child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def _post_worker_init(worker):
+    import warmup
+    warmup.start()
+
+
+def _worker_exit(server, worker):
+    # Gunicorn has already finished in-flight requests; finish queued IAM and ConfigMap writes too
+    import jobs
+    import utils
+    logger.info(f'Worker {worker.pid} exiting, draining background updates')
+    jobs.drain()
+    utils.drain()
+
+
+def _on_exit(server):
+    # Lets the other replicas take over this pod's GCP service accounts right away
+    import sharding
+    import utils
+    if sharding.sharding_enabled():
+        try:
+            sharding.release(os.environ.get('DEFAULT_PLATFORM_NS', utils.DEFAULT_PLATFORM_NS))
+        except Exception:
+            logger.exception('Deleting the replica Lease failed')
+
+
+class ProductionServer(BaseApplication):
+    """Gunicorn with threaded workers, configured from the environment.
+
+    SIGTERM stops accepting connections, lets in-flight requests finish for up
+    to GRACEFUL_TIMEOUT_SECONDS and drains queued IAM updates before exiting.
+    """
+
+    def __init__(self, app, ssl_off: bool, port: int = DEFAULT_PORT):
+        self.application = app
+        self.options = {
+            'bind': f'{os.environ.get("FLASK_HOST", "0.0.0.0")}:{port}',
+            'workers': int(os.environ.get('WEB_CONCURRENCY', 2)),
+            'worker_class': 'gthread',
+            'threads': int(os.environ.get('WEB_THREADS', 8)),
+            'timeout': int(os.environ.get('REQUEST_TIMEOUT_SECONDS', 60)),
+            'graceful_timeout': int(os.environ.get('GRACEFUL_TIMEOUT_SECONDS', 30)),
+            'keepalive': int(os.environ.get('KEEPALIVE_SECONDS', 5)),
+            'loglevel': os.environ.get('LOG_LEVEL', 'ERROR').lower(),
+            'post_worker_init': _post_worker_init,
+            'worker_exit': _worker_exit,
+            'child_exit': _child_exit,
+            'on_exit': _on_exit,
+        }
+        if not ssl_off:
+            self.options['certfile'] = '/ssl/tls.crt'
+            self.options['keyfile'] = '/ssl/tls.key'
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
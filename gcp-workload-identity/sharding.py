@@ -0,0 +1,429 @@
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import requests.adapters
+
+import gcp_utils
+import metrics
+import scheduler
+from informer import Informer
+from leader import LeaderLock, lock_path as leader_lock_path
+from k8s_context import KubernetesContext, get_k8s_context
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+REPLICA_LABEL = 'gcpworkloadidentity.dominodatalab.com/replica'
+ADDRESS_ANNOTATION = 'gcpworkloadidentity.dominodatalab.com/address'
+UPDATES_PATH = '/iam_policy_updates'
+JOBS_PATH = '/jobs/'
+MAX_UPDATE_BODY_BYTES = 1024 * 1024
+
+
+class ForwardedUpdateError(Exception):
+    """A member change the owning replica could not apply."""
+
+
+class ReplicaUnavailable(Exception):
+    """Another replica could not be reached."""
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with ``vnodes`` points per node."""
+
+    def __init__(self, nodes, vnodes: int = 64):
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, _hash(key)) % len(self._nodes)]
+
+
+def _hash(value) -> int:
+    return int(hashlib.sha256(value.encode()).hexdigest()[:16], 16)
+
+
+def _micro_time(t: datetime.datetime) -> str:
+    return t.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class ReplicaSet:
+    """The live replicas of the service and which of them owns each GCP service account.
+
+    Every replica keeps a Lease named after itself in the platform namespace,
+    renewed every third of ``lease_duration`` and carrying the address of its
+    internal update endpoint. A replica whose Lease has not been renewed
+    within ``lease_duration`` is gone, and its GSAs move to the others:
+    owners come from a consistent hash ring over the live replicas, so only
+    the GSAs of replicas that joined or left change hands.
+
+    In each replica one Gunicorn worker, the holder of a ``LeaderLock`` on
+    ``lock_path``, renews the Lease and serves the endpoint, so every GSA has
+    a single writing process across the deployment. The other workers retry
+    the lock and take over if that worker exits.
+    """
+
+    def __init__(self, namespace, identity, address, k8s_ctx: KubernetesContext = None,
+                 lease_duration: int = 15, vnodes: int = 64, lock_path: str = None, on_change=None):
+        if k8s_ctx is None:
+            k8s_ctx = get_k8s_context()
+        from kubernetes import client
+        self.namespace = namespace
+        self.identity = identity
+        self.address = address
+        self.lease_duration = lease_duration
+        self.vnodes = vnodes
+        self._leader = LeaderLock(lock_path or leader_lock_path(f'replica-{identity}'), on_acquire=self._serve)
+        self._on_change = on_change
+        self._coordination = client.CoordinationV1Api(k8s_ctx.api_client)
+        self.informer = Informer(self._coordination.list_namespaced_lease, namespace,
+                                 name=f'leases-{namespace}', label_selector=REPLICA_LABEL)
+        self._ring = HashRing(())
+        self._ring_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    @property
+    def leader(self) -> bool:
+        return self._leader.held
+
+    def start(self):
+        self.informer.start()
+        threading.Thread(target=self._loop, name='replica-lease', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.informer.stop()
+
+    def _serve(self):
+        self._server = _serve(self)
+        metrics.LEADERS.labels('replica').set(1)
+        logger.info(f'Replica {self.identity} accepting IAM updates on {self.address}')
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._leader.try_acquire():
+                    self.renew()
+            except Exception:
+                logger.exception(f'Renewing the Lease of replica {self.identity} failed')
+            # Keeps the ring, and gcpwi_replicas_live, current in workers that see no requests
+            self.live()
+            self._stop.wait(self.lease_duration / 3)
+
+    def renew(self):
+        from kubernetes.client.rest import ApiException
+        now = datetime.datetime.now(datetime.timezone.utc)
+        body = {'metadata': {'name': self.identity, 'labels': {REPLICA_LABEL: 'true'},
+                             'annotations': {ADDRESS_ANNOTATION: self.address}},
+                'spec': {'holderIdentity': self.identity, 'leaseDurationSeconds': self.lease_duration,
+                         'renewTime': _micro_time(now)}}
+        try:
+            with metrics.observe('kubernetes', 'patch_namespaced_lease'):
+                scheduler.call_kubernetes(lambda timeout: self._coordination.patch_namespaced_lease(
+                    self.identity, self.namespace, body, _request_timeout=timeout))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            body['spec']['acquireTime'] = body['spec']['renewTime']
+            with metrics.observe('kubernetes', 'create_namespaced_lease'):
+                scheduler.call_kubernetes(lambda timeout: self._coordination.create_namespaced_lease(
+                    self.namespace, body, _request_timeout=timeout))
+        metrics.LEASE_RENEWED.set(now.timestamp())
+
+    def live(self) -> dict:
+        """{identity: address} of the replicas whose Lease is current."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        replicas = {}
+        for lease in self.informer.list():
+            spec = lease.spec
+            if not spec or not spec.renew_time or not spec.holder_identity:
+                continue
+            if spec.renew_time + datetime.timedelta(seconds=spec.lease_duration_seconds or 0) < now:
+                continue
+            address = (lease.metadata.annotations or {}).get(ADDRESS_ANNOTATION)
+            if address:
+                replicas[spec.holder_identity] = address
+        self._update_ring(replicas)
+        return replicas
+
+    def _update_ring(self, replicas):
+        if self._ring.nodes == frozenset(replicas):
+            return
+        with self._ring_lock:
+            if self._ring.nodes == frozenset(replicas):
+                return
+            logger.info(f'Live replicas changed from {sorted(self._ring.nodes)} to {sorted(replicas)}')
+            self._ring = HashRing(replicas, self.vnodes)
+            metrics.REPLICAS_LIVE.set(len(replicas))
+        if self._on_change:
+            self._on_change()
+
+    def owner(self, key):
+        """(identity, address) of the replica owning ``key``, or None if no replica is live."""
+        replicas = self.live()
+        identity = self._ring.owner(key)
+        if identity is None or identity not in replicas:
+            return None
+        return identity, replicas[identity]
+
+    def is_local(self, key) -> bool:
+        """Whether ``key`` belongs to this replica; also when no replica is live yet."""
+        owner = self.owner(key)
+        return owner is None or owner[0] == self.identity
+
+
+class _UpdatesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _from_replica(self):
+        # Only replicas may call these endpoints; they carry no user credentials
+        peers = {urlsplit(address).hostname for address in self.server.replicas.live().values()}
+        return self.client_address[0] in peers | {'127.0.0.1', _pod_ip()}
+
+    def do_GET(self):
+        import jobs
+        url = urlsplit(self.path)
+        if not url.path.startswith(JOBS_PATH):
+            return self._reply(404, {'message': f'{url.path} not found'})
+        if not self._from_replica():
+            return self._reply(403, {'message': 'Not a replica'})
+        job_id = url.path[len(JOBS_PATH):]
+        try:
+            # Already capped by the replica asking
+            wait = max(float(parse_qs(url.query).get('wait', ['0'])[0]), 0)
+        except ValueError:
+            return self._reply(400, {'message': 'wait must be a number of seconds'})
+        store = jobs.get_job_store()
+        job = store.wait(job_id, wait) if wait else store.get(job_id)
+        if job is None:
+            return self._reply(404, {'message': f'No job {job_id}'})
+        self._reply(200, job)
+
+    def do_POST(self):
+        replicas = self.server.replicas
+        if self.path != UPDATES_PATH or not self._from_replica():
+            # The body is left unread: the connection cannot be reused
+            self.close_connection = True
+            if self.path != UPDATES_PATH:
+                return self._reply(404, {'message': f'{self.path} not found'})
+            return self._reply(403, {'message': 'Not a replica'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_UPDATE_BODY_BYTES:
+            self.close_connection = True
+            return self._reply(413, {'message': f'Body must be at most {MAX_UPDATE_BODY_BYTES} bytes'})
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+            changes = [(sa, bound) for sa, bound in body['changes']]
+            if not isinstance(body['gcp_service_account'], str) or not all(
+                    isinstance(sa, str) and isinstance(bound, bool) for sa, bound in changes):
+                raise TypeError('changes must be [service account, bound] pairs')
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'message': f'Malformed update: {e}'})
+        if body.get('namespace') != _pod_namespace():
+            return self._reply(400, {'message': 'Updates are only accepted for the compute namespace'})
+        token = scheduler.start_deadline(float(os.environ.get('REQUEST_DEADLINE_SECONDS', 30)))
+        try:
+            futures = gcp_utils.ensure_iam_policy_members(body['gcp_service_account'], body['namespace'], changes,
+                                                          cached=replicas.is_local(body['gcp_service_account']))
+        except scheduler.Overloaded as e:
+            return self._reply(503, {'message': str(e)}, {'Retry-After': str(e.retry_after)})
+        finally:
+            scheduler.end_deadline(token)
+        results = []
+        for f in futures:
+            try:
+                error = f.exception(timeout=scheduler.iam.timeout * (scheduler.iam.max_retries + 1))
+            except TimeoutError:
+                error = scheduler.DeadlineExceeded('Timed out waiting for the policy update')
+            results.append(None if error is None else str(error))
+        self._reply(200, {'results': results})
+
+
+def _serve(replicas: ReplicaSet):
+    server = ThreadingHTTPServer(('0.0.0.0', urlsplit(replicas.address).port), _UpdatesHandler)
+    server.daemon_threads = True
+    server.replicas = replicas
+    threading.Thread(target=server.serve_forever, name='replica-updates', daemon=True).start()
+    return server
+
+
+def _pod_namespace():
+    return os.environ.get('DEFAULT_COMPUTE_NS', 'domino-compute')
+
+
+def _pod_ip():
+    return os.environ.get('POD_IP') or socket.gethostbyname(socket.gethostname())
+
+
+_forward_session = requests.Session()
+_forward_session.mount('http://', requests.adapters.HTTPAdapter(
+    pool_maxsize=int(os.environ.get('SHARDING_FORWARD_WORKERS', 16))))
+_forward_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SHARDING_FORWARD_WORKERS', 16)),
+                                       thread_name_prefix='iam-forward')
+
+
+def _forward(address, gcp_service_account, domino_compute_namespace, changes):
+    resp = _forward_session.post(f'{address}{UPDATES_PATH}',
+                                 json={'gcp_service_account': gcp_service_account,
+                                       'namespace': domino_compute_namespace,
+                                       'changes': [[sa, bound] for sa, bound in changes]},
+                                 timeout=scheduler.iam.timeout * (scheduler.iam.max_retries + 2))
+    if resp.status_code == 503:
+        raise scheduler.Overloaded('iam', int(resp.headers.get('Retry-After', 1)))
+    resp.raise_for_status()
+    return resp.json()['results']
+
+
+def fetch_job(identity, job_id, wait: float = 0):
+    """Job ``job_id`` from replica ``identity``, waiting up to ``wait`` seconds for it to finish.
+
+    None if ``identity`` is this replica or not a live one, or the job is unknown there.
+    """
+    if _replicas is None or identity is None or identity == _replicas.identity:
+        return None
+    address = _replicas.live().get(identity)
+    if address is None:
+        return None
+    try:
+        resp = _forward_session.get(f'{address}{JOBS_PATH}{job_id}', params={'wait': wait},
+                                    timeout=wait + scheduler.kubernetes.timeout)
+    except requests.RequestException as e:
+        logger.warning(f'Fetching job {job_id} from replica {identity} failed: {e}')
+        raise ReplicaUnavailable(f'Replica {identity} running job {job_id} could not be reached') from e
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _chain(futures, sources):
+    for f, source in zip(futures, sources):
+        source.add_done_callback(lambda s, f=f: f.set_exception(s.exception()) if s.exception() is not None
+                                 else f.set_result(s.result()))
+
+
+def _forward_or_apply(owner, gcp_service_account, domino_compute_namespace, changes, futures):
+    identity, address = owner
+    try:
+        results = _forward(address, gcp_service_account, domino_compute_namespace, changes)
+    except scheduler.Overloaded as e:
+        metrics.IAM_FORWARDS.labels('shed').inc()
+        for f in futures:
+            f.set_exception(e)
+        return
+    except Exception as e:
+        # The owner is unreachable or failing: apply here instead, from a fresh policy read, guarded by the etag
+        logger.warning(f'Forwarding IAM updates for {gcp_service_account} to {identity} failed, '
+                       f'applying them locally: {e}')
+        metrics.IAM_FORWARDS.labels('fallback').inc()
+        try:
+            _chain(futures, gcp_utils.ensure_iam_policy_members(gcp_service_account, domino_compute_namespace,
+                                                                 changes))
+        except Exception as local_error:
+            for f in futures:
+                f.set_exception(local_error)
+        return
+    metrics.IAM_FORWARDS.labels('forwarded').inc()
+    for f, result in zip(futures, results):
+        if result is None:
+            f.set_result(None)
+        else:
+            f.set_exception(ForwardedUpdateError(result))
+
+
+_replicas = None
+_replicas_lock = threading.Lock()
+
+
+def sharding_enabled() -> bool:
+    return os.environ.get('SHARDING_ENABLED', 'false') == 'true'
+
+
+def replica_identity() -> str:
+    return os.environ.get('POD_NAME') or socket.gethostname()
+
+
+def start(platform_namespace, k8s_ctx: KubernetesContext = None) -> ReplicaSet:
+    """Joins the replica set configured from the environment, once per process."""
+    global _replicas
+    with _replicas_lock:
+        if _replicas is None:
+            address = os.environ.get('REPLICA_ADDRESS') or \
+                f'http://{_pod_ip()}:{int(os.environ.get("REPLICA_PORT", 6001))}'
+            _replicas = ReplicaSet(platform_namespace, replica_identity(), address,
+                                   k8s_ctx, lease_duration=int(os.environ.get('REPLICA_LEASE_SECONDS', 15)),
+                                   on_change=gcp_utils.invalidate_iam_policy_cache).start()
+        return _replicas
+
+
+def get_replicas() -> ReplicaSet:
+    return _replicas
+
+
+def is_local(key) -> bool:
+    """Whether this replica should do the background work for ``key`` (always, without sharding)."""
+    return _replicas is None or _replicas.is_local(key)
+
+
+def ensure_iam_policy_members(gcp_service_account, domino_compute_namespace, changes) -> list:
+    """``gcp_utils.ensure_iam_policy_members``, run by the process that owns the GSA; one future per change.
+
+    Without sharding, or in the owning process, the changes are applied here;
+    only the owning process checks them against the members it remembers,
+    the others leave the check to the batched policy update. Otherwise they
+    are sent to the owner. If the owner cannot be reached they are applied here.
+    """
+    owner = _replicas.owner(gcp_service_account) if _replicas is not None else None
+    if owner is None:
+        return gcp_utils.ensure_iam_policy_members(gcp_service_account, domino_compute_namespace, changes)
+    if owner[0] == _replicas.identity and _replicas.leader:
+        return gcp_utils.ensure_iam_policy_members(gcp_service_account, domino_compute_namespace, changes,
+                                                   cached=True)
+    futures = [Future() for _ in changes]
+    _forward_executor.submit(_forward_or_apply, owner, gcp_service_account, domino_compute_namespace,
+                             list(changes), futures)
+    return futures
+
+
+def release(namespace, k8s_ctx: KubernetesContext = None):
+    """Deletes this pod's Lease, handing its GSAs to the other replicas without waiting for it to expire."""
+    from kubernetes import client
+    from kubernetes.client.rest import ApiException
+    identity = replica_identity()
+    try:
+        client.CoordinationV1Api((k8s_ctx or get_k8s_context()).api_client).delete_namespaced_lease(
+            identity, namespace, _request_timeout=5)
+    except ApiException as e:
+        if e.status != 404:
+            raise
@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ``ttl`` seconds.
+
+    Thread safe. Lookups are counted as hits or misses (an expired entry is a
+    miss) in ``gcpwi_cache_lookups_total`` under ``name``. A ``ttl`` of 0
+    disables caching.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str = 'unnamed'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._hits = metrics.CACHE_LOOKUPS.labels(name, 'hit')
+        self._misses = metrics.CACHE_LOOKUPS.labels(name, 'miss')
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._hits.inc()
+                    return value
+                del self._data[key]
+            self._misses.inc()
+            return default
+
+    def put(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        with self._lock:
+            if key is _MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import atexit
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+
+import metrics
+import scheduler
+from configmap_cache import config_map_cache_enabled, get_config_map_cache
+from k8s_context import KubernetesContext, get_k8s_context
+
+if TYPE_CHECKING:
+    from kubernetes.client import V1ConfigMap
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING = 'domino-user-current-org-mapping'
+MAX_CONFLICT_RETRIES = 5
+
+
+def merge_patch_config_map(core_v1, name, namespace, body) -> V1ConfigMap:
+    """PATCH with a true JSON merge patch (the generated client would send a strategic merge patch)."""
+    with metrics.observe('kubernetes', 'merge_patch_namespaced_config_map'):
+        return scheduler.call_kubernetes(lambda timeout: core_v1.api_client.call_api(
+            '/api/v1/namespaces/{namespace}/configmaps/{name}', 'PATCH',
+            path_params={'namespace': namespace, 'name': name},
+            query_params=[],
+            header_params={'Accept': 'application/json', 'Content-Type': 'application/merge-patch+json'},
+            body=body,
+            response_type='V1ConfigMap',
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True,
+            _request_timeout=timeout))
+
+
+class UserOrgMappingStore:
+    """Domino user id -> default org, kept in one or more ConfigMaps.
+
+    ``set`` only queues the change; a background flusher sends all changes
+    queued for a ConfigMap every ``flush_interval`` seconds as one JSON merge
+    patch containing just the changed keys, guarded by the ConfigMap's
+    resourceVersion. Queued changes are visible to ``get`` right away.
+
+    With ``shards`` > 1 users are spread over ``<name>-0`` .. ``<name>-N-1`` by a
+    hash of the user id, keeping each ConfigMap well under the 1 MiB limit.
+    Saves go to the shard of the current layout only. Users not yet saved there
+    are looked up in the layouts of ``previous_shards`` (most recent first) and
+    finally in the unsharded ConfigMap.
+    """
+
+    def __init__(self, namespace, k8s_ctx: KubernetesContext = None, shards: int = None,
+                 flush_interval: float = None, name: str = CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING,
+                 previous_shards: list = None):
+        if k8s_ctx is None:
+            k8s_ctx = get_k8s_context()
+        if shards is None:
+            shards = int(os.environ.get('USER_ORG_MAPPING_SHARDS', 1))
+        if previous_shards is None:
+            previous_shards = [int(n) for n in os.environ.get('USER_ORG_MAPPING_PREVIOUS_SHARDS', '').split(',')
+                               if n.strip()]
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('USER_ORG_FLUSH_INTERVAL_SECONDS', 0.5))
+        self.namespace = namespace
+        self.name = name
+        self.shards = shards
+        self.previous_shards = previous_shards
+        self.flush_interval = flush_interval
+        self._k8s_ctx = k8s_ctx
+        self._core_v1 = k8s_ctx.core_v1
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def shard_name(self, user_id, shards=None) -> str:
+        if shards is None:
+            shards = self.shards
+        if shards <= 1:
+            return self.name
+        shard = int(hashlib.sha256(user_id.encode()).hexdigest()[:8], 16) % shards
+        return f'{self.name}-{shard}'
+
+    def config_map_names(self) -> list:
+        """Every ConfigMap users can be read from: the unsharded one and each shard of every layout."""
+        names = [self.name]
+        for shards in [self.shards] + self.previous_shards:
+            if shards > 1:
+                names += [f'{self.name}-{shard}' for shard in range(shards)]
+        return list(dict.fromkeys(names))
+
+    def _read(self, name) -> V1ConfigMap:
+        from kubernetes.client.rest import ApiException
+        try:
+            if config_map_cache_enabled():
+                return get_config_map_cache(self.namespace, self._k8s_ctx).get(name)
+            return self._core_v1.read_namespaced_config_map(name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def get(self, user_id):
+        name = self.shard_name(user_id)
+        with self._lock:
+            for changes in (self._pending.get(name), self._in_flight.get(name)):
+                if changes and user_id in changes:
+                    return changes[user_id][0]
+        layouts = [self.shards] + self.previous_shards + [1]
+        for config_map_name in dict.fromkeys(self.shard_name(user_id, shards) for shards in layouts):
+            config_map = self._read(config_map_name)
+            if config_map is not None and config_map.data and user_id in config_map.data:
+                return config_map.data[user_id]
+        return None
+
+    def set(self, user_id, org) -> Future:
+        """Queues the change; the future resolves once it has been written."""
+        future = Future()
+        name = self.shard_name(user_id)
+        with self._lock:
+            changes = self._pending.setdefault(name, {})
+            previous = changes.get(user_id)
+            changes[user_id] = (org, previous[1] + [future] if previous else [future])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='user-org-flush', daemon=True)
+                self._thread.start()
+        return future
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing user default org changes failed')
+
+    def flush(self):
+        """Writes all queued changes now."""
+        with self._flush_lock:
+            with self._lock:
+                batches, self._pending = self._pending, {}
+                self._in_flight = batches
+            try:
+                for name, changes in batches.items():
+                    futures = [f for _, fs in changes.values() for f in fs]
+                    try:
+                        patched = self._write(name, {user_id: org for user_id, (org, _) in changes.items()})
+                        if config_map_cache_enabled():
+                            get_config_map_cache(self.namespace, self._k8s_ctx).wait_for(
+                                name, patched.metadata.resource_version)
+                        for f in futures:
+                            f.set_result(True)
+                    except Exception as e:
+                        logger.exception(f'Writing {len(changes)} user default orgs to {name} failed')
+                        for f in futures:
+                            f.set_exception(e)
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+
+    def _write(self, name, data) -> V1ConfigMap:
+        from kubernetes.client import V1ConfigMap, V1ObjectMeta
+        from kubernetes.client.rest import ApiException
+        for attempt in range(MAX_CONFLICT_RETRIES + 1):
+            current = self._read(name) if attempt == 0 else self._read_uncached(name)
+            if current is None:
+                try:
+                    return self._core_v1.create_namespaced_config_map(
+                        self.namespace, V1ConfigMap(metadata=V1ObjectMeta(name=name), data=data))
+                except ApiException as e:
+                    if e.status != 409:
+                        raise
+                    continue
+            body = {'metadata': {'resourceVersion': current.metadata.resource_version}, 'data': data}
+            try:
+                return merge_patch_config_map(self._core_v1, name, self.namespace, body)
+            except ApiException as e:
+                if e.status != 409 or attempt == MAX_CONFLICT_RETRIES:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    def _read_uncached(self, name) -> V1ConfigMap:
+        from kubernetes.client.rest import ApiException
+        try:
+            return self._core_v1.read_namespaced_config_map(name, self.namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_user_org_mapping_store(namespace, k8s_ctx: KubernetesContext = None) -> UserOrgMappingStore:
+    store = _stores.get(namespace)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(namespace)
+            if store is None:
+                store = _stores[namespace] = UserOrgMappingStore(namespace, k8s_ctx)
+    return store
+
+
+def flush_all():
+    for store in list(_stores.values()):
+        store.flush()
+
+
+atexit.register(flush_all)
@@ -1,217 +1,535 @@
-from kubernetes import client, config
-from kubernetes.client import V1ObjectMeta, V1PodList
-from kubernetes.client.models.v1_service_account import V1ServiceAccount
-from kubernetes.client.models.v1_config_map import  V1ConfigMap
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import concurrent.futures
+import contextvars
+import hashlib
+import http.cookiejar
+import logging
 import requests
+import requests.adapters
 import os
+import random
+import time
 import gcp_utils
+import metrics
+import scheduler
+import sharding
+from k8s_context import KubernetesContext, get_k8s_context
+from configmap_cache import config_map_cache_enabled, get_config_map_cache
+from pipeline import Pipeline
+from pod_index import get_run_pod_index
+from ttl_cache import TTLCache
+from user_org_mapping import CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING, get_user_org_mapping_store
+import user_org_mapping
+
+if TYPE_CHECKING:
+    from kubernetes import client
+    from kubernetes.client import V1ConfigMap, V1ObjectMeta, V1ServiceAccount
 
 DEFAULT_PLATFORM_NS = 'domino-platform'
 DEFAULT_COMPUTE_NS = 'domino-compute'
 CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING = 'domino-org-gcp-svc-account-mapping'
-CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING = 'domino-user-current-org-mapping'
+GKE_GCP_SERVICE_ACCOUNT_ANNOTATION = 'iam.gke.io/gcp-service-account'
 
-def save_user_default_org(domino_user_id,domino_org,platform_ns: DEFAULT_PLATFORM_NS):
+logger = logging.getLogger("gcpworkloadidentity")
 
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    domino_user_to_org_mapping: V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING,
-                                                                     platform_ns)
-    if not domino_user_to_org_mapping.data:
-        domino_user_to_org_mapping.data = {}
-    domino_user_to_org_mapping.data[domino_user_id] = domino_org
-    v1.patch_namespaced_config_map(CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING,
-                                                                     platform_ns,domino_user_to_org_mapping.to_dict())
-
-def get_user_default_org(domino_api_key,platform_ns: DEFAULT_PLATFORM_NS):
-    domino_user_id = get_user_id(domino_api_key)
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    domino_user_to_org_mapping: V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING,
-                                                                     platform_ns)
-    if domino_user_to_org_mapping.data and \
-            domino_user_id in domino_user_to_org_mapping.data:
-        return domino_user_to_org_mapping.data[domino_user_id]
-    return None
 
-def annotate_pod_service_account(pod_svc_account,gcp_service_account,pod_namespace=DEFAULT_COMPUTE_NS):
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    svc_account:V1ServiceAccount = v1.read_namespaced_service_account(pod_svc_account,pod_namespace)
-    svc_meta:V1ObjectMeta = svc_account.metadata
-    if not svc_meta.annotations:
-        svc_meta.annotations = {}
-    if gcp_service_account:
-        svc_meta.annotations['iam.gke.io/gcp-service-account']=gcp_service_account
-    else:
-        svc_meta.annotations['iam.gke.io/gcp-service-account']=''
-    print(v1.patch_namespaced_service_account(pod_svc_account,pod_namespace,svc_account.to_dict()))
+def _core_v1(k8s_ctx: KubernetesContext = None) -> client.CoreV1Api:
+    if k8s_ctx is None:
+        k8s_ctx = get_k8s_context()
+    return k8s_ctx.core_v1
 
-def pod_svc_account_annotations(pod_svc_account,pod_namespace=DEFAULT_COMPUTE_NS):
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
+def _read_config_map(name,platform_ns,k8s_ctx: KubernetesContext = None) -> V1ConfigMap:
+    if config_map_cache_enabled():
+        return get_config_map_cache(platform_ns,k8s_ctx).get(name)
+    return _core_v1(k8s_ctx).read_namespaced_config_map(name,platform_ns)
+
+def _config_map_data(name,platform_ns,k8s_ctx: KubernetesContext = None) -> dict:
+    config_map = _read_config_map(name,platform_ns,k8s_ctx)
+    if config_map is None or not config_map.data:
+        return {}
+    # Cached objects are shared; callers get their own copy
+    return dict(config_map.data)
+
+def _config_map_written(name,platform_ns,patched: V1ConfigMap,k8s_ctx: KubernetesContext = None):
+    # The cache is only ever updated by its watch; wait until it has seen our write
+    if config_map_cache_enabled():
+        get_config_map_cache(platform_ns,k8s_ctx).wait_for(name,patched.metadata.resource_version)
+
+def save_user_default_org(domino_user_id,domino_org,platform_ns: DEFAULT_PLATFORM_NS,k8s_ctx: KubernetesContext = None):
+    # Queued and written in batches as a merge patch of just the changed users
+    return get_user_org_mapping_store(platform_ns,k8s_ctx).set(domino_user_id,domino_org)
+
+def annotate_pod_service_account(pod_svc_account,gcp_service_account,pod_namespace=DEFAULT_COMPUTE_NS,
+                                 k8s_ctx: KubernetesContext = None, resource_version=None):
+    v1 = _core_v1(k8s_ctx)
+    # Only the annotation is sent, so no read is needed and other fields are left alone
+    body = {'metadata': {'annotations': {GKE_GCP_SERVICE_ACCOUNT_ANNOTATION: gcp_service_account or ''}}}
+    if resource_version:
+        # Fails with 409 if the ServiceAccount changed since it was read at that version
+        body['metadata']['resourceVersion'] = resource_version
+    print(v1.patch_namespaced_service_account(pod_svc_account,pod_namespace,body))
+
+def pod_svc_account_annotations(pod_svc_account,pod_namespace=DEFAULT_COMPUTE_NS,k8s_ctx: KubernetesContext = None):
+    v1 = _core_v1(k8s_ctx)
     svc_account:V1ServiceAccount = v1.read_namespaced_service_account(pod_svc_account,pod_namespace)
     svc_meta:V1ObjectMeta = svc_account.metadata
     if not svc_meta.annotations:
         svc_meta.annotations = {}
     return svc_meta.annotations
 
-def get_orgs_gcp_service_accounts_mapping(platform_ns:DEFAULT_PLATFORM_NS):
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    org_gcp_svc_mapping:V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,
-                                                                    platform_ns)
-    return org_gcp_svc_mapping.data
-
-def update_orgs_gcp_service_accounts_mapping(domino_org,gcp_sa,platform_ns:DEFAULT_PLATFORM_NS):
+def get_orgs_gcp_service_accounts_mapping(platform_ns:DEFAULT_PLATFORM_NS,k8s_ctx: KubernetesContext = None):
+    return _config_map_data(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,platform_ns,k8s_ctx)
+
+def update_orgs_gcp_service_accounts_mapping(domino_org,gcp_sa,platform_ns:DEFAULT_PLATFORM_NS,
+                                             k8s_ctx: KubernetesContext = None):
+    return update_orgs_gcp_service_accounts_mappings({domino_org: gcp_sa},platform_ns,k8s_ctx)[domino_org]
+
+def update_orgs_gcp_service_accounts_mappings(mappings,platform_ns:DEFAULT_PLATFORM_NS,
+                                              k8s_ctx: KubernetesContext = None):
+    """Maps each org in ``mappings`` to its GSA; returns {org: (old_gcp_sa, gcp_sa)}.
+
+    Only the given orgs are sent, as a merge patch guarded by the resourceVersion
+    they were read at, so concurrent writers from other replicas are not overwritten.
+    """
+    from kubernetes.client.rest import ApiException
+    v1 = _core_v1(k8s_ctx)
+    for attempt in range(user_org_mapping.MAX_CONFLICT_RETRIES + 1):
+        org_gcp_svc_mapping:V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,
+                                                                        platform_ns)
+        data = org_gcp_svc_mapping.data or {}
+        updated = {domino_org: (data.get(domino_org), gcp_sa) for domino_org, gcp_sa in mappings.items()}
+        body = {'metadata': {'resourceVersion': org_gcp_svc_mapping.metadata.resource_version},
+                'data': dict(mappings)}
+        try:
+            patched = user_org_mapping.merge_patch_config_map(v1,CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,
+                                                              platform_ns,body)
+            break
+        except ApiException as e:
+            if e.status != 409 or attempt == user_org_mapping.MAX_CONFLICT_RETRIES:
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    _config_map_written(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,platform_ns,patched,k8s_ctx)
+    return updated
+
+def remove_service_account(domino_api_key,run_id,pod_namespace=DEFAULT_COMPUTE_NS,k8s_ctx: KubernetesContext = None):
+    return _single_run(_reset_runs(domino_api_key,[run_id],pod_namespace,k8s_ctx))
+
+def assume_service_account(domino_api_key,run_id,domino_org,pod_namespace=DEFAULT_COMPUTE_NS,
+                           platform_namespace=DEFAULT_PLATFORM_NS,k8s_ctx: KubernetesContext = None):
+    """Moves the run to the org's GSA, with the same outcome as removing the old GSA then applying the new one.
+
+    The desired GSA is compared with the ServiceAccount annotation and the IAM
+    members, and only the differences are written: nothing when the run already
+    has the GSA, otherwise one IAM remove and/or add and one annotation patch.
+    Independent lookups run concurrently.
+    """
+    return _single_run(_assume_runs(domino_api_key,[(run_id,domino_org)],pod_namespace,platform_namespace,k8s_ctx))
+
+def assume_service_accounts(domino_api_key,runs,pod_namespace=DEFAULT_COMPUTE_NS,
+                            platform_namespace=DEFAULT_PLATFORM_NS,k8s_ctx: KubernetesContext = None):
+    """assume_service_account for each (run_id, domino_org) in ``runs``; returns (status, message) per run.
+
+    The user, org and mapping lookups are made once for the batch and the IAM
+    changes for each GSA are written in a single policy update.
+    """
+    return _batch_results(_assume_runs(domino_api_key,runs,pod_namespace,platform_namespace,k8s_ctx))
+
+def remove_service_accounts(domino_api_key,run_ids,pod_namespace=DEFAULT_COMPUTE_NS,
+                            k8s_ctx: KubernetesContext = None):
+    """remove_service_account for each run id, with one policy update per GSA; returns (status, message) per run."""
+    return _batch_results(_reset_runs(domino_api_key,run_ids,pod_namespace,k8s_ctx))
+
+def _single_run(results):
+    result, = results
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def _batch_results(results):
+    return [(False, f'Error: {r}') if isinstance(r, Exception) else r for r in results]
+
+def _target_gcp_service_account(org_name,user_orgs,orgs_map):
+    # (status, message, GSA to bind); a failed assume still leaves the run without a GSA, as before
+    if not org_name:
+        return True, f'No org passed.', None
+    if not org_name in user_orgs:
+        return False,f'User does not belong to org {org_name}', None
+    if not org_name in orgs_map:
+        return False,'Domino Org Not Mapped to GCP Service Account', None
+    if not orgs_map[org_name]:
+        return False, f'Unknown error, gcp_service_account not found', None
+    return True, f'User now assumes the GCP Service Account {orgs_map[org_name]}', orgs_map[org_name]
+
+def _validate_targets(domino_api_key,org_names,user_orgs,orgs_map):
+    user_orgs = _user_orgs_including(domino_api_key,user_orgs,org_names)
+    return [(org_name, _target_gcp_service_account(org_name,user_orgs,orgs_map)) for org_name in org_names]
+
+def _run_service_accounts(p: Pipeline,domino_api_key,run_ids,pod_namespace,k8s_ctx,user_id):
+    # Per run, a future of (pod service account, its GSA annotation or None when not annotated)
+    def lookup(run_id):
+        pod_sa = get_pod_service_account(domino_api_key,run_id,pod_namespace,k8s_ctx)
+        if not pod_sa:
+            return None, None
+        return pod_sa, pod_svc_account_annotations(pod_sa,pod_namespace,k8s_ctx).get(GKE_GCP_SERVICE_ACCOUNT_ANNOTATION)
+    return [p.stage('pod_lookup', lambda _, run_id=run_id: lookup(run_id), user_id) for run_id in run_ids]
+
+def _wait_exception(f):
+    """The future's exception, or DeadlineExceeded if the request deadline passes before it is done."""
     try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    org_gcp_svc_mapping:V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,
-                                                                    platform_ns)
-    if not org_gcp_svc_mapping.data:
-        org_gcp_svc_mapping.data = {}
-    old_gcp_sa =  org_gcp_svc_mapping.data[domino_org]
-    org_gcp_svc_mapping.data[domino_org] = gcp_sa
-    v1.patch_namespaced_config_map(CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING,
-                                   platform_ns, org_gcp_svc_mapping.to_dict())
-    return old_gcp_sa, gcp_sa
-
-def apply_service_account(domino_api_key,run_id,domino_org,pod_namespace=DEFAULT_COMPUTE_NS,
-                                                         platform_namespace=DEFAULT_PLATFORM_NS):
-    orgs_gcp_service_accounts_map = get_orgs_gcp_service_accounts_mapping(platform_namespace)
-    if not domino_org:
-        return True, f'No org passed.'
-
-    if not org_belongs_to_user(domino_api_key,domino_org):
-        return False,f'User does not belong to org {domino_org}'
-
-    if not domino_org in orgs_gcp_service_accounts_map:
-        return False,'Domino Org Not Mapped to GCP Service Account'
-    else:
-        gcp_service_account = orgs_gcp_service_accounts_map[domino_org]
-
-    if gcp_service_account:
-        domino_user_id = get_user_id(domino_api_key)
-        pod_service_account = get_pod_service_account(domino_api_key,run_id,pod_namespace)
-        gcp_utils.add_iam_policy_binding(gcp_service_account, pod_namespace,pod_service_account)
-        annotate_pod_service_account(pod_service_account,gcp_service_account,pod_namespace)
-        save_user_default_org(domino_user_id,domino_org,platform_namespace)
-        return True, f'User now assumes the GCP Service Account {gcp_service_account}'
-    else:
-        return False, f'Unknown error, gcp_service_account not found'
-
-def remove_service_account(domino_api_key,run_id,pod_namespace=DEFAULT_COMPUTE_NS):
-    pod_service_account = get_pod_service_account(domino_api_key,run_id,pod_namespace)
-
-    if pod_service_account:
-        annotations = pod_svc_account_annotations(pod_service_account,pod_namespace)
-        if 'iam.gke.io/gcp-service-account' in annotations:
-            gcp_service_account = annotations['iam.gke.io/gcp-service-account']
-            if gcp_service_account:
-                gcp_utils.remove_iam_policy_binding(pod_service_account, gcp_service_account, pod_namespace)
-                annotate_pod_service_account(pod_service_account,None,pod_namespace)
-            return True, f'GCP Service Account Workload Identity Removed'
+        return f.exception(timeout=scheduler.remaining())
+    except concurrent.futures.TimeoutError:
+        return scheduler.DeadlineExceeded('Request deadline passed waiting for the workload identity update')
+
+def _nth(update,n):
+    """A future of the ``n``th future that ``update`` resolves to."""
+    f = concurrent.futures.Future()
+    def inner_done(inner):
+        if inner.exception() is not None:
+            f.set_exception(inner.exception())
         else:
-            return False, f'GCP Service Account Workload Identity Could Not Be Removed. Possibly not a owner or no GSA mapped to Pod'
-    return False, f'Cannot find Pod. Possibly not a owner'
+            f.set_result(inner.result())
+    def update_done(update):
+        if update.exception() is not None:
+            f.set_exception(update.exception())
+        else:
+            update.result()[n].add_done_callback(inner_done)
+    update.add_done_callback(update_done)
+    return f
 
-def get_pod_service_account(domino_api_key,run_id,pod_namespace=DEFAULT_COMPUTE_NS):
-    user_id = get_user_id(domino_api_key)
+def _settled(f):
+    """A future of ``f``'s exception, or None, once ``f`` is done."""
+    settled = concurrent.futures.Future()
+    f.add_done_callback(lambda f: settled.set_result(f.exception()))
+    return settled
+
+def _resolved():
+    f = concurrent.futures.Future()
+    f.set_result(None)
+    return f
+
+def _remove_members(gcp_service_account,pod_namespace,pod_sas,errors):
+    # Runs whose annotation failed still use this GSA and keep their member; the annotation reports the error
+    moved = [pod_sa for pod_sa, error in zip(pod_sas, errors) if error is None]
+    futures = iter(sharding.ensure_iam_policy_members(gcp_service_account,pod_namespace,
+                                                      [(pod_sa, False) for pod_sa in moved]) if moved else [])
+    return [next(futures) if error is None else _resolved() for error in errors]
+
+def _reconcile_runs(p: Pipeline,plan,pod_namespace,k8s_ctx,resource_versions=None):
+    """Moves each (pod_sa, current GSA, desired GSA) in ``plan`` to its desired GSA with the fewest writes.
+
+    The members each GSA should and should not have are handed to the replica
+    owning it, which writes only those not already in its policy, all in one
+    update per GSA. Each run is moved in three steps, so it always has a GSA
+    it can use: its member is added to the new GSA, its ServiceAccount is
+    annotated, and only then is its member removed from the old GSA. A run
+    whose add or annotation fails keeps its old GSA. With ``resource_versions``
+    each annotation is only written if the ServiceAccount is still at that
+    version. Returns, per run, None or the exception its writes raised.
+    """
+    adds, removes = {}, {}
+    for i, (pod_sa, current, desired) in enumerate(plan):
+        if desired:
+            adds.setdefault(desired, []).append((i, pod_sa))
+        if current and current != desired:
+            removes.setdefault(current, []).append((i, pod_sa))
+    pending = [[] for _ in plan]
+    added = [[] for _ in plan]
+    for gcp_service_account, runs in adds.items():
+        update = p.stage('iam_update', lambda gsa=gcp_service_account, runs=runs:
+                         sharding.ensure_iam_policy_members(gsa,pod_namespace,[(pod_sa, True) for _, pod_sa in runs]))
+        for n, (i, _) in enumerate(runs):
+            added[i].append(_nth(update,n))
+            pending[i].append(added[i][-1])
+    annotated = [None] * len(plan)
+    for i, (pod_sa, current, desired) in enumerate(plan):
+        if pod_sa and (current or None) != desired:
+            version = resource_versions[i] if resource_versions else None
+            annotated[i] = p.stage('annotate', lambda *_, pod_sa=pod_sa, desired=desired, version=version:
+                                   annotate_pod_service_account(pod_sa,desired,pod_namespace,k8s_ctx,version),
+                                   *added[i])
+            pending[i].append(annotated[i])
+    for gcp_service_account, runs in removes.items():
+        update = p.stage('iam_update', lambda *errors, gsa=gcp_service_account, runs=runs:
+                         _remove_members(gsa,pod_namespace,[pod_sa for _, pod_sa in runs],errors),
+                         *[_settled(annotated[i]) for i, _ in runs])
+        for n, (i, _) in enumerate(runs):
+            pending[i].append(_nth(update,n))
+    errors = []
+    for futures in pending:
+        exceptions = [_wait_exception(f) for f in futures]
+        errors.append(next((e for e in exceptions if e is not None), None))
+    return errors
+
+def _assume_runs(domino_api_key,runs,pod_namespace,platform_namespace,k8s_ctx):
+    p = Pipeline(f'assume_service_account {len(runs)} run(s)')
+    user_id = p.stage('principal', lambda: get_user_id(domino_api_key))
+    orgs = p.stage('orgs', lambda: get_user_orgs(domino_api_key))
+    orgs_gcp_service_accounts_map = p.stage('org_mapping',
+                                            lambda: get_orgs_gcp_service_accounts_mapping(platform_namespace,k8s_ctx))
+    default_org = p.stage('default_org',
+                          lambda *_: None if all(org for _, org in runs) else
+                          get_user_default_org(domino_api_key,platform_namespace,k8s_ctx),
+                          user_id, orgs)
+    targets = p.stage('validate',
+                      lambda default, user_orgs, orgs_map: _validate_targets(domino_api_key,
+                                                                             [org or default for _, org in runs],
+                                                                             user_orgs,orgs_map),
+                      default_org, orgs, orgs_gcp_service_accounts_map)
+    service_accounts = _run_service_accounts(p,domino_api_key,[run_id for run_id, _ in runs],pod_namespace,
+                                             k8s_ctx,user_id)
+    try:
+        results, plan, orgs_assumed = [], [], []
+        for (org_name, (status, message, gcp_service_account)), f in zip(targets.result(), service_accounts):
+            if f.exception():
+                results.append(f.exception())
+                continue
+            pod_sa, current = f.result()
+            if gcp_service_account and not pod_sa:
+                results.append((False, f'Cannot find Pod. Possibly not a owner'))
+                continue
+            results.append((status, message))
+            if pod_sa:
+                plan.append((len(results) - 1, (pod_sa, current, gcp_service_account), org_name))
+        errors = _reconcile_runs(p,[run for _, run, _ in plan],pod_namespace,k8s_ctx)
+        for (i, (_, _, gcp_service_account), org_name), error in zip(plan, errors):
+            if error is not None:
+                results[i] = error
+            elif gcp_service_account:
+                orgs_assumed.append(org_name)
+        domino_user_id = user_id.result()
+        if orgs_assumed and get_user_org_mapping_store(platform_namespace,k8s_ctx).get(domino_user_id) != orgs_assumed[-1]:
+            save_user_default_org(domino_user_id,orgs_assumed[-1],platform_namespace,k8s_ctx)
+        return results
+    finally:
+        p.log_timings()
+
+def _reset_runs(domino_api_key,run_ids,pod_namespace,k8s_ctx):
+    p = Pipeline(f'remove_service_account {len(run_ids)} run(s)')
+    user_id = p.stage('principal', lambda: get_user_id(domino_api_key))
+    service_accounts = _run_service_accounts(p,domino_api_key,run_ids,pod_namespace,k8s_ctx,user_id)
+    try:
+        results, plan = [], []
+        for f in service_accounts:
+            if f.exception():
+                results.append(f.exception())
+                continue
+            pod_sa, current = f.result()
+            if not pod_sa:
+                results.append((False, f'Cannot find Pod. Possibly not a owner'))
+            elif current is None:
+                results.append((False, f'GCP Service Account Workload Identity Could Not Be Removed. '
+                                       f'Possibly not a owner or no GSA mapped to Pod'))
+            else:
+                results.append((True, f'GCP Service Account Workload Identity Removed'))
+                plan.append((len(results) - 1, (pod_sa, current, None)))
+        errors = _reconcile_runs(p,[run for _, run in plan],pod_namespace,k8s_ctx)
+        for (i, _), error in zip(plan, errors):
+            if error is not None:
+                results[i] = error
+        return results
+    finally:
+        p.log_timings()
+
+def prewarm_service_accounts(runs,pod_namespace,platform_namespace,k8s_ctx: KubernetesContext = None):
+    """Gives each new run [(starting user id, pod service account)] the GSA of its user's stored default org.
+
+    Runs whose service account already has a GSA, and users without a default
+    org, are left alone. The annotation is only written if the ServiceAccount
+    has not changed since it was read, so a run assumed in the meantime keeps
+    the GSA it was given; the member added for it is then removed again.
+    Returns, per run, the GSA applied, None if skipped, or the exception that
+    prevented it.
+    """
+    from kubernetes.client.rest import ApiException
+    p = Pipeline(f'prewarm {len(runs)} run(s)')
+    orgs_gcp_service_accounts_map = p.stage('org_mapping',
+                                            lambda: get_orgs_gcp_service_accounts_mapping(platform_namespace,k8s_ctx))
+    service_accounts = [p.stage('pod_lookup', lambda pod_sa=pod_sa: _core_v1(k8s_ctx).read_namespaced_service_account(
+                            pod_sa,pod_namespace).metadata)
+                        for _, pod_sa in runs]
+    store = get_user_org_mapping_store(platform_namespace,k8s_ctx)
     try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    podLst:V1PodList = v1.list_namespaced_pod(pod_namespace)
-
-    for p in podLst.items:
-        pod:V1PodList = p
-        m:V1ObjectMeta = pod.metadata
-        metadata = m.to_dict()
-
-        if metadata['labels'] and 'dominodatalab.com/execution-id' in metadata['labels'].keys():
-            execution_id = metadata['labels']['dominodatalab.com/execution-id']
-            if execution_id==run_id:
-                pod_user_id = metadata['labels']['dominodatalab.com/starting-user-id']
-                if pod_user_id==user_id:
-                    return p.spec.service_account
+        results, plan = [], []
+        for (user_id, pod_sa), metadata in zip(runs, service_accounts):
+            org = store.get(user_id) if user_id else None
+            gcp_service_account = orgs_gcp_service_accounts_map.result().get(org) if org else None
+            if metadata.exception():
+                results.append(metadata.exception())
+            elif not gcp_service_account or (metadata.result().annotations or {}).get(GKE_GCP_SERVICE_ACCOUNT_ANNOTATION):
+                results.append(None)
+            else:
+                results.append(gcp_service_account)
+                plan.append((len(results) - 1, (pod_sa, None, gcp_service_account),
+                             metadata.result().resource_version))
+        errors = _reconcile_runs(p,[run for _, run, _ in plan],pod_namespace,k8s_ctx,
+                                 [version for _, _, version in plan])
+        superseded = {}
+        for (i, (pod_sa, _, gcp_service_account), _), error in zip(plan, errors):
+            if isinstance(error, ApiException) and error.status == 409:
+                results[i] = None
+                superseded.setdefault(gcp_service_account, []).append(pod_sa)
+            elif error is not None:
+                results[i] = error
+        for gcp_service_account, pod_sas in superseded.items():
+            _drop_superseded(gcp_service_account,pod_sas,pod_namespace,k8s_ctx)
+        return results
+    finally:
+        p.log_timings()
+
+def _drop_superseded(gcp_service_account,pod_sas,pod_namespace,k8s_ctx):
+    # The runs were assumed while being pre-warmed; the member added for them is stray unless they now use this GSA
+    stray = [pod_sa for pod_sa in pod_sas
+             if pod_svc_account_annotations(pod_sa,pod_namespace,k8s_ctx).get(GKE_GCP_SERVICE_ACCOUNT_ANNOTATION)
+             != gcp_service_account]
+    logger.info(f'Pre-warming {len(pod_sas)} runs lost to concurrent changes, removing {len(stray)} members '
+                f'from {gcp_service_account}')
+    for f in sharding.ensure_iam_policy_members(gcp_service_account,pod_namespace,[(pod_sa, False) for pod_sa in stray]):
+        _wait_exception(f)
+
+def get_pod_service_account(domino_api_key,run_id,pod_namespace=DEFAULT_COMPUTE_NS,k8s_ctx: KubernetesContext = None):
+    user_id = get_user_id(domino_api_key)
+    # An invalid key has no user id, and must not match pods that have none either
+    if not user_id:
+        return None
+    for pod_user_id, pod_service_account in get_run_pod_index(pod_namespace,k8s_ctx).lookup(run_id):
+        if pod_user_id==user_id:
+            return pod_service_account
     return None
 
 def org_belongs_to_user(domino_api_key,org_name):
-    orgs = get_user_orgs(domino_api_key)
-    if org_name in orgs:
-        return True
-    return False
+    return org_name in _user_orgs_including(domino_api_key,get_user_orgs(domino_api_key),[org_name])
 
-def is_user_admin(domino_api_key):
-    domino_host = os.environ.get('DOMINO_USER_HOST','http://nucleus-frontend.domino-platform:80')
-    resp = requests.get(f'{domino_host}/v4/auth/principal',
-                 headers={'X-Domino-Api-Key':domino_api_key})
-    if(resp.status_code==200):
-        return "ActAsProjectAdmin" in resp.json()['allowedSystemOperations']
+def _user_orgs_including(domino_api_key,user_orgs,org_names) -> set:
+    # The user's orgs as a set; refetched once if it misses any of org_names, as the cached
+    # list may predate the user joining an org
+    user_orgs = set(user_orgs)
+    if any(org_name and org_name not in user_orgs for org_name in org_names):
+        _invalidate_lookup(_orgs_cache, domino_api_key)
+        user_orgs = set(get_user_orgs(domino_api_key))
+    return user_orgs
 
-def get_user_id(domino_api_key):
-    domino_host = os.environ.get('DOMINO_USER_HOST','http://nucleus-frontend.domino-platform:80')
-    resp = requests.get(f'{domino_host}/v4/auth/principal',
-                 headers={'X-Domino-Api-Key':domino_api_key})
-    if(resp.status_code==200):
-        return resp.json()['canonicalId']
+def _domino_host():
+    return os.environ.get('DOMINO_USER_HOST','http://nucleus-frontend.domino-platform:80')
 
-def get_user_orgs(domino_api_key):
-    domino_host = os.environ.get('DOMINO_USER_HOST','http://nucleus-frontend.domino-platform:80')
+def _new_domino_session() -> requests.Session:
+    session = requests.Session()
+    # The session is shared by all callers: never replay a cookie set for one of them on another's request
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    pool_size = int(os.environ.get('DOMINO_CONNECTION_POOL_MAXSIZE', 16))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_domino_session = _new_domino_session()
+
+_principal_cache = TTLCache(int(os.environ.get('PRINCIPAL_CACHE_MAXSIZE', 1024)),
+                            float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', 30)), 'principal')
+_orgs_cache = TTLCache(int(os.environ.get('PRINCIPAL_CACHE_MAXSIZE', 1024)),
+                       float(os.environ.get('ORGS_CACHE_TTL_SECONDS', 30)), 'orgs')
+
+# Lookups already made during the current request, keyed like the caches
+_request_memo = contextvars.ContextVar('domino_request_memo', default=None)
+
+def begin_request_scope():
+    return _request_memo.set({})
 
-    url = f'{domino_host}/api/organizations/v1/organizations'
+def end_request_scope(token):
+    _request_memo.reset(token)
 
-    resp = requests.get(url,
-                 headers={'X-Domino-Api-Key':domino_api_key})
+def _api_key_hash(domino_api_key):
+    # Never keep raw API keys in memory longer than the request
+    return hashlib.sha256(domino_api_key.encode()).hexdigest()
+
+def _cached_lookup(cache: TTLCache, domino_api_key, fetch):
+    key = _api_key_hash(domino_api_key)
+    memo = _request_memo.get()
+    if memo is not None and (id(cache), key) in memo:
+        return memo[(id(cache), key)]
+    value = cache.get(key)
+    if value is None:
+        value = fetch(domino_api_key)
+        if value is not None:
+            cache.put(key, value)
+    if memo is not None and value is not None:
+        memo[(id(cache), key)] = value
+    return value
+
+def _invalidate_lookup(cache: TTLCache, domino_api_key):
+    key = _api_key_hash(domino_api_key)
+    cache.invalidate(key)
+    memo = _request_memo.get()
+    if memo is not None:
+        memo.pop((id(cache), key), None)
+
+def invalidate_principal_cache(domino_api_key=None):
+    if domino_api_key is None:
+        _principal_cache.invalidate()
+        _orgs_cache.invalidate()
+        memo = _request_memo.get()
+        if memo is not None:
+            memo.clear()
+    else:
+        _invalidate_lookup(_principal_cache, domino_api_key)
+        _invalidate_lookup(_orgs_cache, domino_api_key)
+
+def _domino_retryable(error, resp):
+    if error is not None:
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return scheduler.retryable_status(resp.status_code)
+
+def _domino_get(url, domino_api_key) -> requests.Response:
+    return scheduler.domino.call(lambda timeout: _domino_session.get(url, headers={'X-Domino-Api-Key':domino_api_key},
+                                                                     timeout=timeout),
+                                 _domino_retryable)
+
+@metrics.timed('domino', 'get_user_id', failed=lambda principal: principal is None)
+def _fetch_principal(domino_api_key):
+    resp = _domino_get(f'{_domino_host()}/v4/auth/principal',domino_api_key)
+    if(resp.status_code==200):
+        return resp.json()
+
+@metrics.timed('domino', 'get_user_orgs', failed=lambda orgs: orgs is None)
+def _fetch_user_orgs(domino_api_key):
+    url = f'{_domino_host()}/api/organizations/v1/organizations'
+
+    resp = _domino_get(url,domino_api_key)
 
     if(resp.status_code==200):
         data =  resp.json()
         lst = []
         for o in data['orgs']:
             lst.append(o['name'])
-    return lst
+        return lst
 
-def get_user_default_org(domino_api_key,platform_ns:DEFAULT_PLATFORM_NS):
+def is_user_admin(domino_api_key):
+    principal = _cached_lookup(_principal_cache, domino_api_key, _fetch_principal)
+    if principal:
+        return "ActAsProjectAdmin" in principal['allowedSystemOperations']
+
+def get_user_id(domino_api_key):
+    principal = _cached_lookup(_principal_cache, domino_api_key, _fetch_principal)
+    if principal:
+        return principal['canonicalId']
+
+def get_user_orgs(domino_api_key):
+    orgs = _cached_lookup(_orgs_cache, domino_api_key, _fetch_user_orgs)
+    if orgs is None:
+        return []
+    return orgs
+
+def drain():
+    # Called on shutdown: write everything that is still queued
+    gcp_utils.shutdown_policy_updates()
+    user_org_mapping.flush_all()
+
+def get_user_default_org(domino_api_key,platform_ns:DEFAULT_PLATFORM_NS,k8s_ctx: KubernetesContext = None):
     orgs = get_user_orgs(domino_api_key)
     user_id = get_user_id(domino_api_key)
-    try:
-        config.load_incluster_config()
-    except:
-        print("Loading local k8s config")
-        config.load_kube_config()
-    v1 = client.CoreV1Api()
-    user_current_org_mapping:V1ConfigMap = v1.read_namespaced_config_map(CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING,
-                                                                    platform_ns)
-
-    if user_current_org_mapping.data and \
-            user_id in user_current_org_mapping.data:
-        default_org = user_current_org_mapping.data[user_id]
+    default_org = get_user_org_mapping_store(platform_ns,k8s_ctx).get(user_id) if user_id else None
+
+    if default_org:
         if default_org in orgs:
             return default_org
     return None
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+
+import gcp_utils
+import sharding
+import utils
+from configmap_cache import config_map_cache_enabled, get_config_map_cache
+from k8s_context import get_k8s_context
+from pod_index import get_run_pod_index, pod_index_enabled
+from user_org_mapping import get_user_org_mapping_store
+
+logger = logging.getLogger("gcpworkloadidentity")
+
+MAX_BACKOFF_SECONDS = 10
+
+
+class Warmup:
+    """Does the work the first requests would otherwise pay for, in the background.
+
+    Each step (building the Kubernetes and IAM clients, syncing the ConfigMap
+    caches and the run pod index, joining the replica set) runs on its own thread and is retried with
+    backoff until it succeeds. ``ready`` is set once every step is done. Steps
+    not done after ``timeout`` seconds are logged and keep being retried; only
+    with ``give_up`` is ``ready`` set then regardless, as requests still work cold.
+    """
+
+    def __init__(self, pod_namespace, platform_namespace, timeout: float = 60, give_up: bool = False):
+        self.pod_namespace = pod_namespace
+        self.platform_namespace = platform_namespace
+        self.timeout = timeout
+        self.give_up = give_up
+        self.ready = threading.Event()
+        self.steps = {}
+        self._lock = threading.Lock()
+        self._started = None
+        self.seconds_to_ready = None
+
+    def _kubernetes_client(self):
+        get_k8s_context()
+
+    def _iam_client(self):
+        gcp_utils.get_iam_client().warm()
+
+    def _config_maps(self):
+        if not config_map_cache_enabled():
+            utils.get_orgs_gcp_service_accounts_mapping(self.platform_namespace)
+            return
+        names = [utils.CONFIG_MAP_ORG_TO_GCP_SVC_ACCOUNT_MAPPING]
+        names += get_user_org_mapping_store(self.platform_namespace).config_map_names()
+        if not get_config_map_cache(self.platform_namespace).warm(names, self._left()):
+            raise TimeoutError('ConfigMap watches have not synced')
+
+    def _pod_index(self):
+        if pod_index_enabled() and not get_run_pod_index(self.pod_namespace).informer.wait_for_sync(self._left()):
+            raise TimeoutError('Run pod watch has not synced')
+
+    def _replica(self):
+        if sharding.sharding_enabled() and \
+                not sharding.start(self.platform_namespace).informer.wait_for_sync(self._left()):
+            raise TimeoutError('Replica Lease watch has not synced')
+
+    def _left(self):
+        # Past the timeout a retried step still waits a while for its watch instead of spinning
+        return max(self._started + self.timeout - time.monotonic(), MAX_BACKOFF_SECONDS)
+
+    def start(self):
+        self._started = time.monotonic()
+        steps = {'kubernetes_client': self._kubernetes_client, 'iam_client': self._iam_client,
+                 'config_maps': self._config_maps, 'pod_index': self._pod_index, 'replica': self._replica}
+        self.steps = {name: {'done': False, 'seconds': None, 'error': None} for name in steps}
+        for name, fn in steps.items():
+            threading.Thread(target=self._run, args=(name, fn), name=f'warmup-{name}', daemon=True).start()
+        threading.Thread(target=self._give_up, name='warmup', daemon=True).start()
+        return self
+
+    def _run(self, name, fn):
+        backoff = 0.5
+        while not self.ready.is_set():
+            try:
+                fn()
+                break
+            except Exception as e:
+                logger.warning(f'Warm-up step {name} failed, retrying in {backoff}s: {e}')
+                with self._lock:
+                    self.steps[name]['error'] = str(e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+        else:
+            return
+        with self._lock:
+            self.steps[name].update(done=True, error=None, seconds=round(time.monotonic() - self._started, 3))
+            if all(step['done'] for step in self.steps.values()):
+                self._set_ready()
+
+    def _give_up(self):
+        if not self.ready.wait(self.timeout):
+            with self._lock:
+                if self.give_up:
+                    logger.warning(f'Warm-up not finished after {self.timeout}s, reporting ready anyway: {self.steps}')
+                    self._set_ready()
+                else:
+                    logger.error(f'Warm-up not finished after {self.timeout}s, still not ready: {self.steps}')
+
+    def _set_ready(self):
+        if not self.ready.is_set():
+            self.seconds_to_ready = round(time.monotonic() - self._started, 3)
+            logger.info(f'Warm-up finished in {self.seconds_to_ready}s')
+            self.ready.set()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'ready': self.ready.is_set(), 'seconds_to_ready': self.seconds_to_ready,
+                    'pending': [name for name, step in self.steps.items() if not step['done']],
+                    'steps': {name: dict(step) for name, step in self.steps.items()}}
+
+
+_warmup = None
+_warmup_lock = threading.Lock()
+
+
+def start() -> Warmup:
+    """Starts warming up this process, once."""
+    global _warmup
+    with _warmup_lock:
+        if _warmup is None:
+            _warmup = Warmup(os.environ.get('DEFAULT_COMPUTE_NS', utils.DEFAULT_COMPUTE_NS),
+                             os.environ.get('DEFAULT_PLATFORM_NS', utils.DEFAULT_PLATFORM_NS),
+                             timeout=float(os.environ.get('WARMUP_TIMEOUT_SECONDS', 60)),
+                             give_up=os.environ.get('WARMUP_GIVE_UP', 'false').lower() == 'true').start()
+        return _warmup
+
+
+def get_warmup() -> Warmup:
+    return _warmup
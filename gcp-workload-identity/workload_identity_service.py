@@ -1,16 +1,78 @@
-from flask import Flask, request, Response  # type: ignore
+from flask import Flask, request, Response, g, jsonify  # type: ignore
 import logging
 import os
+import time
+import iam_gc
+import jobs
+import metrics
+import prewarm
+import scheduler
+import sharding
 import utils
+import warmup
+from k8s_context import get_k8s_context
 
 
 DEFAULT_PLATFORM_NS = 'domino-platform'
 DEFAULT_COMPUTE_NS = 'domino-compute'
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 30))
+JOB_MAX_WAIT_SECONDS = float(os.environ.get('JOB_MAX_WAIT_SECONDS', 30))
 
 
 logger = logging.getLogger("gcpworkloadidentity")
 app = Flask(__name__)
 
+@app.before_first_request
+def start_background_tasks():
+    if iam_gc.iam_gc_enabled():
+        iam_gc.start_collector(os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS),
+                               os.environ.get('DEFAULT_PLATFORM_NS', DEFAULT_PLATFORM_NS),
+                               get_k8s_context())
+    if prewarm.prewarm_enabled():
+        prewarm.start_controller(os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS),
+                                 os.environ.get('DEFAULT_PLATFORM_NS', DEFAULT_PLATFORM_NS),
+                                 get_k8s_context())
+
+@app.before_request
+def begin_request_scope():
+    g.request_started = time.perf_counter()
+    g.request_scope = utils.begin_request_scope()
+    g.request_deadline = scheduler.start_deadline(REQUEST_DEADLINE_SECONDS)
+
+def _record_request(status):
+    # Label by route pattern, not path, to keep the number of series bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.record_request(route, request.method, status, time.perf_counter() - g.request_started)
+    g.request_recorded = True
+
+@app.after_request
+def record_request(response):
+    if 'request_started' in g:
+        _record_request(response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_scope(exc):
+    if 'request_started' in g and 'request_recorded' not in g:
+        _record_request(500)
+    if 'request_scope' in g:
+        utils.end_request_scope(g.request_scope)
+    if 'request_deadline' in g:
+        scheduler.end_deadline(g.request_deadline)
+
+@app.errorhandler(scheduler.Overloaded)
+def overloaded(e):
+    return Response(str(e), 503, headers={'Retry-After': str(e.retry_after)})
+
+@app.errorhandler(scheduler.DeadlineExceeded)
+def deadline_exceeded(e):
+    return Response(str(e), 504)
+
+@app.errorhandler(sharding.ReplicaUnavailable)
+def replica_unavailable(e):
+    return Response(str(e), 502)
+
 @app.route("/map_org_to_gcp_sa", methods=["POST"])
 def map_org_to_gcp_sa() -> object:
     platform_ns = os.environ.get('DEFAULT_PLATFORM_NS',DEFAULT_PLATFORM_NS)
@@ -34,7 +96,8 @@ def map_org_to_gcp_sa() -> object:
             return Response(
                 str('Pay load must contain a non-empty domino org and a not-empty svc_account'),
                 404)
-        old_gcp_sa, new_gcp_sa = utils.update_orgs_gcp_service_accounts_mapping(domino_org,gcp_sa,platform_ns)
+        old_gcp_sa, new_gcp_sa = utils.update_orgs_gcp_service_accounts_mapping(domino_org,gcp_sa,platform_ns,
+                                                                                 get_k8s_context())
         return Response(
             str(f'Domino Org {domino_org} mapping updated from GCP SA {old_gcp_sa} to {new_gcp_sa}'),
             200)
@@ -65,19 +128,20 @@ def apply_service_account() -> object:
     platform_ns = os.environ.get('DEFAULT_PLATFORM_NS',DEFAULT_PLATFORM_NS)
     compute_ns = os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS)
     domino_api_key = request.headers["X-Domino-Api-Key"]
+    k8s_ctx = get_k8s_context()
     payload = request.json
     run_id = payload['run_id']
     org = None
     if 'domino_org' in payload:
         org = payload['domino_org']
-    if not org:
-        org = utils.get_user_default_org(domino_api_key,platform_ns)
+    # An empty org resolves to the user's default org inside the pipeline
     logger.debug(f'Run Id {run_id}')
     logger.debug(f'Org Id {org}')
-    #First remove existing service account
-    status, message = utils.remove_service_account(domino_api_key, run_id, compute_ns)
-
-    status, message = utils.apply_service_account(domino_api_key,run_id,org,compute_ns,platform_ns)
+    if payload.get('async'):
+        return _submit_job('assume_service_account', domino_api_key, run_id,
+                           lambda: utils.assume_service_account(domino_api_key,run_id,org,compute_ns,platform_ns,k8s_ctx))
+    #Removes the existing service account, then applies the org's
+    status, message = utils.assume_service_account(domino_api_key,run_id,org,compute_ns,platform_ns,k8s_ctx)
     if status:
         return Response(
             str(message),
@@ -92,8 +156,13 @@ def remove_service_account() -> object:
     compute_ns = os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS)
     domino_api_key = request.headers["X-Domino-Api-Key"]
     payload = request.json
+    k8s_ctx = get_k8s_context()
+    if payload.get('async'):
+        run_id = payload['run_id']
+        return _submit_job('reset_service_account', domino_api_key, run_id,
+                           lambda: utils.remove_service_account(domino_api_key,run_id,compute_ns,k8s_ctx))
 
-    status, message = utils.remove_service_account(domino_api_key,payload['run_id'],compute_ns)
+    status, message = utils.remove_service_account(domino_api_key,payload['run_id'],compute_ns,k8s_ctx)
     if status:
         return Response(
             str(message),
@@ -103,23 +172,155 @@ def remove_service_account() -> object:
             str(message),
             404)
 
+def _job_response(job, status_code):
+    body = {k: v for k, v in job.items() if k != 'user_id'}
+    return jsonify(body), status_code, {'Location': f'/jobs/{job["job_id"]}'}
+
+def _submit_job(kind, domino_api_key, run_id, fn):
+    # Check the caller before answering, so a bad key or run id is not only reported through the job
+    user_id = utils.get_user_id(domino_api_key)
+    if not user_id:
+        return Response(str('Not Authorized. Invalid Domino API key'), 403)
+    if not isinstance(run_id, str) or not run_id:
+        return Response(str('Invalid run_id'), 404)
+
+    def run():
+        scope = utils.begin_request_scope()
+        try:
+            return fn()
+        finally:
+            utils.end_request_scope(scope)
+    return _job_response(jobs.get_job_store().submit(kind, user_id, run_id, run), 202)
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id) -> object:
+    domino_api_key = request.headers["X-Domino-Api-Key"]
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), JOB_MAX_WAIT_SECONDS)
+    except ValueError:
+        return Response(str('wait must be a number of seconds'), 400)
+    user_id = utils.get_user_id(domino_api_key)
+    if not user_id:
+        return Response(str('Not Authorized. Invalid Domino API key'), 403)
+    store = jobs.get_job_store()
+    job = store.get(job_id)
+    if job is None:
+        # Started on another replica, which is asked for it over the internal port
+        job = sharding.fetch_job(jobs.replica_of(job_id), job_id, wait)
+    elif wait and job['state'] != jobs.DONE and job['user_id'] == user_id:
+        job = store.wait(job_id, wait) or job
+    # Another user's job is reported as missing
+    if job is None or job['user_id'] != user_id:
+        return Response(str(f'No job {job_id}'), 404)
+    return _job_response(job, 200 if job['state'] == jobs.DONE else 202)
+
+def _batch_items(payload, key):
+    items = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, Response(str(f'Pay load must contain a non-empty list {key}'), 404)
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, Response(str(f'At most {BATCH_MAX_ITEMS} {key} can be sent in one call'), 413)
+    return items, None
+
+def _batch_response(keys, key_name, results):
+    return jsonify({'results': [{key_name: k, 'status': status, 'message': message}
+                                for k, (status, message) in zip(keys, results)]})
+
+def _without_duplicates(keys, results):
+    # A run or org may only appear once per batch; later occurrences are rejected
+    seen = set()
+    for i, k in enumerate(keys):
+        if results[i] is None:
+            if k in seen:
+                results[i] = (False, 'Duplicate in batch')
+            seen.add(k)
+    return [i for i, r in enumerate(results) if r is None]
+
+@app.route("/map_orgs_to_gcp_sas", methods=["POST"])
+def map_orgs_to_gcp_sas() -> object:
+    platform_ns = os.environ.get('DEFAULT_PLATFORM_NS',DEFAULT_PLATFORM_NS)
+    domino_api_key = request.headers["X-Domino-Api-Key"]
+    if not utils.is_user_admin(domino_api_key):
+        return Response(
+            str('Not Authorized. Only a Domino Admin can map orgs to GCP SAs'),
+            403)
+    items, error = _batch_items(request.json, 'mappings')
+    if error:
+        return error
+    orgs = [item.get('domino_org') if isinstance(item, dict) else None for item in items]
+    results = [None if isinstance(org, str) and org and item.get('gcp_sa') else
+               (False, 'Mapping must contain a non-empty domino org and a not-empty svc_account')
+               for org, item in zip(orgs, items)]
+    valid = _without_duplicates(orgs, results)
+    if valid:
+        updated = utils.update_orgs_gcp_service_accounts_mappings({orgs[i]: items[i]['gcp_sa'] for i in valid},
+                                                                  platform_ns,get_k8s_context())
+        for i in valid:
+            old_gcp_sa, new_gcp_sa = updated[orgs[i]]
+            results[i] = (True, f'Domino Org {orgs[i]} mapping updated from GCP SA {old_gcp_sa} to {new_gcp_sa}')
+    return _batch_response(orgs, 'domino_org', results)
+
+@app.route("/assume_service_accounts", methods=["POST"])
+def apply_service_accounts() -> object:
+    platform_ns = os.environ.get('DEFAULT_PLATFORM_NS',DEFAULT_PLATFORM_NS)
+    compute_ns = os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS)
+    domino_api_key = request.headers["X-Domino-Api-Key"]
+    items, error = _batch_items(request.json, 'runs')
+    if error:
+        return error
+    run_ids = [item.get('run_id') if isinstance(item, dict) else None for item in items]
+    results = [None if isinstance(run_id, str) and run_id else (False, 'Run must contain a run_id')
+               for run_id in run_ids]
+    valid = _without_duplicates(run_ids, results)
+    runs = [(run_ids[i], items[i].get('domino_org')) for i in valid]
+    for i, result in zip(valid, utils.assume_service_accounts(domino_api_key,runs,compute_ns,platform_ns,
+                                                               get_k8s_context())):
+        results[i] = result
+    return _batch_response(run_ids, 'run_id', results)
+
+@app.route("/reset_service_accounts", methods=["DELETE"])
+def remove_service_accounts() -> object:
+    compute_ns = os.environ.get('DEFAULT_COMPUTE_NS', DEFAULT_COMPUTE_NS)
+    domino_api_key = request.headers["X-Domino-Api-Key"]
+    run_ids, error = _batch_items(request.json, 'run_ids')
+    if error:
+        return error
+    results = [None if isinstance(run_id, str) and run_id else (False, 'Invalid run_id') for run_id in run_ids]
+    valid = _without_duplicates(run_ids, results)
+    for i, result in zip(valid, utils.remove_service_accounts(domino_api_key,[run_ids[i] for i in valid],
+                                                               compute_ns,get_k8s_context())):
+        results[i] = result
+    return _batch_response(run_ids, 'run_id', results)
+
 @app.route("/get_my_orgs", methods=["GET"])
 def get_my_orgs() -> object:
     platform_ns = os.environ.get('DEFAULT_PLATFORM_NS', DEFAULT_PLATFORM_NS)
     domino_api_key = request.headers["X-Domino-Api-Key"]
     user_orgs = utils.get_user_orgs(domino_api_key)
 
-    orgs_to_service_accounts_map = utils.get_orgs_gcp_service_accounts_mapping(platform_ns)
+    orgs_to_service_accounts_map = utils.get_orgs_gcp_service_accounts_mapping(platform_ns,get_k8s_context())
     my_orgs = {}
     for org in user_orgs:
-        my_orgs[org] = orgs_to_service_accounts_map[org]
+        my_orgs[org] = orgs_to_service_accounts_map.get(org)
     return my_orgs
 
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics() -> object:
+    body, content_type = metrics.exposition()
+    return Response(body, 200, content_type=content_type)
+
+
 @app.route("/healthz")
 def alive():
     return "{'status': 'Healthy'}"
 
+@app.route("/readyz")
+def ready():
+    # Warm-up normally starts with the worker; starting it here covers any other way of serving the app
+    status = warmup.start().status()
+    return jsonify(status), 200 if status['ready'] else 503
+
 
 if __name__ == "__main__":
     lvl: str = logging.getLevelName(os.environ.get("LOG_LEVEL", "ERROR"))
@@ -130,19 +331,25 @@ if __name__ == "__main__":
 
     debug: bool = os.environ.get("FLASK_ENV") == "development"
     ssl_off = os.environ.get('SSL_OFF',"true")=="true"
-    port = 6000
-    if ssl_off:
+    port = int(os.environ.get('PORT', 6000))
+    if os.environ.get('SERVER_MODE', 'development') == 'production':
+        from server import ProductionServer
+        print(f'Running production server on port {port}')
+        ProductionServer(app, ssl_off, port).run()
+    elif ssl_off:
+        warmup.start()
         print(f'Running only http on port{port}')
         app.run(
             host=os.environ.get("FLASK_HOST", "0.0.0.0"),
-            port=6000,
+            port=port,
             debug=debug,
         )
     else:
+        warmup.start()
         print(f'Running on port{port}')
         app.run(
             host=os.environ.get("FLASK_HOST", "0.0.0.0"),
-            port=6000,
+            port=port,
             debug=debug,
             ssl_context=("/ssl/tls.crt", "/ssl/tls.key"),
         )
@@ -0,0 +1,157 @@
+"""Client for the workload identity service, for use inside Domino workspaces and jobs.
+
+    from gcp_identity_client import WorkloadIdentityClient
+
+    client = WorkloadIdentityClient()
+    print(client.my_orgs())
+    gcp_service_account = client.assume('org1')
+    seconds = client.wait_until_ready(gcp_service_account)
+
+The API key and run id default to DOMINO_USER_API_KEY and DOMINO_RUN_ID, and the service URL to
+GCP_WORKLOAD_IDENTITY_URL. Connections are kept alive between calls. Connection failures, 429s and
+502/503/504 responses are retried with full-jitter exponential backoff, honouring Retry-After.
+Assume and reset run as jobs on the service, so long updates do not hit client or proxy timeouts.
+"""
+import os
+import random
+import time
+
+import requests
+import requests.adapters
+
+DEFAULT_URL = 'http://gcpworkloadidentity-svc.domino-platform'
+METADATA_URL = 'http://169.254.169.254/computeMetadata/v1/instance/service-accounts/default'
+RETRYABLE_STATUS = (429, 502, 503, 504)
+
+
+class WorkloadIdentityError(Exception):
+    """The service refused or failed a call; ``status`` is the HTTP status, if any."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class WorkloadIdentityClient:
+    """Assume and reset the GCP service account of this run, and wait for GKE to hand out its credentials."""
+
+    def __init__(self, url: str = None, api_key: str = None, run_id: str = None, timeout: float = 30,
+                 max_retries: int = 4, backoff: float = 0.5, max_backoff: float = 10):
+        self.url = (url or os.environ.get('GCP_WORKLOAD_IDENTITY_URL', DEFAULT_URL)).rstrip('/')
+        self.api_key = api_key or os.environ.get('DOMINO_USER_API_KEY')
+        self.run_id = run_id or os.environ.get('DOMINO_RUN_ID')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+        self.session.headers['X-Domino-Api-Key'] = self.api_key or ''
+        # The metadata server is local, and is polled many times while waiting for credentials
+        self.metadata = requests.Session()
+        self.metadata.headers['Metadata-Flavor'] = 'Google'
+
+    def _request(self, method, path, **kwargs) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            try:
+                resp = self.session.request(method, f'{self.url}{path}', timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+                continue
+            if resp.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                break
+            retry_after = resp.headers.get('Retry-After')
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else delay)
+        if resp.status_code >= 400:
+            raise WorkloadIdentityError(resp.text, resp.status_code)
+        return resp
+
+    def _run_job(self, method, path, payload, timeout):
+        give_up_at = time.monotonic() + timeout
+        job = self._request(method, path, json=dict(payload, run_id=self.run_id, **{'async': True})).json()
+        while job['state'] != 'done':
+            left = give_up_at - time.monotonic()
+            if left <= 0:
+                raise WorkloadIdentityError(f'Job {job["job_id"]} not done after {timeout}s')
+            job = self._request('GET', f'/jobs/{job["job_id"]}',
+                                params={'wait': max(min(left, self.timeout - 5, 30), 0)}).json()
+        if not job['status']:
+            raise WorkloadIdentityError(job['message'])
+        return job['message']
+
+    def my_orgs(self) -> dict:
+        """{org: GCP service account, or None if the org is not mapped} for the orgs the user belongs to."""
+        return self._request('GET', '/get_my_orgs').json()
+
+    def assume(self, org, timeout: float = 120) -> str:
+        """Moves this run to the GCP service account of ``org`` and returns that account.
+
+        Returns once the service has updated the IAM policy and the Kubernetes
+        service account; GKE may take longer to hand out the new credentials,
+        see ``wait_until_ready``.
+        """
+        gcp_service_account = self.my_orgs().get(org)
+        if not gcp_service_account:
+            raise WorkloadIdentityError(f'Org {org} is not one of yours or not mapped to a GCP service account')
+        self._run_job('POST', '/assume_service_account', {'domino_org': org}, timeout)
+        return gcp_service_account
+
+    def reset(self, timeout: float = 120) -> str:
+        """Removes the GCP service account from this run; returns the service's message."""
+        return self._run_job('DELETE', '/reset_service_account', {}, timeout)
+
+    def current_service_account(self):
+        """The email the metadata server gives out for this pod, or None if it has none yet."""
+        try:
+            resp = self.metadata.get(f'{METADATA_URL}/email', timeout=2)
+        except (requests.ConnectionError, requests.Timeout):
+            return None
+        return resp.text.strip() if resp.status_code == 200 else None
+
+    def _token_available(self):
+        try:
+            return self.metadata.get(f'{METADATA_URL}/token', timeout=5).status_code == 200
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+
+    def _wait_for(self, ready, timeout, interval, max_interval):
+        start = time.monotonic()
+        while True:
+            if ready():
+                return time.monotonic() - start
+            if time.monotonic() - start + interval > timeout:
+                raise TimeoutError(f'Credentials not ready after {timeout}s, '
+                                   f'the metadata server gives out {self.current_service_account()}')
+            time.sleep(interval)
+            interval = min(interval * 1.5, max_interval)
+
+    def wait_until_ready(self, gcp_service_account, timeout: float = 120, interval: float = 0.1,
+                         max_interval: float = 2) -> float:
+        """Waits until the metadata server hands out tokens for ``gcp_service_account``; returns the seconds taken.
+
+        Polls the email endpoint, every ``interval`` seconds at first and backing
+        off to ``max_interval``, then checks that a token can be fetched.
+        Raises TimeoutError after ``timeout`` seconds.
+        """
+        return self._wait_for(lambda: self.current_service_account() == gcp_service_account and
+                              self._token_available(), timeout, interval, max_interval)
+
+    def wait_until_released(self, gcp_service_account, timeout: float = 120, interval: float = 0.1,
+                            max_interval: float = 2) -> float:
+        """Waits until the metadata server no longer hands out ``gcp_service_account``; returns the seconds taken."""
+        return self._wait_for(lambda: self.current_service_account() not in (gcp_service_account, None),
+                              timeout, interval, max_interval)
+
+    def close(self):
+        self.session.close()
+        self.metadata.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,12 +1,5 @@
-import requests
+from gcp_identity_client import WorkloadIdentityClient
 
-import os
-org = 'org4'
-url = 'http://gcpworkloadidentity-svc.gcp-aes4085-platform/get_my_orgs'
-headers = {           "X-Domino-Api-Key": os.environ['DOMINO_USER_API_KEY']
-          }
-print(headers)
-
-resp = requests.get(url,headers=headers)
-print(resp.status_code)
-print(resp.content)
\ No newline at end of file
+with WorkloadIdentityClient() as client:
+    for org, gcp_service_account in client.my_orgs().items():
+        print(f'{org}: {gcp_service_account}')
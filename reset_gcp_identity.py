@@ -1,16 +1,12 @@
-import requests
-import os
+import sys
 
-org = 'org1'
-url = 'http://gcpworkloadidentity-svc.gcp-aes4085-platform/reset_service_account'
-headers = {"Content-Type" : "application/json",
-           "X-Domino-Api-Key": os.environ['DOMINO_USER_API_KEY']
-          }
-print(headers)
-data = {
-    "run_id" : os.environ['DOMINO_RUN_ID']
-}
+from gcp_identity_client import WorkloadIdentityClient
 
-resp = requests.delete(url,headers=headers,json=data)
-print(resp.status_code)
-print(resp.content)
\ No newline at end of file
+# --wait: also wait until the metadata server no longer hands out the removed GCP service account
+wait = '--wait' in sys.argv
+
+with WorkloadIdentityClient() as client:
+    gcp_service_account = client.current_service_account()
+    print(client.reset())
+    if wait and gcp_service_account:
+        print(f'{gcp_service_account} released after {client.wait_until_released(gcp_service_account):.1f}s')
@@ -7,6 +7,7 @@ echo "USAGE: ./deploy.sh VERSION"
 image="${image:-quay.io/domino/gcpworkloadidentity}"
 platform_namespace="${platform_namespace:-domino-platform}"
 compute_namespace="${compute_namespace:-domino-compute}"
+replicas="${replicas:-1}"
 
 
 deployment_name="gcpworkloadidentity"
@@ -99,8 +100,22 @@ rules:
   - "configmaps"
   verbs:
   - "get"
+  - "list"
+  - "watch"
+  - "create"
   - "update"
   - "patch"
+- apiGroups:
+  - "coordination.k8s.io"
+  resources:
+  - "leases"
+  verbs:
+  - "get"
+  - "list"
+  - "watch"
+  - "create"
+  - "patch"
+  - "delete"
 ---
 kind: RoleBinding
 apiVersion: rbac.authorization.k8s.io/v1
@@ -187,7 +202,7 @@ metadata:
   labels:
     app: ${deployment_name}
 spec:
-  replicas: 1
+  replicas: ${replicas}
   selector:
     matchLabels:
       app: ${deployment_name}
@@ -200,6 +215,8 @@ spec:
     spec:
       serviceAccountName: ${deployment_name}
       automountServiceAccountToken: true
+      # Leaves room for GRACEFUL_TIMEOUT_SECONDS plus draining queued IAM updates
+      terminationGracePeriodSeconds: 60
       nodeSelector:
         dominodatalab.com/node-pool: platform
 
@@ -226,8 +243,20 @@ spec:
           value: ${GCP_REGION}
         - name: GCP_GKE_ID
           value: ${GCP_GKE_ID}
+        - name: SHARDING_ENABLED
+          value: "true"
+        - name: POD_NAME
+          valueFrom:
+            fieldRef:
+              fieldPath: metadata.name
+        - name: POD_IP
+          valueFrom:
+            fieldRef:
+              fieldPath: status.podIP
         ports:
         - containerPort: 6000
+        # IAM policy updates forwarded between replicas
+        - containerPort: 6001
         livenessProbe:
           httpGet:
             path: /healthz
@@ -238,10 +267,11 @@ spec:
           timeoutSeconds: 5
         readinessProbe:
           httpGet:
-            path: /healthz
+            path: /readyz
             port: 6000
             scheme: HTTP
-          initialDelaySeconds: 20
+          initialDelaySeconds: 1
+          periodSeconds: 2
           failureThreshold: 2
           timeoutSeconds: 5
         imagePullPolicy: Always
@@ -260,7 +290,7 @@ EOF
 # Wait for the app to actually be up before starting the webhook.
 let tries=1
 availreps=""
-while [[ ${tries} -lt 10 && "${availreps}" != "1" ]]; do
+while [[ ${tries} -lt 10 && "${availreps}" != "${replicas}" ]]; do
   echo "Checking deployment, try $tries"
   kubectl get deployment -n ${platform_namespace} ${deployment_name}
   availreps=$(kubectl get deployment -n ${platform_namespace} ${deployment_name} -o jsonpath='{.status.availableReplicas}')
@@ -288,7 +318,7 @@ spec:
   type: ClusterIP
 EOF
 
-if [[ ${availreps} != "1" ]]; then
+if [[ "${availreps}" != "${replicas}" ]]; then
   echo "Deployment never became available, exiting."
   exit 1
 fi
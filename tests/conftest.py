@@ -0,0 +1,44 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'gcp-workload-identity'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest  # noqa: E402
+from google.auth.credentials import AnonymousCredentials  # noqa: E402
+from kubernetes import client  # noqa: E402
+
+from fakes import FakeIam, FakeKubernetes  # noqa: E402
+import gcp_utils  # noqa: E402
+import k8s_context  # noqa: E402
+
+PROJECT = 'test-project'
+COMPUTE_NS = 'domino-compute'
+PLATFORM_NS = 'domino-platform'
+
+
+@pytest.fixture
+def fake_iam(monkeypatch):
+    with FakeIam() as fake:
+        monkeypatch.setenv('GCP_IAM_ENDPOINT', fake.url)
+        monkeypatch.setenv('GCP_PROJECT_ID', PROJECT)
+        monkeypatch.setattr(gcp_utils._iam_client, '_load_credentials', AnonymousCredentials)
+        gcp_utils._iam_client.reset()
+        gcp_utils.invalidate_iam_policy_cache()
+        yield fake
+        gcp_utils._iam_client.reset()
+        gcp_utils.invalidate_iam_policy_cache()
+
+
+@pytest.fixture
+def fake_k8s():
+    with FakeKubernetes() as fake:
+        yield fake
+
+
+@pytest.fixture
+def k8s_ctx(fake_k8s):
+    configuration = client.Configuration()
+    configuration.host = fake_k8s.url
+    return k8s_context.KubernetesContext(configuration)
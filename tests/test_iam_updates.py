@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import gcp_utils
+import sharding
+from conftest import COMPUTE_NS
+
+GSA = 'org1@test-project.iam.gserviceaccount.com'
+
+
+def _members(runs):
+    return {gcp_utils.workload_identity_member(COMPUTE_NS, f'run-{i}') for i in runs}
+
+
+def _run_concurrently(ensure, changes, workers=32):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [f for batch in pool.map(lambda change: ensure(GSA, COMPUTE_NS, [change]), changes) for f in batch]
+    done, _ = wait(futures, timeout=60)
+    assert len(done) == len(futures)
+    return [f.exception() for f in futures]
+
+
+def _seed(runs):
+    for f in gcp_utils.ensure_iam_policy_members(GSA, COMPUTE_NS, [(f'run-{i}', True) for i in runs]):
+        f.result(timeout=30)
+
+
+def test_concurrent_adds_and_removes(fake_iam):
+    _seed(range(50))
+    changes = [(f'run-{i}', True) for i in range(50, 100)] + [(f'run-{i}', False) for i in range(25)]
+    assert _run_concurrently(gcp_utils.ensure_iam_policy_members, changes) == [None] * len(changes)
+    assert set(fake_iam.members(GSA)) == _members(range(25, 100))
+    # Batching: far fewer policy writes than changes
+    assert fake_iam.requests['set_iam_policy'] < len(changes)
+
+
+def test_concurrent_changes_through_sharding_without_replicas(fake_iam):
+    changes = [(f'run-{i}', i % 3 != 0) for i in range(60)]
+    assert _run_concurrently(sharding.ensure_iam_policy_members, changes) == [None] * len(changes)
+    assert set(fake_iam.members(GSA)) == _members(i for i in range(60) if i % 3 != 0)
+
+
+def test_changes_that_already_hold_are_not_written(fake_iam):
+    _seed(range(10))
+    fake_iam.reset_counters()
+    changes = [(f'run-{i}', True) for i in range(10)] + [(f'run-{i}', False) for i in range(10, 20)]
+    assert _run_concurrently(gcp_utils.ensure_iam_policy_members, changes) == [None] * len(changes)
+    assert set(fake_iam.members(GSA)) == _members(range(10))
+    assert fake_iam.requests['set_iam_policy'] == 0
+
+
+def test_concurrent_writers_in_two_processes(fake_iam):
+    # A second batcher stands in for another process writing the same policy
+    other = gcp_utils.PolicyUpdateBatcher(gcp_utils.get_iam_client(), 0.01, 4, 10)
+    try:
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            futures = list(pool.map(
+                lambda i: (other if i % 2 else gcp_utils._policy_updater).submit(
+                    GSA, gcp_utils.workload_identity_member(COMPUTE_NS, f'run-{i}'), True), range(80)))
+        for f in futures:
+            f.result(timeout=60)
+    finally:
+        other.shutdown()
+    assert set(fake_iam.members(GSA)) == _members(range(80))
+
+
+def test_later_change_for_the_same_member_wins(fake_iam):
+    futures = gcp_utils.ensure_iam_policy_members(GSA, COMPUTE_NS, [('run-1', True), ('run-2', True)])
+    futures += gcp_utils.ensure_iam_policy_members(GSA, COMPUTE_NS, [('run-1', False)])
+    for f in futures:
+        f.result(timeout=30)
+    assert set(fake_iam.members(GSA)) == _members([2])
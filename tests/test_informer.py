@@ -0,0 +1,69 @@
+import time
+
+from kubernetes import client
+
+from conftest import COMPUTE_NS
+from informer import Informer
+
+
+def _until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+
+def _run_ids(pod):
+    return [pod.metadata.labels['dominodatalab.com/execution-id']]
+
+
+def test_lists_then_follows_changes(fake_k8s, k8s_ctx):
+    fake_k8s.add_run_pod(COMPUTE_NS, 'r1', 'u1')
+    events = []
+    informer = Informer(k8s_ctx.core_v1.list_namespaced_pod, COMPUTE_NS, indexers={'run': _run_ids},
+                        name='pods-test', watch_timeout_seconds=5)
+    informer.add_event_handler(lambda event_type, pod: events.append((event_type, pod.metadata.name)))
+    informer.start()
+    try:
+        assert informer.wait_for_sync(10)
+        assert [p.metadata.name for p in informer.by_index('run', 'r1')] == ['run-r1-pod']
+        fake_k8s.add_run_pod(COMPUTE_NS, 'r2', 'u1')
+        fake_k8s.delete_run_pod(COMPUTE_NS, 'r1')
+        _until(lambda: ('DELETED', 'run-r1-pod') in events)
+        assert informer.get('run-r1-pod') is None
+        assert informer.by_index('run', 'r1') == []
+        assert [p.metadata.name for p in informer.list()] == ['run-r2-pod']
+        assert events == [('ADDED', 'run-r1-pod'), ('ADDED', 'run-r2-pod'), ('DELETED', 'run-r1-pod')]
+        assert informer.sync_age() < 5
+    finally:
+        informer.stop()
+
+
+def test_relists_when_the_resource_version_expired(fake_k8s, k8s_ctx):
+    fake_k8s.event_history = 2
+    informer = Informer(k8s_ctx.core_v1.list_namespaced_pod, COMPUTE_NS, name='pods-test',
+                        watch_timeout_seconds=5)
+    informer._relist()
+    # More changes than the fake API server remembers before the watch starts: it answers 410 Gone
+    for i in range(5):
+        fake_k8s.add_run_pod(COMPUTE_NS, f'r{i}', 'u1')
+    informer.start()
+    try:
+        _until(lambda: len(informer.list()) == 5)
+        assert fake_k8s.requests['list_pods'] == 2
+    finally:
+        informer.stop()
+
+
+def test_configmap_informer_selects_by_name(fake_k8s, k8s_ctx):
+    fake_k8s.add_config_map('p', 'wanted', {'a': '1'})
+    fake_k8s.add_config_map('p', 'other', {'b': '2'})
+    informer = Informer(k8s_ctx.core_v1.list_namespaced_config_map, 'p', name='cm-test',
+                        watch_timeout_seconds=5, field_selector='metadata.name=wanted')
+    informer.start()
+    try:
+        assert informer.wait_for_sync(10)
+        assert [cm.metadata.name for cm in informer.list()] == ['wanted']
+        assert isinstance(informer.get('wanted'), client.V1ConfigMap)
+    finally:
+        informer.stop()
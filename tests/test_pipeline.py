@@ -0,0 +1,43 @@
+import contextvars
+import threading
+
+import pytest
+
+from pipeline import Pipeline
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+def test_stages_get_their_dependencies_results():
+    p = Pipeline('test')
+    a = p.stage('a', lambda: 2)
+    b = p.stage('b', lambda: 3)
+    c = p.stage('c', lambda x, y: x * y, a, b)
+    assert c.result(timeout=5) == 6
+    assert set(p.timings) == {'a', 'b', 'c'}
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    p = Pipeline('test')
+    stages = [p.stage('wait', barrier.wait) for _ in range(2)]
+    assert sorted(s.result(timeout=5) for s in stages) == [0, 1]
+
+
+def test_failed_dependency_fails_dependents():
+    ran = []
+    p = Pipeline('test')
+    a = p.stage('a', lambda: 1 / 0)
+    b = p.stage('b', lambda x: ran.append(x), a)
+    with pytest.raises(ZeroDivisionError):
+        b.result(timeout=5)
+    assert ran == []
+
+
+def test_stages_see_the_callers_context():
+    token = request_id.set('r-1')
+    try:
+        p = Pipeline('test')
+    finally:
+        request_id.reset(token)
+    assert p.stage('read', request_id.get).result(timeout=5) == 'r-1'
@@ -0,0 +1,50 @@
+import pytest
+
+import user_org_mapping
+from conftest import PLATFORM_NS
+from user_org_mapping import CONFIG_MAP_DOMINO_USER_CURRENT_ORG_MAPPING as NAME
+
+
+@pytest.fixture(autouse=True)
+def no_config_map_cache(monkeypatch):
+    monkeypatch.setenv('CONFIGMAP_CACHE_ENABLED', 'false')
+
+
+def _store(k8s_ctx, **kwargs):
+    return user_org_mapping.UserOrgMappingStore(PLATFORM_NS, k8s_ctx, flush_interval=0.01, **kwargs)
+
+
+def test_queued_changes_are_visible_and_written_in_one_patch(fake_k8s, k8s_ctx):
+    fake_k8s.add_config_map(PLATFORM_NS, NAME, {'other': 'org0'})
+    store = _store(k8s_ctx, shards=1)
+    futures = [store.set(f'u{i}', f'org{i}') for i in range(20)]
+    assert store.get('u3') == 'org3'
+    store.flush()
+    assert all(f.result(timeout=5) for f in futures)
+    assert fake_k8s.config_maps[(PLATFORM_NS, NAME)]['data'] == dict({f'u{i}': f'org{i}' for i in range(20)},
+                                                                       other='org0')
+    assert fake_k8s.requests['patch_config_map'] == 1
+
+
+def test_shards_fall_back_to_the_unsharded_config_map(fake_k8s, k8s_ctx):
+    fake_k8s.add_config_map(PLATFORM_NS, NAME, {'u1': 'old', 'u2': 'old'})
+    store = _store(k8s_ctx, shards=4)
+    store.set('u1', 'new')
+    store.flush()
+    assert store.get('u1') == 'new'
+    assert store.get('u2') == 'old'
+    assert (PLATFORM_NS, store.shard_name('u1')) in fake_k8s.config_maps
+
+
+def test_previous_shard_layouts_are_read(fake_k8s, k8s_ctx):
+    before = _store(k8s_ctx, shards=4)
+    for i in range(20):
+        before.set(f'u{i}', 'org4')
+    before.flush()
+    after = _store(k8s_ctx, shards=7, previous_shards=[4])
+    after.set('u3', 'org7')
+    after.flush()
+    assert [after.get(f'u{i}') for i in range(5)] == ['org4', 'org4', 'org4', 'org7', 'org4']
+    assert after.get('nobody') is None
+    # Without the previous layout the defaults saved under it are not found
+    assert _store(k8s_ctx, shards=7).get('u0') is None